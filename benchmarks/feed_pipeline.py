@@ -0,0 +1,100 @@
+# Benchmark: cost of the feed pipeline against collection size
+#
+# Compares the old pipeline (join every post, then sort/limit) with the
+# limit-first pipeline from flaskblog.queries, using either $lookup or
+# batched author resolution. Seeds a scratch database, so point
+# BENCH_MONGO_URI at a disposable mongod (mongomock is used when unset).
+#
+#   python benchmarks/feed_pipeline.py --sizes 1000 10000 50000
+import argparse
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from flaskblog.queries import post_pipeline  # noqa: E402
+
+PAGE_SIZE = 4
+SORT = [("date_posted", -1), ("_id", -1)]
+
+
+def get_database():
+    uri = os.getenv("BENCH_MONGO_URI")
+    if uri:
+        from pymongo import MongoClient
+        return MongoClient(uri).get_database("flaskblog_bench")
+    import mongomock
+    return mongomock.MongoClient().get_database("flaskblog_bench")
+
+
+def seed(db, n_posts, n_users=100):
+    db.users.drop()
+    db.posts.drop()
+    user_ids = db.users.insert_many([
+        {"username": f"user{i}", "email": f"user{i}@example.com", "password": "x", "image": "default.jpg"}
+        for i in range(n_users)
+    ]).inserted_ids
+    start = datetime(2024, 1, 1)
+    batch = []
+    for i in range(n_posts):
+        batch.append({"author": user_ids[i % n_users], "title": f"Post {i}", "content": "lorem ipsum " * 20,
+                      "date_posted": start + timedelta(seconds=i)})
+        if len(batch) == 5000:
+            db.posts.insert_many(batch)
+            batch = []
+    if batch:
+        db.posts.insert_many(batch)
+    db.posts.create_index([("date_posted", 1), ("_id", 1)])
+
+
+# The pipeline main.home used before: join the whole collection, then page
+def join_first(db):
+    return list(db.posts.aggregate([
+        {"$lookup": {"from": "users", "localField": "author", "foreignField": "_id", "as": "author_details"}},
+        {"$unwind": "$author_details"},
+        {"$project": {"_id": 1, "title": 1, "content": 1, "date_posted": 1, "author_details.username": 1}},
+        {"$sort": dict(SORT)},
+        {"$limit": PAGE_SIZE},
+    ]))
+
+
+def limit_first_lookup(db):
+    return list(db.posts.aggregate(post_pipeline(sort=SORT, limit=PAGE_SIZE)))
+
+
+def limit_first_batch(db):
+    posts = list(db.posts.aggregate(post_pipeline(sort=SORT, limit=PAGE_SIZE, join=False)))
+    author_ids = list({post["author"] for post in posts})
+    authors = {user["_id"]: user for user in db.users.find({"_id": {"$in": author_ids}}, {"username": 1})}
+    for post in posts:
+        post["author_details"] = {"username": authors[post.pop("author")]["username"]}
+    return posts
+
+
+def timeit(func, db, repeat):
+    func(db)  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func(db)
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 5000, 20000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    db = get_database()
+    variants = [("join-first", join_first), ("limit-first $lookup", limit_first_lookup),
+                ("limit-first batch", limit_first_batch)]
+    print(f"{'posts':>8}  " + "  ".join(f"{name:>20}" for name, _ in variants) + "   (ms per page)")
+    for size in args.sizes:
+        seed(db, size)
+        timings = [timeit(func, db, args.repeat) for _, func in variants]
+        print(f"{size:>8}  " + "  ".join(f"{ms:>20.2f}" for ms in timings))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+# Load-testing and benchmark harness
+#
+# Seeds a database with users and posts, then drives the real blueprints
+# either through the Flask test client (no network, one request at a time)
+# or through a threaded HTTP load generator against a local server. Reports
+# p50/p95/p99 latency, throughput, MongoDB commands per request and error
+# responses (4xx/5xx) for each scenario, and can save / compare JSON
+# baselines. A run with errors exits non-zero and its baseline is marked
+# invalid: a fast 429 or 503 is not a fast success.
+#
+# By default the app runs against mongomock; set BENCH_MONGO_URI to use a
+# disposable local mongod instead (its database is dropped and re-seeded).
+# Mongo ops per request come from pymongo command monitoring, so they are
+# only reported against a real mongod.
+#
+#   python benchmarks/harness.py --users 200 --posts 20000 --save benchmarks/baselines/local.json
+#   python benchmarks/harness.py --mode http --concurrency 16 --compare benchmarks/baselines/local.json
+import argparse
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+# Config reads the environment at import time
+os.environ.setdefault("SECRET_KEY", "benchmark")
+os.environ.setdefault("MAIL_SERVER", "localhost")
+os.environ.setdefault("MAIL_PORT", "1025")
+os.environ.setdefault("MAIL_USERNAME", "bench@example.com")
+os.environ.setdefault("MONGO_URI", os.getenv("BENCH_MONGO_URI", "mongodb://localhost:27017/flaskblog_bench"))
+
+PASSWORD = "benchmark-password"
+
+
+def make_app(use_mongomock, cache):
+    if use_mongomock:
+        import mongomock
+        import flask_pymongo
+        flask_pymongo.MongoClient = mongomock.MongoClient
+
+    from flaskblog import create_app
+    from flaskblog.config import Config
+
+    class BenchConfig(Config):
+        TESTING = True
+        WTF_CSRF_ENABLED = False
+        MAIL_QUEUE_ENABLED = False
+        # Standalone servers and mongomock have no change streams
+        EVENTS_SOURCE = "poll"
+        # Every request comes from the same client IP
+        RATELIMIT_ENABLED = False
+        RESPONSE_CACHE_ENABLED = cache
+        SERVER_NAME = None
+
+    return create_app(BenchConfig)
+
+
+def seed(app, n_users, n_posts):
+    from flaskblog import mongo, passwords
+    from flaskblog.fanout import author_snapshot
+    from flaskblog.summaries import summarize as summarize_post
+    with app.app_context():
+        db = mongo.db
+        db.users.delete_many({})
+        db.posts.delete_many({})
+        # One hash shared by every user, hashing thousands would dominate seeding
+        hashed = passwords.hash(PASSWORD)
+        users = [{"username": f"user{i}", "email": f"user{i}@example.com", "password": hashed,
+                  "date_joined": datetime.now(), "image": "default.jpg"} for i in range(n_users)]
+        user_ids = db.users.insert_many(users).inserted_ids
+        # Posts carry what add_post stores: the summary and the author snapshot
+        content = "lorem ipsum dolor sit amet " * 40
+        summary = summarize_post(content)
+        snapshots = [author_snapshot(user) for user in users]
+        start = datetime(2024, 1, 1)
+        post_ids, batch = [], []
+        for i in range(n_posts):
+            batch.append({"author": user_ids[i % n_users], "author_details": snapshots[i % n_users],
+                          "title": f"Benchmark post {i}", "content": content,
+                          "date_posted": start + timedelta(seconds=i), **summary})
+            if len(batch) == 5000:
+                post_ids += db.posts.insert_many(batch).inserted_ids
+                batch = []
+        if batch:
+            post_ids += db.posts.insert_many(batch).inserted_ids
+        try:
+            from flaskblog.migrations import apply_indexes
+            apply_indexes(db)
+        except Exception as error:  # mongomock lacks some index types
+            print(f"Skipping some indexes: {error}", file=sys.stderr)
+        return [str(post_id) for post_id in post_ids], n_users
+
+
+# Each scenario returns (method, path, form data) for one request
+def scenarios(post_ids, n_users):
+    return {
+        "feed": lambda: ("GET", "/", None),
+        "feed_deep_page": lambda: ("GET", f"/?page={max(len(post_ids) // 8, 1)}", None),
+        "post_view": lambda: ("GET", f"/post/{random.choice(post_ids)}", None),
+        "login": lambda: ("POST", "/login", {"email": f"user{random.randrange(n_users)}@example.com",
+                                            "password": PASSWORD}),
+        "api_export": lambda: ("GET", "/api/posts?limit=100", None),
+    }
+
+
+def summarize(latencies, elapsed, mongo_ops, errors):
+    latencies = sorted(latencies)
+
+    def pct(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000
+
+    return {
+        "requests": len(latencies),
+        "p50_ms": round(pct(0.50), 3),
+        "p95_ms": round(pct(0.95), 3),
+        "p99_ms": round(pct(0.99), 3),
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3),
+        "throughput_rps": round(len(latencies) / elapsed, 1),
+        "mongo_ops_per_request": round(mongo_ops / len(latencies), 2) if mongo_ops is not None else None,
+        "errors": errors,
+        "error_rate": round(errors / len(latencies), 4),
+    }
+
+
+def mongo_ops_for(endpoint):
+    from flaskblog import metrics
+    return metrics.mongo_per_request.value(endpoint)
+
+
+def run_client(app, make_request, requests):
+    client = app.test_client()
+    latencies, errors = [], 0
+    start = time.perf_counter()
+    for _ in range(requests):
+        method, path, data = make_request()
+        began = time.perf_counter()
+        response = client.open(path, method=method, data=data)
+        response.get_data()
+        latencies.append(time.perf_counter() - began)
+        if response.status_code >= 400:
+            errors += 1
+        if method == "POST":
+            client.get("/logout")
+    return latencies, errors, time.perf_counter() - start
+
+
+def run_http(base_url, make_request, requests, concurrency):
+    latencies, lock = [], threading.Lock()
+    remaining, errors = [requests], [0]
+
+    def worker():
+        opener = urllib.request.build_opener(urllib.request.HTTPRedirectHandler())
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+            method, path, data = make_request()
+            body = urllib.parse.urlencode(data).encode() if data else None
+            began = time.perf_counter()
+            failed = False
+            try:
+                with opener.open(urllib.request.Request(base_url + path, data=body, method=method)) as response:
+                    response.read()
+            except urllib.error.HTTPError as error:
+                error.read()
+                failed = True
+            except urllib.error.URLError:
+                failed = True
+            with lock:
+                latencies.append(time.perf_counter() - began)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - start
+
+
+def serve(app):
+    import logging
+    from werkzeug.serving import make_server
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}"
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+    if not baseline.get("valid", True):
+        print("\nNote: the baseline run had error responses, its numbers are not trustworthy.")
+    if (baseline.get("mode"), baseline.get("database")) != (results["mode"], results["database"]):
+        print(f"\nNote: baseline was recorded with mode={baseline.get('mode')} "
+              f"database={baseline.get('database')}, numbers may not be comparable.")
+    print(f"\n{'scenario':<16} {'metric':<16} {'baseline':>10} {'current':>10} {'change':>9}")
+    for name, current in results["scenarios"].items():
+        previous = baseline["scenarios"].get(name)
+        if not previous:
+            continue
+        for metric in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps", "mongo_ops_per_request"):
+            old, new = previous.get(metric), current.get(metric)
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            worse = change < -threshold if metric == "throughput_rps" else change > threshold
+            flag = "  REGRESSION" if worse else ""
+            print(f"{name:<16} {metric:<16} {old:>10} {new:>10} {change:>+8.1f}%{flag}")
+            if worse:
+                regressions.append((name, metric))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--posts", type=int, default=5000)
+    parser.add_argument("--requests", type=int, default=200, help="requests per scenario")
+    parser.add_argument("--mode", choices=("client", "http"), default="client")
+    parser.add_argument("--concurrency", type=int, default=8, help="HTTP mode worker threads")
+    parser.add_argument("--scenario", action="append", help="only run these scenarios")
+    parser.add_argument("--no-cache", action="store_true", help="disable the rendered-page cache")
+    parser.add_argument("--save", help="write results to this JSON baseline")
+    parser.add_argument("--compare", help="compare against this JSON baseline")
+    parser.add_argument("--threshold", type=float, default=10.0, help="regression threshold in percent")
+    args = parser.parse_args()
+
+    use_mongomock = not os.getenv("BENCH_MONGO_URI")
+    app = make_app(use_mongomock, cache=not args.no_cache)
+    print(f"Seeding {args.users} users and {args.posts} posts ({'mongomock' if use_mongomock else 'mongod'})...")
+    post_ids, n_users = seed(app, args.users, args.posts)
+
+    endpoints = {"feed": "main.home", "feed_deep_page": "main.home", "post_view": "posts.post",
+                 "login": "users.login", "api_export": "posts.get_all_posts"}
+    server = base_url = None
+    if args.mode == "http":
+        server, base_url = serve(app)
+
+    results = {"created": datetime.now().isoformat(timespec="seconds"), "mode": args.mode,
+               "database": "mongomock" if use_mongomock else "mongod",
+               "users": args.users, "posts": args.posts, "valid": True, "scenarios": {}}
+    print(f"\n{'scenario':<16} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'req/s':>9} {'mongo ops':>10} {'errors':>7}")
+    for name, make_request in scenarios(post_ids, n_users).items():
+        if args.scenario and name not in args.scenario:
+            continue
+        before = mongo_ops_for(endpoints[name])
+        if args.mode == "client":
+            latencies, errors, elapsed = run_client(app, make_request, args.requests)
+        else:
+            latencies, errors, elapsed = run_http(base_url, make_request, args.requests, args.concurrency)
+        ops = mongo_ops_for(endpoints[name]) - before
+        summary = summarize(latencies, elapsed, None if use_mongomock else ops, errors)
+        results["scenarios"][name] = summary
+        if errors:
+            results["valid"] = False
+        ops_text = summary["mongo_ops_per_request"] if summary["mongo_ops_per_request"] is not None else "n/a"
+        print(f"{name:<16} {summary['p50_ms']:>9} {summary['p95_ms']:>9} {summary['p99_ms']:>9} "
+              f"{summary['throughput_rps']:>9} {ops_text:>10} {errors:>7}")
+
+    if server is not None:
+        server.shutdown()
+    if args.save:
+        os.makedirs(os.path.dirname(os.path.abspath(args.save)), exist_ok=True)
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved baseline to {args.save}")
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            failed = bool(compare(results, json.load(f), args.threshold))
+    if not results["valid"]:
+        failing = [name for name, summary in results["scenarios"].items() if summary["errors"]]
+        print(f"\nError responses in: {', '.join(failing)}. Their latencies are not comparable, "
+              f"fix the setup and run again.", file=sys.stderr)
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
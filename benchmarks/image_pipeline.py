@@ -0,0 +1,71 @@
+# Benchmark: profile picture processing, old single-size path vs the pipeline
+#
+# The old path (flaskblog.utils.save_image before the pipeline) decoded and
+# thumbnailed the upload on the request thread and wrote one 125px file.
+# The pipeline writes 4 sizes x 2 formats in a process pool. This measures
+# per-upload latency and the throughput of N concurrent request threads.
+#
+#   python benchmarks/image_pipeline.py --threads 8 --uploads 32
+import argparse
+import io
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+from flaskblog.images import render_renditions  # noqa: E402
+
+
+def make_upload(width, height):
+    from PIL import Image
+    image = Image.effect_noise((width, height), 64).convert("RGB")
+    buf = io.BytesIO()
+    image.save(buf, "JPEG", quality=95)
+    return buf.getvalue()
+
+
+def single_size(data, directory, index):
+    from PIL import Image
+    image = Image.open(io.BytesIO(data))
+    image.thumbnail((125, 125))
+    image.save(os.path.join(directory, f"legacy-{index}.jpg"))
+
+
+def run(label, submit, uploads, threads):
+    start = time.perf_counter()
+    latencies = []
+
+    def one(index):
+        began = time.perf_counter()
+        submit(index)
+        latencies.append(time.perf_counter() - began)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(one, range(uploads)))
+    elapsed = time.perf_counter() - start
+    latencies.sort()
+    print(f"{label:<28} {uploads / elapsed:>8.1f} uploads/s   "
+          f"p50 {latencies[len(latencies) // 2] * 1000:>7.1f} ms   p95 {latencies[int(len(latencies) * 0.95)] * 1000:>7.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--uploads", type=int, default=16)
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--size", type=int, nargs=2, default=[2400, 1600])
+    args = parser.parse_args()
+
+    data = make_upload(*args.size)
+    with tempfile.TemporaryDirectory() as directory, ProcessPoolExecutor(args.workers) as pool:
+        pool.submit(int).result()  # start the workers before timing
+        run("single size, request thread", lambda i: single_size(data, directory, i), args.uploads, args.threads)
+        run("8 renditions, process pool",
+            lambda i: pool.submit(render_renditions, data, f"{i:016x}", directory).result(),
+            args.uploads, args.threads)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,46 @@
 from flask import Flask, current_app
 from dotenv import load_dotenv
 from flask_pymongo import PyMongo
-from flask_bcrypt import Bcrypt
-from flask_login import LoginManager, UserMixin
+from flask_login import LoginManager
 from bson.objectid import ObjectId
 from itsdangerous.url_safe import URLSafeTimedSerializer as Serializer
-from flask_mail import Mail
+from flaskblog.profiles import ProfileCache
+from flaskblog.cache import ResponseCache
+from flaskblog.mailer import LazyMail, MailQueue
+from flaskblog.images import ImagePipeline
+from flaskblog.search.backends import SearchService
+from flaskblog.metrics import Metrics
+from flaskblog.fanout import AuthorFanout
+from flaskblog.passwords import PasswordHasher
+from flaskblog.assets import Assets
+from flaskblog.compression import Compression
+from flaskblog.ratelimit import RateLimiter
+from flaskblog.events import ChangeFeed, invalidate_caches
+from flaskblog.sessions import SessionStore
+from flaskblog.db import Database, AsyncDatabase
 
 # Load .env variables
 load_dotenv()
 
 # Initialize extensions (without app context)
-mail = Mail()
+mail = LazyMail()
 mongo = PyMongo()
-bcrypt = Bcrypt()
+database = Database(mongo)
+async_database = AsyncDatabase(mongo)
+passwords = PasswordHasher()
+assets = Assets()
+compression = Compression()
+rate_limiter = RateLimiter()
 login_manager = LoginManager()
+session_store = SessionStore()
+profile_cache = ProfileCache(mongo)
+response_cache = ResponseCache()
+mail_queue = MailQueue(mail, mongo)
+image_pipeline = ImagePipeline()
+search_service = SearchService(database)
+metrics = Metrics()
+author_fanout = AuthorFanout(mongo)
+change_feed = ChangeFeed(mongo)
 
 # Define schemas
 post_schema = {
@@ -28,6 +54,20 @@ post_schema = {
         "title": {"bsonType": "string", "description": "Title must be a string"},
         "content": {"bsonType": "string", "description": "Content must be a string"},
         "date_posted": {"bsonType": "date", "description": "Date must be a valid date"},
+        # Derived from the content when the post is written (flaskblog/summaries.py)
+        "excerpt": {"bsonType": "string"},
+        "word_count": {"bsonType": "int"},
+        "reading_time": {"bsonType": "int"},
+        "content_html": {"bsonType": "string"},
+        "content_hash": {"bsonType": "string"},
+        "author_details": {
+            "bsonType": "object",
+            "description": "Snapshot of the author's display fields, kept in sync by the fan-out job",
+            "properties": {
+                "username": {"bsonType": "string"},
+                "image": {"bsonType": "string"},
+            },
+        },
     },
 }
 
@@ -40,33 +80,47 @@ user_schema = {
         "password": {"bsonType": "string", "description": "Password must be a string"},
         "date_joined": {"bsonType": "date", "description": "Date must be a valid date"},
         "image": {"bsonType": "string", "description": "Image must be a string"},
-        "posts": {
-            "bsonType": "array",
-            "items": {"bsonType": "objectId"},
-            "description": "List of post ObjectIds authored by the user"
-        }
+        "session_epoch": {"bsonType": "int", "description": "Bumped to sign out every session of the user"},
     },
 }
 
-# User class
-class User(UserMixin):
-    def __init__(self, id, username, email, image):
+# Signed-in user: a compact snapshot of the profile, also kept in the session
+# (see flaskblog/sessions.py)
+class User:
+    __slots__ = ("id", "username", "email", "image", "epoch")
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, email, image, epoch=0):
         self.id = id
         self.username = username
         self.email = email
         self.image = image
+        self.epoch = epoch
+
+    # The session epoch is part of the id, so bumping it signs out every
+    # session and remember-me cookie issued before
+    def get_id(self):
+        return f"{self.id}:{self.epoch}"
 
     @staticmethod
     def get(user_id):
-        user_data = mongo.db.users.find_one({"_id": ObjectId(user_id)})
+        user_data = profile_cache.get(user_id)
         if not user_data:
             return None
-        return User(str(user_data["_id"]), user_data["username"], user_data["email"], user_data["image"])
+        return User.from_document(user_data)
+
+    @staticmethod
+    def from_document(user_data):
+        return User(str(user_data["_id"]), user_data["username"], user_data["email"], user_data["image"],
+                    user_data.get("session_epoch", 0))
     
     def get_reset_token(self, expires_sec=1800):
         s = Serializer(current_app.config["SECRET_KEY"])
-        return s.dumps({"id": self.id})
+        return s.dumps({"id": self.id, "epoch": self.epoch})
     
+    # A token only works until the password it resets has changed
     @staticmethod
     def verify_reset_token(token):
         s = Serializer(current_app.config["SECRET_KEY"])
@@ -74,12 +128,15 @@ class User(UserMixin):
             data = s.loads(token)
         except:
             return None
-        return User.get(data["id"])
+        user = User.get(data["id"])
+        if user is None or user.epoch != data.get("epoch", 0):
+            return None
+        return user
 
 # Login manager setup
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get(user_id)
+    return session_store.load_user(user_id)
 
 login_manager.login_view = "users.login"
 login_manager.login_message_category = 'info'
@@ -90,26 +147,56 @@ def create_app(config_class="flaskblog.config.Config"):
     app.config.from_object(config_class)
 
     # Initialize extensions with the app
-    mongo.init_app(app)
+    database.init_app(app, event_listeners=[metrics.command_listener])
+    async_database.init_app(app, event_listeners=[metrics.command_listener])
     mail.init_app(app)
-    bcrypt.init_app(app)
+    passwords.init_app(app)
+    assets.init_app(app)
+    compression.init_app(app)
+    rate_limiter.init_app(app)
     login_manager.init_app(app)
+    session_store.init_app(app)
+    profile_cache.init_app(app)
+    response_cache.init_app(app)
+    mail_queue.init_app(app)
+    image_pipeline.init_app(app)
+    search_service.init_app(app)
+    metrics.init_app(app)
+    author_fanout.init_app(app)
+    change_feed.init_app(app)
+    change_feed.on_change(invalidate_caches)
+    change_feed.on_change(session_store.user_changed)
+    metrics.add_collector("profile_cache", profile_cache.stats)
+    metrics.add_collector("response_cache", response_cache.stats)
+    metrics.add_collector("search", search_service.stats)
+    metrics.add_collector("mongo_pool", database.pool_stats.totals)
+    metrics.add_collector("passwords", passwords.stats)
+    metrics.add_collector("ratelimit", rate_limiter.stats)
+    metrics.add_collector("events", change_feed.stats)
+    metrics.add_collector("sessions", session_store.stats)
 
-    # Apply schema validation after initializing the app and database
-    with app.app_context():
-        db = mongo.db
-        if db is not None:
-            db.command("collMod", "posts", validator={"$jsonSchema": post_schema})
-            db.command("collMod", "users", validator={"$jsonSchema": user_schema})
+    # Validators and indexes are provisioned by `flask db upgrade`; the version
+    # is checked on the first request, so booting never waits on Mongo
+    from flaskblog.migrations import db_cli, deferred_schema_check
+    from flaskblog.startup import profile_startup_command
+    from flaskblog.posts.cli import posts_cli
+    from flaskblog.bulk import data_cli
+    app.cli.add_command(db_cli)
+    app.cli.add_command(posts_cli)
+    app.cli.add_command(data_cli)
+    app.cli.add_command(profile_startup_command)
+    app.before_request(deferred_schema_check(app, mongo))
 
     # Register blueprints
     from flaskblog.users.routes import users_blueprint
     from flaskblog.posts.routes import posts_blueprint
     from flaskblog.main.routes import main_blueprint
+    from flaskblog.search.routes import search_blueprint
     from flaskblog.errors.handlers import errors_blueprint
     app.register_blueprint(users_blueprint)
     app.register_blueprint(posts_blueprint)
     app.register_blueprint(main_blueprint)
+    app.register_blueprint(search_blueprint)
     app.register_blueprint(errors_blueprint)
 
     return app
\ No newline at end of file
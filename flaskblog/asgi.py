@@ -0,0 +1,202 @@
+# ASGI serving mode
+#
+# The hot read paths (feed, post page, listings, login) have coroutine
+# variants registered with @async_view. They run on the event loop against
+# pymongo's asyncio client, and CPU-bound work such as bcrypt is awaited from
+# a process pool, so one process can hold many slow clients. Every other endpoint
+# falls through to the regular Flask app, run in a thread pool by asgiref.
+#
+# Routing, request/session handling, before/after request hooks, error
+# handlers and templates are all the Flask app's own: an async view runs
+# inside a normal Flask request context. The hooks are synchronous and may do
+# I/O (the SQLite session store, rate limits, the user loader), so they run
+# in asgiref's thread pool rather than on the loop.
+import asyncio
+import sys
+from collections import defaultdict
+from io import BytesIO
+from flask import Response, request, session
+from werkzeug.exceptions import HTTPException
+
+# endpoint -> coroutine view
+async_views = {}
+
+
+# Register a coroutine as the ASGI variant of a Flask endpoint
+def async_view(endpoint):
+    def decorator(view):
+        async_views[endpoint] = view
+        return view
+    return decorator
+
+
+# Call blocking code (sync pymongo, the SQLite session store) from a
+# coroutine view in asgiref's thread pool, keeping the request context
+async def run_sync(function, *args, **kwargs):
+    from asgiref.sync import sync_to_async
+    return await sync_to_async(function, thread_sensitive=False)(*args, **kwargs)
+
+
+# Response whose body is an async iterator, sent chunk by chunk
+class AsyncStreamResponse(Response):
+    def __init__(self, body, **kwargs):
+        super().__init__(**kwargs)
+        self.async_body = body
+
+
+def build_environ(scope, body=b""):
+    script_name = scope.get("root_path", "").encode("utf8").decode("latin1")
+    path_info = scope["path"].encode("utf8").decode("latin1")
+    if path_info.startswith(script_name):
+        path_info = path_info[len(script_name):]
+    server = scope.get("server") or ("localhost", 80)
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": script_name,
+        "PATH_INFO": path_info,
+        "QUERY_STRING": scope["query_string"].decode("ascii"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f"HTTP/{scope['http_version']}",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    if scope.get("client"):
+        environ["REMOTE_ADDR"] = scope["client"][0]
+    headers = defaultdict(list)
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin1")
+        if name in ("content-length", "content-type"):
+            key = name.upper().replace("-", "_")
+        else:
+            key = "HTTP_" + name.upper().replace("-", "_")
+        headers[key].append(value.decode("latin1"))
+    for key, values in headers.items():
+        environ[key] = ",".join(values)
+    return environ
+
+
+class AsyncDispatcher:
+    def __init__(self, app):
+        from asgiref.wsgi import WsgiToAsgi
+        self.app = app
+        self.wsgi = WsgiToAsgi(app)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] != "http":
+            return await self.wsgi(scope, receive, send)
+        environ = build_environ(scope)
+        try:
+            endpoint, view_args = self.app.url_map.bind_to_environ(environ).match()
+        except HTTPException:
+            endpoint = None
+        view = async_views.get(endpoint)
+        if view is None:
+            return await self.wsgi(scope, receive, send)
+
+        environ["wsgi.input"] = BytesIO(await self.read_body(receive))
+        response = await self.dispatch(environ, view)
+        await self.send_response(response, receive, send)
+
+    async def lifespan(self, receive, send):
+        from flaskblog import async_database
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await async_database.close()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def read_body(self, receive):
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return body
+
+    # Flask's full_dispatch_request, awaiting the view and the hooks
+    async def dispatch(self, environ, view):
+        app = self.app
+        with app.request_context(environ):
+            try:
+                try:
+                    await self.load_session_user()
+                    rv = await run_sync(app.preprocess_request)
+                    if rv is None:
+                        rv = await view(**request.view_args)
+                except Exception as error:
+                    rv = app.handle_user_exception(error)
+                return await run_sync(app.finalize_request, rv)
+            except Exception as error:
+                return app.handle_exception(error)
+
+    # Warm the profile cache so Flask-Login's user loader doesn't block the loop
+    async def load_session_user(self):
+        from flaskblog import async_database, profile_cache, session_store
+        from flaskblog.sessions import parse_token
+        token = session.get("_user_id")
+        parsed = parse_token(token)
+        # A current session snapshot needs no profile at all
+        if parsed and session_store.cached_user(token) is None:
+            await profile_cache.get_many_async([parsed[0]], async_database.db.users)
+
+    async def send_response(self, response, receive, send):
+        headers = [(name.lower().encode("latin1"), value.encode("latin1")) for name, value in response.headers.items()]
+        await send({"type": "http.response.start", "status": response.status_code, "headers": headers})
+        try:
+            if isinstance(response, AsyncStreamResponse) and response.status_code != 304:
+                if not await self.send_stream(response.async_body, receive, send):
+                    return
+            else:
+                for chunk in response.iter_encoded():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            response.close()
+
+    # Send an async body until it ends or the client goes away (servers drop
+    # what is sent after a disconnect, so it has to be watched for). Returns
+    # False on disconnect. The body is closed either way, so a stream such
+    # as the new-post feed stops and unsubscribes.
+    async def send_stream(self, body, receive, send):
+        disconnected = asyncio.ensure_future(self.wait_disconnect(receive))
+        chunks = body.__aiter__()
+        try:
+            while True:
+                next_chunk = asyncio.ensure_future(chunks.__anext__())
+                await asyncio.wait({next_chunk, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+                if not next_chunk.done():
+                    next_chunk.cancel()
+                    await asyncio.gather(next_chunk, return_exceptions=True)
+                    return False
+                try:
+                    chunk = next_chunk.result()
+                except StopAsyncIteration:
+                    return True
+                if chunk:
+                    data = chunk.encode() if isinstance(chunk, str) else chunk
+                    await send({"type": "http.response.body", "body": data, "more_body": True})
+        finally:
+            disconnected.cancel()
+            aclose = getattr(body, "aclose", None)
+            if aclose is not None:
+                await aclose()
+
+    async def wait_disconnect(self, receive):
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+
+def create_asgi_app(config_class="flaskblog.config.Config"):
+    from flaskblog import create_app
+    return AsyncDispatcher(create_app(config_class))
@@ -0,0 +1,167 @@
+# Static asset pipeline
+#
+# `flask assets build` copies every static file to static/dist/ under a name
+# carrying a hash of its content (main.css -> dist/main.3f2a9c0d1b7e.css),
+# writes gzip (and, with the brotli package, brotli) copies next to the text
+# files and records everything in dist/manifest.json. The manifest is read
+# once at startup: `asset_url("main.css")` resolves the fingerprinted name
+# and the static view serves those files, and the content-named profile
+# picture renditions, with a far-future immutable Cache-Control and the best
+# precompressed copy the client accepts. Files missing from the manifest are
+# served as before, so the app works without a build.
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import click
+from flask import request, send_from_directory, url_for
+from flask.cli import AppGroup
+from flaskblog.images import rendition_pattern
+
+dist_folder = "dist"
+# Folders holding user content, already named by their content
+skip_folders = ("dist", "profile_pics")
+compressible = (".css", ".js", ".svg", ".json", ".txt", ".map", ".html", ".ico")
+
+
+def _brotli():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def fingerprint(filename, data):
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+class Assets:
+    def __init__(self):
+        self.static_folder = None
+        self.max_age = 31536000
+        self.manifest = {}
+        self.fingerprinted = {}
+
+    def init_app(self, app):
+        self.static_folder = app.static_folder
+        self.max_age = app.config.get("ASSETS_MAX_AGE", self.max_age)
+        self.manifest = self.load_manifest()
+        self.fingerprinted = {entry["path"]: entry for entry in self.manifest.values()}
+        app.add_template_global(self.asset_url, "asset_url")
+        app.view_functions["static"] = self.send_static
+        app.cli.add_command(assets_cli)
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.static_folder, dist_folder, "manifest.json")
+
+    def load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+
+    # url_for("static", ...) that points at the fingerprinted copy when there is one
+    def asset_url(self, filename, **kwargs):
+        entry = self.manifest.get(filename)
+        return url_for("static", filename=entry["path"] if entry else filename, **kwargs)
+
+    def is_immutable(self, filename):
+        if filename in self.fingerprinted:
+            return True
+        folder, _, name = filename.rpartition("/")
+        return folder == "profile_pics" and rendition_pattern.match(name) is not None
+
+    # Replaces Flask's static view
+    def send_static(self, filename):
+        if not self.is_immutable(filename):
+            return send_from_directory(self.static_folder, filename)
+        encoding = None
+        entry = self.fingerprinted.get(filename)
+        if entry:
+            accepted = [name for name in entry.get("encodings", ()) if request.accept_encodings[name]]
+            if accepted:
+                encoding = max(accepted, key=lambda name: request.accept_encodings[name])
+        if encoding:
+            suffix = ".br" if encoding == "br" else ".gz"
+            mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+            response = send_from_directory(self.static_folder, filename + suffix, mimetype=mimetype,
+                                           max_age=self.max_age)
+            response.content_encoding = encoding
+        else:
+            response = send_from_directory(self.static_folder, filename, max_age=self.max_age)
+        if entry and entry.get("encodings"):
+            response.vary.add("Accept-Encoding")
+        response.cache_control.immutable = True
+        return response
+
+    # Fingerprint and precompress every static file, returning the manifest.
+    # `prune` deletes the files of previous builds; keep them while pages
+    # rendered by older workers may still reference them.
+    def build(self, prune=False):
+        brotli = _brotli()
+        manifest, written = {}, set()
+        for root, folders, files in os.walk(self.static_folder):
+            relative_root = os.path.relpath(root, self.static_folder)
+            if relative_root == ".":
+                folders[:] = [folder for folder in folders if folder not in skip_folders]
+                relative_root = ""
+            for name in sorted(files):
+                if name.startswith("."):
+                    continue
+                source = os.path.join(relative_root, name).replace(os.sep, "/")
+                with open(os.path.join(root, name), "rb") as f:
+                    data = f.read()
+                target = f"{dist_folder}/{fingerprint(source, data)}"
+                _write(os.path.join(self.static_folder, target), data)
+                written.add(target)
+                encodings = []
+                if name.endswith(compressible):
+                    # Precompressed copies of a content-named file never change
+                    _write(os.path.join(self.static_folder, target + ".gz"), gzip.compress(data, 9, mtime=0))
+                    written.add(target + ".gz")
+                    encodings.append("gzip")
+                    if brotli is not None:
+                        _write(os.path.join(self.static_folder, target + ".br"), brotli.compress(data))
+                        written.add(target + ".br")
+                        encodings.insert(0, "br")
+                manifest[source] = {"path": target, "encodings": encodings}
+
+        if prune:
+            dist = os.path.join(self.static_folder, dist_folder)
+            for root, _, files in os.walk(dist):
+                for name in files:
+                    path = os.path.relpath(os.path.join(root, name), self.static_folder).replace(os.sep, "/")
+                    if path not in written and name != "manifest.json":
+                        os.remove(os.path.join(root, name))
+        _write(self.manifest_path, json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+        return manifest
+
+
+assets_cli = AppGroup("assets", help="Static asset pipeline.")
+
+
+@assets_cli.command("build")
+@click.option("--prune", is_flag=True, help="Delete the files of previous builds.")
+def build_command(prune):
+    """Fingerprint and precompress the static files."""
+    from flaskblog import assets
+    manifest = assets.build(prune=prune)
+    for source, entry in sorted(manifest.items()):
+        encodings = f" (+{', '.join(entry['encodings'])})" if entry["encodings"] else ""
+        click.echo(f"{source} -> {entry['path']}{encodings}")
+    if _brotli() is None:
+        click.echo("brotli is not installed, only gzip copies were written.")
+    click.echo(f"Wrote {assets.manifest_path}. Restart the app to pick it up.")
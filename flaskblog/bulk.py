@@ -0,0 +1,247 @@
+# Bulk import and export of posts and users
+#
+# `flask data export posts posts.ndjson` streams a collection out as NDJSON
+# (MongoDB extended JSON, one document per line) or BSON (mongodump's
+# format, picked by the .bson extension or --format). `flask data import
+# posts posts.ndjson` streams such a dump back in:
+#
+# - every document is checked against the collection's $jsonSchema before
+#   it is sent, so a bad row is written to the rejects file instead of
+#   failing on the server;
+# - documents go out in unordered batches of --batch-size, several batches
+#   in flight at once (--workers), so a duplicate _id only loses itself;
+# - after each batch the input offset is saved to a checkpoint file, and
+#   running the same command again resumes from there.
+import json
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import bson
+import click
+from bson import json_util
+from bson.codec_options import CodecOptions
+from bson.objectid import ObjectId
+from bson.raw_bson import RawBSONDocument
+from flask.cli import AppGroup, with_appcontext
+from pymongo import InsertOne, ReplaceOne
+from pymongo.errors import BulkWriteError
+
+collections = ("posts", "users")
+duplicate_key = 11000
+
+bson_types = {
+    "object": dict,
+    "array": list,
+    "string": str,
+    "objectId": ObjectId,
+    "date": datetime,
+    "bool": bool,
+    "int": int,
+    "long": int,
+    "double": float,
+}
+
+
+# Errors of `value` against the subset of $jsonSchema the app's schemas use
+def validate(value, schema, path="document"):
+    expected = schema.get("bsonType")
+    if expected is not None:
+        types = bson_types[expected]
+        # bool is an int in Python, not in BSON
+        if not isinstance(value, types) or (isinstance(value, bool) and expected != "bool"):
+            return [f"{path} must be {expected}"]
+    errors = []
+    if isinstance(value, dict):
+        errors += [f"{path}.{field} is required" for field in schema.get("required", ()) if field not in value]
+        for field, field_schema in schema.get("properties", {}).items():
+            if field in value:
+                errors += validate(value[field], field_schema, f"{path}.{field}")
+    return errors
+
+
+def dump_format(path, format):
+    if format:
+        return format
+    return "bson" if path.endswith(".bson") else "ndjson"
+
+
+# Yield (document or error, offset after it) from a dump, starting at `offset`
+def read_dump(f, format, offset=0):
+    f.seek(offset)
+    if format == "bson":
+        while True:
+            header = f.read(4)
+            if not header:
+                return
+            size = int.from_bytes(header, "little")
+            data = header + f.read(size - 4)
+            offset += size
+            try:
+                yield bson.decode(data), offset
+            except Exception as error:
+                yield ValueError(f"undecodable BSON: {error}"), offset
+        return
+    for line in iter(f.readline, b""):
+        offset += len(line)
+        if not line.strip():
+            continue
+        try:
+            yield json_util.loads(line), offset
+        except ValueError as error:
+            yield ValueError(f"invalid JSON: {error}"), offset
+
+
+def load_checkpoint(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_checkpoint(path, state):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+# Write one batch unordered, returning (written, duplicates, failed)
+def write_batch(collection, documents, mode):
+    if mode == "upsert":
+        requests = [ReplaceOne({"_id": document["_id"]}, document, upsert=True) if "_id" in document
+                    else InsertOne(document) for document in documents]
+    else:
+        requests = [InsertOne(document) for document in documents]
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as error:
+        details = error.details
+        duplicates = sum(1 for write_error in details["writeErrors"] if write_error["code"] == duplicate_key)
+        written = details["nInserted"] + details["nUpserted"] + details["nModified"]
+        return written, duplicates, len(details["writeErrors"]) - duplicates
+    return result.inserted_count + result.upserted_count + result.modified_count, 0, 0
+
+
+def import_dump(collection, schema, path, format="ndjson", batch_size=1000, workers=4, mode="insert",
+                checkpoint_path=None, rejects_path=None, restart=False, echo=print, progress=None):
+    checkpoint_path = checkpoint_path or f"{path}.checkpoint"
+    rejects_path = rejects_path or f"{path}.rejects"
+    state = None if restart else load_checkpoint(checkpoint_path)
+    if state is None or state.get("collection") != collection.name:
+        state = {"collection": collection.name, "offset": 0, "written": 0, "duplicates": 0,
+                 "failed": 0, "rejected": 0}
+    elif state["offset"]:
+        echo(f"Resuming {path} at byte {state['offset']}")
+
+    rejects = None
+    pending = deque()  # (future, offset after the batch, rows rejected before it), in input order
+
+    # Record finished batches in input order, so the checkpoint never passes
+    # a batch still in flight; waits while more than `keep` are pending
+    def commit(keep):
+        while pending and (pending[0][0].done() or len(pending) > keep):
+            future, offset, rejected = pending.popleft()
+            written, duplicates, failed = future.result()
+            state["written"] += written
+            state["duplicates"] += duplicates
+            state["failed"] += failed
+            state["rejected"] += rejected
+            state["offset"] = offset
+            save_checkpoint(checkpoint_path, state)
+            if progress is not None:
+                progress(state)
+
+    with open(path, "rb") as f, ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            batch, rejected, offset = [], 0, state["offset"]
+            for document, offset in read_dump(f, format, state["offset"]):
+                errors = [str(document)] if isinstance(document, Exception) else validate(document, schema)
+                if errors:
+                    if rejects is None:
+                        rejects = open(rejects_path, "a")
+                    row = None if isinstance(document, Exception) else json.loads(json_util.dumps(document))
+                    rejects.write(json.dumps({"offset": offset, "errors": errors, "document": row}) + "\n")
+                    rejected += 1
+                    continue
+                batch.append(document)
+                if len(batch) == batch_size:
+                    pending.append((executor.submit(write_batch, collection, batch, mode), offset, rejected))
+                    batch, rejected = [], 0
+                    # Bound the documents held in memory
+                    commit(keep=workers * 2)
+            if batch:
+                pending.append((executor.submit(write_batch, collection, batch, mode), offset, rejected))
+                rejected = 0
+            commit(keep=0)
+            state["rejected"] += rejected
+            state["offset"] = offset
+        finally:
+            if rejects is not None:
+                rejects.close()
+    save_checkpoint(checkpoint_path, state)
+    return state
+
+
+def export_dump(collection, path, format="ndjson", batch_size=1000):
+    count = 0
+    if format == "bson":
+        # Raw documents go straight to the file, nothing is decoded
+        raw = collection.with_options(codec_options=CodecOptions(document_class=RawBSONDocument))
+        with open(path, "wb") as f:
+            for document in raw.find({}, sort=[("_id", 1)], batch_size=batch_size):
+                f.write(document.raw)
+                count += 1
+        return count
+    with open(path, "w") as f:
+        for document in collection.find({}, sort=[("_id", 1)], batch_size=batch_size):
+            f.write(json_util.dumps(document, json_options=json_util.RELAXED_JSON_OPTIONS) + "\n")
+            count += 1
+    return count
+
+
+data_cli = AppGroup("data", help="Bulk import and export of posts and users.")
+
+
+@data_cli.command("export")
+@click.argument("collection", type=click.Choice(collections))
+@click.argument("path")
+@click.option("--format", type=click.Choice(("ndjson", "bson")), help="Default: by file extension.")
+@click.option("--batch-size", default=1000, show_default=True)
+@with_appcontext
+def export_command(collection, path, format, batch_size):
+    """Write every document of a collection to a dump file."""
+    from flaskblog import mongo
+    count = export_dump(mongo.db[collection], path, dump_format(path, format), batch_size)
+    click.echo(f"Exported {count} {collection} to {path}.")
+
+
+@data_cli.command("import")
+@click.argument("collection", type=click.Choice(collections))
+@click.argument("path")
+@click.option("--format", type=click.Choice(("ndjson", "bson")), help="Default: by file extension.")
+@click.option("--batch-size", default=1000, show_default=True)
+@click.option("--workers", default=4, show_default=True, help="Batches written concurrently.")
+@click.option("--mode", type=click.Choice(("insert", "upsert")), default="insert", show_default=True,
+              help="upsert replaces documents with the same _id instead of skipping them.")
+@click.option("--checkpoint", help="Default: PATH.checkpoint")
+@click.option("--rejects", help="Invalid rows are appended here. Default: PATH.rejects")
+@click.option("--restart", is_flag=True, help="Ignore the checkpoint and start from the beginning.")
+@with_appcontext
+def import_command(collection, path, format, batch_size, workers, mode, checkpoint, rejects, restart):
+    """Load a dump file into a collection, resuming from its checkpoint."""
+    from flaskblog import mongo, change_feed
+    from flaskblog.migrations import validators
+    state = import_dump(mongo.db[collection], validators()[collection], path, dump_format(path, format),
+                        batch_size, workers, mode, checkpoint, rejects, restart, echo=click.echo,
+                        progress=lambda state: click.echo(f"\r{state['written']} written", nl=False))
+    click.echo(f"\r{state['written']} written, {state['duplicates']} duplicate(s), {state['failed']} failed, "
+               f"{state['rejected']} rejected.{' ' * 20}")
+    if state["rejected"]:
+        click.echo(f"Rejected rows are in {rejects or path + '.rejects'}.")
+    if collection == "posts":
+        click.echo("Run `flask posts backfill-authors` and `flask posts backfill-summaries` "
+                   "if the posts carry no author snapshot or summary.")
+    # Running workers drop whatever they derived from the old data
+    change_feed.publish_reset()
@@ -0,0 +1,258 @@
+# Rendered-page cache with pluggable backends
+#
+# Entries are keyed by endpoint, request arguments, login variant and the
+# current "generation" of every tag the page depends on. Invalidating a tag
+# bumps its generation, so stale entries are simply never looked up again
+# and age out of the backend on their own.
+#
+# The same key doubles as a weak ETag: a client sending it back in
+# If-None-Match gets a 304 before the page is looked up or rendered. The
+# backend's epoch changes whenever its counters are lost, so a key is never
+# reused for different content.
+import hashlib
+import inspect
+import pickle
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from functools import wraps
+from flask import request, session, make_response
+from flask_login import current_user
+
+
+class MemoryBackend:
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._counters = {}
+        self._epoch = uuid.uuid4().hex
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def get_counters(self, keys):
+        with self._lock:
+            return [self._counters.get(key, 0) for key in keys]
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def epoch(self):
+        return self._epoch
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._counters.clear()
+            self._epoch = uuid.uuid4().hex
+
+
+# Redis (or any Redis-compatible local store) backend, so workers share one cache
+class RedisBackend:
+    def __init__(self, url, prefix="flaskblog:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return pickle.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.setex(self.prefix + key, ttl, pickle.dumps(value))
+
+    def get_counters(self, keys):
+        return [int(value or 0) for value in self.client.mget([self.prefix + key for key in keys])]
+
+    def incr(self, key):
+        return self.client.incr(self.prefix + key)
+
+    # Set once by whichever worker gets there first, gone with the counters
+    def epoch(self):
+        self.client.set(self.prefix + "epoch", uuid.uuid4().hex, nx=True)
+        return self.client.get(self.prefix + "epoch").decode("ascii")
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class ResponseCache:
+    def __init__(self):
+        self.backend = MemoryBackend()
+        self.ttl = 300
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get("RESPONSE_CACHE_ENABLED", True)
+        self.ttl = app.config.get("RESPONSE_CACHE_TTL", self.ttl)
+        if app.config.get("RESPONSE_CACHE_BACKEND", "memory") == "redis":
+            self.backend = RedisBackend(app.config["RESPONSE_CACHE_URL"])
+        else:
+            self.backend = MemoryBackend(app.config.get("RESPONSE_CACHE_SIZE", 512))
+
+    # Shared by every worker, invalidations need not be broadcast
+    @property
+    def shared(self):
+        return isinstance(self.backend, RedisBackend)
+
+    def generations(self, tags):
+        return self.backend.get_counters([f"gen:{tag}" for tag in tags])
+
+    # Invalidate every cached page depending on one of the tags
+    def invalidate(self, *tags):
+        for tag in tags:
+            self.backend.incr(f"gen:{tag}")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified}
+
+    # Pages carrying flashed messages are personal, never cache them
+    def _cacheable(self):
+        return self.enabled and request.method == "GET" and not session.get("_flashes")
+
+    # Version of a page: everything its content depends on
+    def _version(self, view_tags, kwargs, query_args, headers=()):
+        variant = "auth" if current_user.is_authenticated else "anon"
+        parts = [self.backend.epoch(), request.endpoint, variant]
+        parts += [f"{name}={value}" for name, value in sorted(kwargs.items())]
+        parts += [f"{name}={request.args.get(name, '')}" for name in query_args]
+        parts += [f"{name}:{request.headers.get(name, '')}" for name in headers]
+        parts += [f"{tag}@{gen}" for tag, gen in zip(view_tags, self.generations(view_tags))]
+        return hashlib.sha1("|".join(parts).encode("utf-8")).hexdigest()
+
+    def _validate(self, response, version, headers=()):
+        response.set_etag(version, weak=True)
+        response.headers["Cache-Control"] = "no-cache"
+        response.vary.add("Cookie")
+        for name in headers:
+            response.vary.add(name)
+        return response
+
+    # 304 for a client that already holds this version
+    def _not_modified(self, version, headers=()):
+        if request.if_none_match.contains_weak(version):
+            self.not_modified += 1
+            return self._validate(make_response("", 304), version, headers)
+        return None
+
+    # Store a freshly rendered page, returns None when it can't be cached
+    def _store(self, version, response):
+        if response.status_code != 200 or response.direct_passthrough:
+            return None
+        entry = {
+            "body": response.get_data(),
+            "mimetype": response.mimetype,
+            "last_modified": datetime.now(timezone.utc).replace(microsecond=0),
+        }
+        self.backend.set(f"page:{version}", entry, self.ttl)
+        return entry
+
+    def _respond(self, entry, version, response=None):
+        if response is None:
+            response = make_response(entry["body"])
+            response.mimetype = entry["mimetype"]
+        response.last_modified = entry["last_modified"]
+        return self._validate(response, version).make_conditional(request)
+
+    # Cache a GET view (plain or coroutine). `query_args` are the request
+    # arguments the page depends on and `tags` maps the view arguments to
+    # the tags to watch.
+    def cached(self, tags, query_args=()):
+        def lookup(kwargs):
+            version = self._version(tags(**kwargs), kwargs, query_args)
+            response = self._not_modified(version)
+            if response is not None:
+                return version, response
+            entry = self.backend.get(f"page:{version}")
+            if entry is not None:
+                self.hits += 1
+                return version, self._respond(entry, version)
+            self.misses += 1
+            return version, None
+
+        def store(version, response):
+            entry = self._store(version, response)
+            return response if entry is None else self._respond(entry, version, response)
+
+        def decorator(view):
+            if inspect.iscoroutinefunction(view):
+                @wraps(view)
+                async def async_wrapper(**kwargs):
+                    if not self._cacheable():
+                        return await view(**kwargs)
+                    version, response = lookup(kwargs)
+                    if response is not None:
+                        return response
+                    return store(version, make_response(await view(**kwargs)))
+                return async_wrapper
+
+            @wraps(view)
+            def wrapper(**kwargs):
+                if not self._cacheable():
+                    return view(**kwargs)
+                version, response = lookup(kwargs)
+                if response is not None:
+                    return response
+                return store(version, make_response(view(**kwargs)))
+            return wrapper
+        return decorator
+
+    # Weak ETags and early 304s for a GET view whose body is not cached,
+    # such as the streamed API exports. `headers` are request headers the
+    # response is negotiated on (added to Vary).
+    def conditional(self, tags, query_args=(), headers=()):
+        def validate(kwargs):
+            version = self._version(tags(**kwargs), kwargs, query_args, headers)
+            return version, self._not_modified(version, headers)
+
+        def finish(version, response):
+            if response.status_code == 200:
+                self._validate(response, version, headers)
+            return response
+
+        def decorator(view):
+            if inspect.iscoroutinefunction(view):
+                @wraps(view)
+                async def async_wrapper(**kwargs):
+                    if not self._cacheable():
+                        return await view(**kwargs)
+                    version, response = validate(kwargs)
+                    if response is not None:
+                        return response
+                    return finish(version, make_response(await view(**kwargs)))
+                return async_wrapper
+
+            @wraps(view)
+            def wrapper(**kwargs):
+                if not self._cacheable():
+                    return view(**kwargs)
+                version, response = validate(kwargs)
+                if response is not None:
+                    return response
+                return finish(version, make_response(view(**kwargs)))
+            return wrapper
+        return decorator
@@ -0,0 +1,173 @@
+# Response compression
+#
+# An after_request hook compresses text responses (pages, JSON, NDJSON
+# exports) with the best encoding both sides support: zstd and brotli when
+# their packages are installed, gzip always. Buffered bodies are compressed
+# in one go once they pass COMPRESS_MIN_SIZE; streamed bodies, including the
+# async exports, are compressed chunk by chunk with a flush after each one so
+# the client keeps receiving rows as they are read. Compressed responses keep
+# their validators but as weak ETags, since the bytes now differ per encoding.
+import zlib
+from flask import request
+from werkzeug.wsgi import ClosingIterator
+from flaskblog.asgi import AsyncStreamResponse
+
+compressible_mimetypes = {
+    "text/html", "text/css", "text/plain", "text/javascript", "application/javascript",
+    "application/json", "application/x-ndjson", "image/svg+xml",
+}
+
+
+class GzipEncoder:
+    name = "gzip"
+
+    @staticmethod
+    def available():
+        return True
+
+    def __init__(self):
+        self._compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+class BrotliEncoder:
+    name = "br"
+
+    @staticmethod
+    def available():
+        try:
+            import brotli
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        import brotli
+        # Quality 5 is the usual trade-off for content compressed per request
+        self._compressor = brotli.Compressor(quality=5)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.flush()
+
+    def finish(self):
+        return self._compressor.finish()
+
+
+class ZstdEncoder:
+    name = "zstd"
+
+    @staticmethod
+    def available():
+        try:
+            import zstandard
+        except ImportError:
+            return False
+        return True
+
+    def __init__(self):
+        import zstandard
+        self._flush_block = zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        self._compressor = zstandard.ZstdCompressor(level=3).compressobj()
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def flush(self):
+        return self._compressor.flush(self._flush_block)
+
+    def finish(self):
+        return self._compressor.flush()
+
+
+encoders = {encoder.name: encoder for encoder in (ZstdEncoder, BrotliEncoder, GzipEncoder)}
+
+
+def _as_bytes(chunk):
+    return chunk.encode("utf-8") if isinstance(chunk, str) else chunk
+
+
+def compress_stream(encoder, chunks):
+    for chunk in chunks:
+        if chunk:
+            data = encoder.compress(_as_bytes(chunk)) + encoder.flush()
+            if data:
+                yield data
+    yield encoder.finish()
+
+
+async def compress_stream_async(encoder, chunks):
+    async for chunk in chunks:
+        if chunk:
+            data = encoder.compress(_as_bytes(chunk)) + encoder.flush()
+            if data:
+                yield data
+    yield encoder.finish()
+
+
+class Compression:
+    def __init__(self):
+        self.algorithms = ["gzip"]
+        self.min_size = 500
+
+    def init_app(self, app):
+        names = [name.strip() for name in app.config.get("COMPRESS_ALGORITHMS", "zstd,br,gzip").split(",")]
+        # Server preference order, limited to what is installed
+        self.algorithms = [name for name in names if name in encoders and encoders[name].available()]
+        self.min_size = app.config.get("COMPRESS_MIN_SIZE", self.min_size)
+        if self.algorithms:
+            app.after_request(self.compress)
+
+    # Highest q-value wins, ties go to the server's preference
+    def negotiate(self):
+        accepted = request.accept_encodings
+        best = None
+        for name in self.algorithms:
+            quality = accepted[name]
+            if quality > 0 and (best is None or quality > best[1]):
+                best = (name, quality)
+        return best[0] if best else None
+
+    def _eligible(self, response):
+        return (request.method != "HEAD"
+                and 200 <= response.status_code < 300 and response.status_code not in (204, 206)
+                and response.mimetype in compressible_mimetypes
+                and "Content-Encoding" not in response.headers
+                and not response.cache_control.no_transform
+                and not response.direct_passthrough)
+
+    def compress(self, response):
+        if not self._eligible(response):
+            return response
+        streamed = isinstance(response, AsyncStreamResponse) or response.is_streamed
+        if not streamed and len(response.get_data()) < self.min_size:
+            return response
+        response.vary.add("Accept-Encoding")
+        name = self.negotiate()
+        if name is None:
+            return response
+        encoder = encoders[name]()
+        if isinstance(response, AsyncStreamResponse):
+            response.async_body = compress_stream_async(encoder, response.async_body)
+        elif streamed:
+            # Closing the wrapper must still close the original body (and its request context)
+            chunks = response.response
+            response.response = ClosingIterator(compress_stream(encoder, chunks), getattr(chunks, "close", None))
+            response.headers.pop("Content-Length", None)
+        else:
+            response.set_data(encoder.compress(response.get_data()) + encoder.finish())
+        response.content_encoding = name
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
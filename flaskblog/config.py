@@ -5,6 +5,123 @@ class Config:
     MONGO_URI = os.getenv("MONGO_URI")
     MAIL_SERVER = os.getenv("MAIL_SERVER")
     MAIL_PORT = int(os.getenv("MAIL_PORT"))
-    MAIL_USE_TLS = True
+    MAIL_USE_TLS = os.getenv("MAIL_USE_TLS", "true").lower() == "true"
     MAIL_USERNAME = os.getenv("MAIL_USERNAME")
-    MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
\ No newline at end of file
+    MAIL_PASSWORD = os.getenv("MAIL_PASSWORD")
+
+    # Feed pagination
+    POSTS_PER_PAGE = int(os.getenv("POSTS_PER_PAGE", 4))
+    FEED_COUNT_TTL = int(os.getenv("FEED_COUNT_TTL", 60))
+
+    # Post rendering (see flaskblog/summaries.py): "markdown" needs the
+    # markdown package and falls back to plain paragraphs, "text" always uses them
+    POST_FORMAT = os.getenv("POST_FORMAT", "markdown")
+    # Characters of the excerpts on the feed cards
+    POST_EXCERPT_LENGTH = int(os.getenv("POST_EXCERPT_LENGTH", 300))
+    POST_WORDS_PER_MINUTE = int(os.getenv("POST_WORDS_PER_MINUTE", 200))
+
+    # "embedded" reads the author snapshot stored on posts, "lookup" joins authors
+    # with $lookup and "batch" resolves them with one $in query per page
+    AUTHOR_RESOLUTION = os.getenv("AUTHOR_RESOLUTION", "embedded")
+    FANOUT_BATCH_SIZE = int(os.getenv("FANOUT_BATCH_SIZE", 500))
+    FANOUT_LEASE = int(os.getenv("FANOUT_LEASE", 300))
+
+    # User profile cache
+    PROFILE_CACHE_SIZE = int(os.getenv("PROFILE_CACHE_SIZE", 1024))
+    PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 300))
+
+    # Server-side sessions (see flaskblog/sessions.py): "sqlite" (shared by the
+    # workers of one host, in the instance folder unless SESSION_SQLITE_PATH
+    # is set), "memory" (one process) or "cookie" (Flask's signed cookie)
+    SESSION_BACKEND = os.getenv("SESSION_BACKEND", "sqlite")
+    SESSION_SQLITE_PATH = os.getenv("SESSION_SQLITE_PATH", "")
+    # Seconds a session's user snapshot is trusted without reading the profile
+    SESSION_USER_TTL = int(os.getenv("SESSION_USER_TTL", 300))
+
+    # Rendered-page cache ("memory" or "redis")
+    RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "true").lower() == "true"
+    RESPONSE_CACHE_BACKEND = os.getenv("RESPONSE_CACHE_BACKEND", "memory")
+    RESPONSE_CACHE_URL = os.getenv("RESPONSE_CACHE_URL", "redis://localhost:6379/0")
+    RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))
+    RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 512))
+
+    # Response compression: encodings in order of preference (zstd and br are
+    # used when their packages are installed) and the smallest body to compress
+    COMPRESS_ALGORITHMS = os.getenv("COMPRESS_ALGORITHMS", "zstd,br,gzip")
+    COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 500))
+
+    # Background mail delivery
+    MAIL_QUEUE_ENABLED = os.getenv("MAIL_QUEUE_ENABLED", "true").lower() == "true"
+    MAIL_QUEUE_SIZE = int(os.getenv("MAIL_QUEUE_SIZE", 100))
+    MAIL_QUEUE_WORKERS = int(os.getenv("MAIL_QUEUE_WORKERS", 2))
+    MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 5))
+    MAIL_RETRY_BACKOFF = int(os.getenv("MAIL_RETRY_BACKOFF", 30))
+
+    # Password hashing: bcrypt cost (see `flask passwords calibrate`), worker
+    # processes and how many hashes may be in flight before answering 503
+    BCRYPT_LOG_ROUNDS = int(os.getenv("BCRYPT_LOG_ROUNDS", 12))
+    PASSWORD_WORKERS = int(os.getenv("PASSWORD_WORKERS", 2))
+    PASSWORD_QUEUE_SIZE = int(os.getenv("PASSWORD_QUEUE_SIZE", 16))
+    PASSWORD_RETRY_AFTER = int(os.getenv("PASSWORD_RETRY_AFTER", 2))
+
+    # Rate limits of the write paths, per client IP, account and endpoint (see
+    # flaskblog/ratelimit.py). "memory" limits each process, "redis" all nodes.
+    RATELIMIT_ENABLED = os.getenv("RATELIMIT_ENABLED", "true").lower() == "true"
+    RATELIMIT_BACKEND = os.getenv("RATELIMIT_BACKEND", "memory")
+    RATELIMIT_URL = os.getenv("RATELIMIT_URL", "redis://localhost:6379/0")
+    RATELIMIT_RULES = {
+        "users.login": os.getenv("RATELIMIT_LOGIN", "ip=20/minute;account=5/minute;endpoint=600/minute"),
+        "users.register": os.getenv("RATELIMIT_REGISTER", "ip=5/hour;endpoint=120/minute"),
+        "users.request_reset": os.getenv("RATELIMIT_RESET", "ip=5/hour;account=3/hour;endpoint=60/minute"),
+        "posts.add_post": os.getenv("RATELIMIT_ADD_POST", "ip=30/minute;account=10/minute;endpoint=600/minute"),
+    }
+
+    # Profile picture processing
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", 2))
+    IMAGE_WAIT_TIMEOUT = int(os.getenv("IMAGE_WAIT_TIMEOUT", 10))
+
+    # Search ("mongo" text index or in-process "memory" inverted index)
+    SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "mongo")
+    SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 10))
+
+    # Change feed keeping every worker's caches fresh (see flaskblog/events.py):
+    # "auto" tails change streams on a replica set and polls the capped events
+    # collection on a standalone server; "changestream" or "poll" forces one
+    EVENTS_ENABLED = os.getenv("EVENTS_ENABLED", "true").lower() == "true"
+    EVENTS_SOURCE = os.getenv("EVENTS_SOURCE", "auto")
+    EVENTS_POLL_INTERVAL = float(os.getenv("EVENTS_POLL_INTERVAL", 1.0))
+    # Seconds between keep-alive comments on the new-post stream
+    EVENTS_KEEPALIVE = int(os.getenv("EVENTS_KEEPALIVE", 15))
+    # How long a worker waits for the change-stream echo of its own write
+    EVENTS_ECHO_WINDOW = float(os.getenv("EVENTS_ECHO_WINDOW", 5))
+
+    # Cache lifetime of fingerprinted static files (see `flask assets build`)
+    ASSETS_MAX_AGE = int(os.getenv("ASSETS_MAX_AGE", 31536000))
+
+    # Instrumentation
+    METRICS_SERVER_TIMING = os.getenv("METRICS_SERVER_TIMING", "false").lower() == "true"
+    METRICS_LOG_REQUESTS = os.getenv("METRICS_LOG_REQUESTS", "false").lower() == "true"
+    # /api/diagnostics exposes internals (pool addresses, outbox, limiter
+    # counters); it is a 404 unless turned on, e.g. on a private network
+    DIAGNOSTICS_ENABLED = os.getenv("DIAGNOSTICS_ENABLED", "false").lower() == "true"
+
+    # MongoDB connection pool
+    MONGO_MAX_POOL_SIZE = int(os.getenv("MONGO_MAX_POOL_SIZE", 100))
+    MONGO_MIN_POOL_SIZE = int(os.getenv("MONGO_MIN_POOL_SIZE", 0))
+    MONGO_WAIT_QUEUE_TIMEOUT_MS = int(os.getenv("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000))
+    MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000))
+    MONGO_CONNECT_TIMEOUT_MS = int(os.getenv("MONGO_CONNECT_TIMEOUT_MS", 5000))
+    # Wire compression, e.g. "zstd,snappy,zlib" (zstd and snappy need their python packages)
+    MONGO_COMPRESSORS = os.getenv("MONGO_COMPRESSORS", "")
+
+    # Read routing for the read-heavy endpoints. "secondaryPreferred" spreads
+    # them over a replica set; the default "primary" keeps read-your-writes
+    # (a page cached from a lagging secondary stays stale until invalidated)
+    MONGO_READ_PREFERENCE = os.getenv("MONGO_READ_PREFERENCE", "primary")
+    MONGO_READ_CONCERN = os.getenv("MONGO_READ_CONCERN", "")
+    MONGO_MAX_STALENESS_SECONDS = int(os.getenv("MONGO_MAX_STALENESS_SECONDS", -1))
+    MONGO_READ_ROUTES = dict.fromkeys(
+        ("main.home", "posts.post", "posts.get_all_posts", "users.get_all_users", "users.get_user_posts",
+         "search.search", "search.search_api"),
+        MONGO_READ_PREFERENCE,
+    )
@@ -0,0 +1,206 @@
+# Database access layer around Flask-PyMongo
+#
+# Builds the MongoClient from config (pool size, timeouts, compression) and
+# routes reads: `database.db` is the blog database with the read preference
+# and read concern configured for the current endpoint, so read-heavy routes
+# can be sent to secondaries while writes keep using the primary. A pool
+# listener keeps connection pool statistics for the diagnostics.
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from flask import has_request_context, request
+from pymongo import monitoring
+from pymongo.read_concern import ReadConcern
+from pymongo.read_preferences import (Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred)
+
+read_preferences = {
+    "primary": Primary,
+    "primaryPreferred": PrimaryPreferred,
+    "secondary": Secondary,
+    "secondaryPreferred": SecondaryPreferred,
+    "nearest": Nearest,
+}
+
+
+def parse_read_preference(name, max_staleness=-1):
+    if name not in read_preferences:
+        raise ValueError(f"Unknown read preference {name!r}, expected one of {', '.join(read_preferences)}")
+    if name == "primary":
+        return Primary()
+    return read_preferences[name](max_staleness=max_staleness)
+
+
+# MongoClient keyword arguments from the MONGO_* settings
+def client_options(config):
+    options = {
+        "maxPoolSize": config.get("MONGO_MAX_POOL_SIZE", 100),
+        "minPoolSize": config.get("MONGO_MIN_POOL_SIZE", 0),
+        "maxIdleTimeMS": config.get("MONGO_MAX_IDLE_TIME_MS"),
+        "waitQueueTimeoutMS": config.get("MONGO_WAIT_QUEUE_TIMEOUT_MS"),
+        "serverSelectionTimeoutMS": config.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000),
+        "connectTimeoutMS": config.get("MONGO_CONNECT_TIMEOUT_MS", 20000),
+    }
+    if config.get("MONGO_COMPRESSORS"):
+        options["compressors"] = config["MONGO_COMPRESSORS"]
+    return {name: value for name, value in options.items() if value is not None}
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pools = {}
+
+    def _pool(self, address):
+        key = f"{address[0]}:{address[1]}"
+        if key not in self._pools:
+            self._pools[key] = {"open": 0, "checked_out": 0, "created": 0, "closed": 0,
+                                "checkouts": 0, "checkout_failures": 0, "cleared": 0}
+        return self._pools[key]
+
+    def _update(self, address, **changes):
+        with self._lock:
+            pool = self._pool(address)
+            for name, delta in changes.items():
+                pool[name] += delta
+
+    def pool_created(self, event):
+        self._update(event.address)
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self._update(event.address, cleared=1)
+
+    def pool_closed(self, event):
+        with self._lock:
+            self._pools.pop(f"{event.address[0]}:{event.address[1]}", None)
+
+    def connection_created(self, event):
+        self._update(event.address, created=1, open=1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._update(event.address, closed=1, open=-1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._update(event.address, checkout_failures=1)
+
+    def connection_checked_out(self, event):
+        self._update(event.address, checkouts=1, checked_out=1)
+
+    def connection_checked_in(self, event):
+        self._update(event.address, checked_out=-1)
+
+    def stats(self):
+        with self._lock:
+            return {address: dict(pool) for address, pool in self._pools.items()}
+
+    def clear(self):
+        with self._lock:
+            self._pools.clear()
+
+    # Totals across servers, for the metrics gauges
+    def totals(self):
+        totals = {}
+        for pool in self.stats().values():
+            for name, value in pool.items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+
+class Database:
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.pool_stats = PoolStats()
+        self.options = {}
+        self.route_options = {}
+        self.default_read_concern = None
+        self.event_listeners = []
+
+    def init_app(self, app, event_listeners=()):
+        self.configure(app.config)
+        self.event_listeners = [self.pool_stats, *event_listeners]
+        self.mongo.init_app(app, event_listeners=self.event_listeners, **self.options)
+
+    # A client inherited from the parent process must not be used after a
+    # fork (its sockets and monitor threads belong to the parent): give the
+    # child a client of its own
+    def reinit(self, app):
+        self.pool_stats.clear()
+        self.mongo.init_app(app, event_listeners=self.event_listeners, **self.options)
+
+    # Open up to `count` pooled connections before serving, so the first
+    # requests don't pay for server selection and handshakes
+    def prefill(self, count):
+        count = min(count, self.options.get("maxPoolSize", 100) or count)
+        if count < 1:
+            return
+        with ThreadPoolExecutor(max_workers=count) as executor:
+            list(executor.map(lambda _: self.mongo.cx.admin.command("ping"), range(count)))
+
+    def configure(self, config):
+        self.options = client_options(config)
+        # Per-endpoint read routing, e.g. {"main.home": "secondaryPreferred"}
+        max_staleness = config.get("MONGO_MAX_STALENESS_SECONDS", -1)
+        read_concern = config.get("MONGO_READ_CONCERN")
+        self.default_read_concern = ReadConcern(read_concern) if read_concern else None
+        self.route_options = {}
+        for endpoint, mode in config.get("MONGO_READ_ROUTES", {}).items():
+            self.route_options[endpoint] = {
+                "read_preference": parse_read_preference(mode, max_staleness),
+                "read_concern": self.default_read_concern,
+            }
+
+    # Apply the read options configured for the current endpoint
+    def route(self, db):
+        if has_request_context():
+            options = self.route_options.get(request.endpoint)
+            if options is not None:
+                return db.with_options(**options)
+        if self.default_read_concern is not None:
+            return db.with_options(read_concern=self.default_read_concern)
+        return db
+
+    @property
+    def db(self):
+        return self.route(self.mongo.db)
+
+    def stats(self):
+        return {
+            "pools": self.pool_stats.stats(),
+            "routes": {endpoint: options["read_preference"].mongos_mode
+                       for endpoint, options in self.route_options.items()},
+        }
+
+
+# The same database through pymongo's asyncio client (pymongo >= 4.9), for
+# the ASGI entry point. The client is created on first use, inside the
+# server's event loop.
+class AsyncDatabase(Database):
+    def __init__(self, mongo):
+        super().__init__(mongo)
+        self.app = None
+        self.client = None
+
+    def init_app(self, app, event_listeners=()):
+        self.app = app
+        self.configure(app.config)
+        self.event_listeners = [self.pool_stats, *event_listeners]
+
+    @property
+    def db(self):
+        if self.client is None:
+            from pymongo import AsyncMongoClient
+            self.client = AsyncMongoClient(self.app.config["MONGO_URI"], event_listeners=self.event_listeners,
+                                           **self.options)
+        return self.route(self.client.get_default_database())
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
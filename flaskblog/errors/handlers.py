@@ -12,4 +12,15 @@ def error_403(error):
 
 @errors_blueprint.app_errorhandler(500)
 def error_500(error):
-    return render_template("errors/500.html"), 500
\ No newline at end of file
+    return render_template("errors/500.html"), 500
+
+@errors_blueprint.app_errorhandler(429)
+def error_429(error):
+    headers = [(name, value) for name, value in error.get_headers() if name == "Retry-After"]
+    return render_template("errors/429.html", message=error.description), 429, headers
+
+# Raised when a bounded worker pool is saturated, e.g. password hashing
+@errors_blueprint.app_errorhandler(503)
+def error_503(error):
+    headers = [(name, value) for name, value in error.get_headers() if name == "Retry-After"]
+    return render_template("errors/503.html", message=error.description), 503, headers
@@ -0,0 +1,337 @@
+# Change events
+#
+# Each worker process keeps state derived from posts and users: the profile
+# cache, the in-memory page cache and the in-memory search index. A
+# background thread in every worker follows the writes of all workers and
+# drops what they make stale:
+#
+# - on a replica set or sharded cluster it tails a MongoDB change stream on
+#   posts and users, resuming from the last token after an error;
+# - on a standalone server, which has no change streams, writers also record
+#   each change in the capped `events` collection, polled every
+#   EVENTS_POLL_INTERVAL seconds.
+#
+# Writers apply their own changes immediately, so they read their own writes
+# without waiting for the feed, and skip them when they come back: polled
+# records carry the writer's origin; a change stream can't, so each worker
+# remembers what it published for EVENTS_ECHO_WINDOW seconds and drops one
+# matching change (same collection, operation and _id) per publish. The same
+# feed pushes new posts to open home pages over Server-Sent Events.
+import asyncio
+import json
+import logging
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from bson.objectid import ObjectId
+from pymongo.errors import OperationFailure, PyMongoError
+
+logger = logging.getLogger(__name__)
+
+watched = ("posts", "users")
+# Fields of a change recorded in the events collection (no content, no passwords)
+recorded_fields = {"posts": ("title", "author", "date_posted", "author_details"), "users": ()}
+# How far back each poll looks, covering clock skew between app hosts and
+# writes that commit out of order
+poll_overlap = timedelta(seconds=5)
+
+
+# What every worker drops when a post or user changes
+def invalidate_caches(event):
+    from flaskblog import profile_cache, response_cache, search_service
+    if event["op"] == "reset":
+        # Events may have been missed, forget everything derived from them
+        profile_cache.clear()
+        response_cache.invalidate("feed", "users")
+        search_service.reset()
+        return
+    # A shared page cache was already invalidated by the writer
+    invalidate_pages = not (event.get("remote") and response_cache.shared)
+    if event["coll"] == "users":
+        profile_cache.invalidate(event["id"])
+        if invalidate_pages:
+            response_cache.invalidate("users")
+        return
+    if invalidate_pages:
+        response_cache.invalidate("feed", f"post:{event['id']}")
+    doc = event.get("doc") or {}
+    if event["op"] == "delete":
+        search_service.remove_post(event["id"])
+    elif "title" in doc and "content" in doc:
+        search_service.index_post({"_id": event["id"], "title": doc["title"], "content": doc["content"]})
+    elif {"title", "content"} & set(event.get("fields", ())):
+        search_service.refresh_post(event["id"])
+
+
+def _format_sse(event, urls):
+    doc = event.get("doc") or {}
+    data = {
+        "id": str(event["id"]),
+        "title": doc.get("title"),
+        "author": (doc.get("author_details") or {}).get("username"),
+        "url": urls.build("posts.post", {"post_id": str(event["id"])}),
+    }
+    return f"event: post\ndata: {json.dumps(data)}\n\n"
+
+
+class ChangeFeed:
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.app = None
+        self.enabled = True
+        self.source = "auto"
+        self.poll_interval = 1.0
+        self.keepalive = 15
+        self.echo_window = 5
+        self.handlers = []
+        self.published = 0
+        self.received = 0
+        self.errors = 0
+        self.origin = None
+        self._mode = None
+        self._pid = None
+        self._subscribers = set()
+        self._echoes = {}
+        self._echo_lock = threading.Lock()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("EVENTS_ENABLED", True)
+        self.source = app.config.get("EVENTS_SOURCE", self.source)
+        self.poll_interval = app.config.get("EVENTS_POLL_INTERVAL", self.poll_interval)
+        self.keepalive = app.config.get("EVENTS_KEEPALIVE", self.keepalive)
+        self.echo_window = app.config.get("EVENTS_ECHO_WINDOW", self.echo_window)
+        if self.enabled:
+            app.before_request(self.start)
+
+    # Run `handler(event)` for every change, local or from another worker
+    def on_change(self, handler):
+        self.handlers.append(handler)
+
+    # "changestream" or "poll", decided once per process
+    @property
+    def mode(self):
+        if self._mode is None:
+            if self.source != "auto":
+                self._mode = self.source
+            else:
+                try:
+                    hello = self.mongo.db.command("hello")
+                except PyMongoError:
+                    # Unreachable for now: start() retries on the next request
+                    raise
+                except Exception:
+                    # A server (or stand-in) that can't answer hello has no change streams
+                    logger.warning("Could not probe for change streams, polling instead", exc_info=True)
+                    hello = {}
+                replicated = "setName" in hello or hello.get("msg") == "isdbgrid"
+                self._mode = "changestream" if replicated else "poll"
+        return self._mode
+
+    # One watcher thread per process, so forked workers start their own
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            try:
+                target = self._watch if self.mode == "changestream" else self._poll
+            except PyMongoError:
+                logger.warning("Could not start the change feed, retrying on the next request", exc_info=True)
+                return
+            self._pid = os.getpid()
+            self.origin = uuid.uuid4().hex
+            threading.Thread(target=target, name="change-feed", daemon=True).start()
+
+    # Announce a write: `document` holds the _id and the fields written
+    def publish(self, collection, operation, document):
+        event = {"coll": collection, "op": operation, "id": ObjectId(document["_id"]),
+                 "fields": [field for field in document if field != "_id"], "doc": document}
+        self._dispatch(event)
+        self.published += 1
+        if not self.enabled:
+            return
+        record = {key: event[key] for key in ("coll", "op", "id", "fields")}
+        record["doc"] = {field: document[field] for field in recorded_fields[collection] if field in document}
+        record["origin"] = self.origin
+        try:
+            if self.mode == "poll":
+                self.mongo.db.events.insert_one(record)
+            else:
+                self._expect_echo(event)
+        except PyMongoError:
+            self.errors += 1
+            logger.exception("Could not record %s %s event", collection, operation)
+
+    # Tell every worker to drop what it derived from posts and users, e.g.
+    # after a bulk import
+    def publish_reset(self):
+        self._dispatch({"coll": None, "op": "reset"})
+        if not self.enabled:
+            return
+        try:
+            if self.mode == "poll":
+                self.mongo.db.events.insert_one({"coll": None, "op": "reset", "id": None, "fields": [], "doc": {},
+                                                 "origin": self.origin})
+        except PyMongoError:
+            self.errors += 1
+            logger.exception("Could not record a reset event")
+
+    def _dispatch(self, event):
+        for handler in self.handlers:
+            try:
+                handler(event)
+            except Exception:
+                logger.exception("Change handler failed for %s %s", event["coll"], event["op"])
+
+    def _echo_key(self, event):
+        return event["coll"], event["op"], event["id"]
+
+    # Remember a local write whose change-stream event is still to come
+    def _expect_echo(self, event):
+        now = time.monotonic()
+        with self._echo_lock:
+            if len(self._echoes) > 10000:
+                self._echoes = {key: expiries for key, expiries in self._echoes.items() if expiries[-1] > now}
+            self._echoes.setdefault(self._echo_key(event), []).append(now + self.echo_window)
+
+    # Whether a change-stream event is one of our own writes (consuming it)
+    def _is_echo(self, event):
+        key = self._echo_key(event)
+        now = time.monotonic()
+        with self._echo_lock:
+            expiries = [expiry for expiry in self._echoes.get(key, ()) if expiry > now]
+            echo = bool(expiries)
+            if expiries[1:]:
+                self._echoes[key] = expiries[1:]
+            else:
+                self._echoes.pop(key, None)
+        return echo
+
+    def _receive(self, event, origin=None):
+        self.received += 1
+        event["remote"] = True
+        # Our own writes were applied when they were published
+        local = origin == self.origin if origin is not None else self._is_echo(event)
+        if not local:
+            self._dispatch(event)
+        if event["coll"] == "posts" and event["op"] == "insert":
+            for deliver in list(self._subscribers):
+                deliver(event)
+
+    def _watch(self):
+        pipeline = [{"$match": {"ns.coll": {"$in": list(watched)},
+                                "operationType": {"$in": ["insert", "update", "replace", "delete"]}}}]
+        token = None
+        with self.app.app_context():
+            while True:
+                try:
+                    with self.mongo.db.watch(pipeline, resume_after=token) as stream:
+                        for change in stream:
+                            token = stream.resume_token
+                            self._receive(self._from_change(change))
+                except OperationFailure:
+                    # e.g. the resume token fell off the oplog: start over
+                    self.errors += 1
+                    logger.exception("Change stream failed, restarting it")
+                    token = None
+                    self._dispatch({"coll": None, "op": "reset"})
+                    time.sleep(self.poll_interval)
+                except PyMongoError:
+                    self.errors += 1
+                    logger.warning("Change stream interrupted, resuming", exc_info=True)
+                    time.sleep(self.poll_interval)
+
+    @staticmethod
+    def _from_change(change):
+        event = {"coll": change["ns"]["coll"], "id": change["documentKey"]["_id"],
+                 "op": "update" if change["operationType"] == "replace" else change["operationType"]}
+        if change.get("fullDocument"):
+            event["doc"] = change["fullDocument"]
+            event["fields"] = list(change["fullDocument"])
+        if "updateDescription" in change:
+            description = change["updateDescription"]
+            event["fields"] = list(description.get("updatedFields", {})) + description.get("removedFields", [])
+        return event
+
+    def _poll(self):
+        seen = {}
+        since = datetime.now(timezone.utc)
+        failed = False
+        with self.app.app_context():
+            while True:
+                started = datetime.now(timezone.utc)
+                try:
+                    floor = ObjectId.from_datetime(since - poll_overlap)
+                    for record in self.mongo.db.events.find({"_id": {"$gt": floor}}).sort("_id", 1):
+                        if record["_id"] not in seen:
+                            seen[record["_id"]] = started
+                            self._receive(record, record.get("origin"))
+                except PyMongoError:
+                    self.errors += 1
+                    failed = True
+                    logger.warning("Polling the events collection failed", exc_info=True)
+                else:
+                    if failed:
+                        # Records may have been capped away while Mongo was unreachable
+                        self._dispatch({"coll": None, "op": "reset"})
+                        failed = False
+                    since = started
+                    for event_id in [event_id for event_id, at in seen.items() if at < since - poll_overlap * 2]:
+                        del seen[event_id]
+                time.sleep(self.poll_interval)
+
+    # Server-Sent Events of new posts. `urls` is a URL adapter bound to the
+    # request, the streams outlive its context.
+    def stream(self, urls):
+        events = queue.Queue(maxsize=100)
+
+        def deliver(event):
+            try:
+                events.put_nowait(event)
+            except queue.Full:  # a client that stopped reading
+                pass
+
+        self._subscribers.add(deliver)
+        try:
+            yield f"retry: {self.keepalive * 1000}\n\n"
+            while True:
+                try:
+                    event = events.get(timeout=self.keepalive)
+                except queue.Empty:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format_sse(event, urls)
+        finally:
+            self._subscribers.discard(deliver)
+
+    async def stream_async(self, urls):
+        loop = asyncio.get_running_loop()
+        events = asyncio.Queue(maxsize=100)
+
+        def put(event):
+            if not events.full():
+                events.put_nowait(event)
+
+        def deliver(event):
+            loop.call_soon_threadsafe(put, event)
+
+        self._subscribers.add(deliver)
+        try:
+            yield f"retry: {self.keepalive * 1000}\n\n"
+            while True:
+                try:
+                    event = await asyncio.wait_for(events.get(), self.keepalive)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _format_sse(event, urls)
+        finally:
+            self._subscribers.discard(deliver)
+
+    def stats(self):
+        return {"mode": self._mode, "published": self.published, "received": self.received,
+                "errors": self.errors, "subscribers": len(self._subscribers)}
@@ -0,0 +1,159 @@
+# Streaming JSON / NDJSON exports for the /api listing endpoints
+from flask import Response, abort, current_app, request, stream_with_context, url_for
+from flaskblog.pagination import encode_id_cursor, decode_id_cursor
+from flaskblog.asgi import AsyncStreamResponse
+
+# Number of documents pulled from Mongo (and encoded) per chunk
+chunk_size = 200
+
+
+# Encode documents the same way jsonify does for this app
+def dumps(document):
+    return current_app.json.dumps(document)
+
+
+# Query arguments an export depends on
+export_query_args = ("limit", "cursor", "fields", "format")
+
+
+# Read limit / cursor / fields / format from the query string
+def export_args(allowed_fields, default_fields):
+    limit = request.args.get("limit", type=int)
+    if limit is not None and limit < 1:
+        abort(400)
+    after = None
+    if "cursor" in request.args:
+        after = decode_id_cursor(request.args["cursor"])
+        if after is None:
+            abort(400)
+    fields = default_fields
+    if "fields" in request.args:
+        fields = tuple(field for field in request.args["fields"].split(",") if field in allowed_fields)
+        if not fields:
+            abort(400)
+    export_format = request.args.get("format")
+    if export_format is None:
+        best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+        export_format = "ndjson" if best == "application/x-ndjson" else "json"
+    if export_format not in ("json", "ndjson"):
+        abort(400)
+    return limit, after, fields, export_format
+
+
+# Find the _id the next page starts after, using only the _id index
+def next_cursor(collection, match, limit):
+    if limit is None:
+        return None
+    last = list(collection.find(match, {"_id": 1}).sort("_id", 1).skip(limit - 1).limit(1))
+    if not last:
+        return None
+    following = collection.find_one({**match, "_id": {"$gt": last[0]["_id"]}}, {"_id": 1})
+    return encode_id_cursor(last[0]["_id"]) if following else None
+
+
+async def next_cursor_async(collection, match, limit):
+    if limit is None:
+        return None
+    last = await collection.find(match, {"_id": 1}).sort("_id", 1).skip(limit - 1).limit(1).to_list(1)
+    if not last:
+        return None
+    following = await collection.find_one({**match, "_id": {"$gt": last[0]["_id"]}}, {"_id": 1})
+    return encode_id_cursor(last[0]["_id"]) if following else None
+
+
+# Group a cursor into lists of `size` documents without materialising it
+def chunked(cursor, size=chunk_size):
+    chunk = []
+    for document in cursor:
+        chunk.append(document)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# Encode one chunk, as NDJSON lines or as the next part of a JSON array
+def encode_chunk(chunk, export_format, first, encode=dumps):
+    if export_format == "ndjson":
+        return "".join(encode(document) + "\n" for document in chunk)
+    encoded = ",".join(encode(document) for document in chunk)
+    if not encoded or first:
+        return encoded
+    return "," + encoded
+
+
+def _export_cursor(collection, projection, limit, after, match):
+    match = dict(match or {})
+    if after is not None:
+        match["_id"] = {"$gt": after}
+    cursor = collection.find(match, projection).sort("_id", 1).batch_size(chunk_size)
+    if limit is not None:
+        cursor = cursor.limit(limit)
+    return cursor, match
+
+
+def _link_next(response, token):
+    if token:
+        args = {**request.args.to_dict(), "cursor": token}
+        next_url = url_for(request.endpoint, _external=True, **request.view_args, **args)
+        response.headers["X-Next-Cursor"] = token
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
+
+# Stream documents from `collection` ordered by _id. `transform` is applied
+# to every chunk (e.g. to resolve authors) before it is encoded.
+def stream_export(collection, projection, limit, after, export_format, transform=None, match=None):
+    cursor, match = _export_cursor(collection, projection, limit, after, match)
+
+    def generate():
+        first = True
+        if export_format == "json":
+            yield "["
+        for chunk in chunked(cursor):
+            if transform is not None:
+                chunk = transform(chunk)
+            encoded = encode_chunk(chunk, export_format, first)
+            if encoded:
+                yield encoded
+                first = False
+        if export_format == "json":
+            yield "]"
+
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "application/json"
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    return _link_next(response, next_cursor(collection, match, limit))
+
+
+# Same export from an async collection, for the ASGI entry point.
+# `transform` is a coroutine function here.
+async def stream_export_async(collection, projection, limit, after, export_format, transform=None, match=None):
+    cursor, match = _export_cursor(collection, projection, limit, after, match)
+    # The body is sent after the request context is gone
+    encode = current_app.json.dumps
+
+    async def generate():
+        first = True
+        if export_format == "json":
+            yield "["
+        chunk = []
+        async for document in cursor:
+            chunk.append(document)
+            if len(chunk) < chunk_size:
+                continue
+            encoded = encode_chunk(await transform(chunk) if transform else chunk, export_format, first, encode)
+            if encoded:
+                yield encoded
+                first = False
+            chunk = []
+        if chunk:
+            encoded = encode_chunk(await transform(chunk) if transform else chunk, export_format, first, encode)
+            if encoded:
+                yield encoded
+        if export_format == "json":
+            yield "]"
+
+    mimetype = "application/x-ndjson" if export_format == "ndjson" else "application/json"
+    response = AsyncStreamResponse(generate(), mimetype=mimetype)
+    return _link_next(response, await next_cursor_async(collection, match, limit))
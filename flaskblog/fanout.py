@@ -0,0 +1,138 @@
+# Author snapshot fan-out
+#
+# Posts embed the display fields of their author ("author_details": username
+# and image) so listings never join the users collection. When an author
+# changes those fields, a job rewrites the snapshot on their posts in
+# batches. Each batch selects posts whose snapshot still differs, so a job
+# is resumable by construction: restarting it just continues where the
+# previous run stopped. Jobs live in the `jobs` collection, which also
+# records their progress.
+#
+# A worker claims a job atomically (pending, or running with an expired
+# lease) and renews the lease after every batch, so only one process runs a
+# given author's job. Rescheduling sets it back to pending, which makes the
+# current owner stop and lets the next claim take over.
+import logging
+import os
+import queue
+import threading
+import uuid
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+snapshot_fields = ("username", "image")
+
+
+def author_snapshot(user):
+    # Always build it in the same field order, the $ne comparison depends on it
+    return {field: user.get(field) for field in snapshot_fields}
+
+
+class AuthorFanout:
+    def __init__(self, mongo):
+        self.mongo = mongo
+        self.app = None
+        self.batch_size = 500
+        self.lease = 300
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self.batch_size = app.config.get("FANOUT_BATCH_SIZE", self.batch_size)
+        self.lease = app.config.get("FANOUT_LEASE", self.lease)
+
+    def _start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            threading.Thread(target=self._work, name="author-fanout", daemon=True).start()
+            # Resume jobs interrupted by a restart; running jobs whose lease is
+            # still current belong to another worker
+            for job in self.mongo.db.jobs.find({"type": "author_fanout", **self._claimable()}, {"_id": 1}):
+                self._queue.put(job["_id"])
+
+    def _claimable(self):
+        return {"$or": [{"status": "pending"}, {"status": "running", "lease_until": {"$lt": datetime.now()}}]}
+
+    # Record (or refresh) the job for an author and run it in the background
+    def schedule(self, author_id, user, background=True):
+        author_id = ObjectId(author_id)
+        job_id = f"author_fanout:{author_id}"
+        self.mongo.db.jobs.update_one(
+            {"_id": job_id},
+            {
+                "$set": {"type": "author_fanout", "author": author_id, "snapshot": author_snapshot(user),
+                         "status": "pending", "updated": 0, "scheduled_at": datetime.now()},
+                "$unset": {"finished_at": ""},
+            },
+            upsert=True,
+        )
+        if background:
+            self._start()
+            self._queue.put(job_id)
+        return job_id
+
+    # Run a job to completion; `progress(updated, total)` is called after every batch
+    def run(self, job_id, progress=None):
+        jobs, posts = self.mongo.db.jobs, self.mongo.db.posts
+        owner = uuid.uuid4().hex
+        job = jobs.find_one_and_update(
+            {"_id": job_id, **self._claimable()},
+            {"$set": {"status": "running", "owner": owner, "started_at": datetime.now(),
+                      "lease_until": datetime.now() + timedelta(seconds=self.lease)}},
+            return_document=ReturnDocument.AFTER,
+        )
+        if job is None:
+            # Done, or another worker holds it
+            return
+        owned = {"_id": job_id, "owner": owner, "status": "running"}
+        snapshot = job["snapshot"]
+        stale = {"author": job["author"], "author_details": {"$ne": snapshot}}
+        total = posts.count_documents({"author": job["author"]})
+        jobs.update_one(owned, {"$set": {"total": total}})
+        updated = 0
+        while True:
+            batch = [post["_id"] for post in posts.find(stale, {"_id": 1}).limit(self.batch_size)]
+            if not batch:
+                break
+            result = posts.update_many({"_id": {"$in": batch}, **stale}, {"$set": {"author_details": snapshot}})
+            updated += result.modified_count
+            renewed = jobs.update_one(owned, {"$set": {
+                "updated": updated, "lease_until": datetime.now() + timedelta(seconds=self.lease)}})
+            # Rescheduled (the author changed again) or the lease was lost: the next claim takes over
+            if renewed.matched_count == 0:
+                return
+            if progress is not None:
+                progress(updated, total)
+        jobs.update_one(owned, {"$set": {"status": "done", "finished_at": datetime.now()},
+                                "$unset": {"owner": "", "lease_until": ""}})
+        self._on_done(job["author"])
+
+    # Pages rendered while the job ran may mix old and new snapshots
+    def _on_done(self, author_id):
+        from flaskblog import change_feed
+        change_feed.publish("users", "update", {"_id": author_id})
+
+    def _work(self):
+        with self.app.app_context():
+            while True:
+                job_id = self._queue.get()
+                try:
+                    self.run(job_id)
+                except Exception:
+                    logger.exception("Author fan-out %s failed, it will resume on restart", job_id)
+
+    def progress(self, author_id):
+        job = self.mongo.db.jobs.find_one({"_id": f"author_fanout:{ObjectId(author_id)}"},
+                                          {"status": 1, "updated": 1, "total": 1, "scheduled_at": 1,
+                                           "finished_at": 1})
+        if job is not None:
+            job.pop("_id")
+        return job
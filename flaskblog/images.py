@@ -0,0 +1,159 @@
+# Profile picture processing
+#
+# Uploads are decoded and resized in a process pool so the PIL work does not
+# hold the GIL of the request threads. Every upload is stored as a set of
+# renditions named after the hash of the uploaded bytes, e.g.
+# "3f2a9c0d1b7e4a55-125.jpg", which dedups identical uploads and lets the
+# files be cached forever. The user document keeps the 125px JPEG name so
+# existing templates keep working. An upload PIL can't decode raises
+# InvalidImage; one still rendering after IMAGE_WAIT_TIMEOUT returns None, and
+# the caller keeps the previous picture until the files are there.
+import hashlib
+import io
+import os
+import re
+import threading
+from concurrent.futures import BrokenExecutor, TimeoutError
+import click
+from flask.cli import AppGroup, with_appcontext
+
+rendition_sizes = (32, 64, 125, 256)
+rendition_formats = {"jpg": ("JPEG", {"quality": 82, "optimize": True, "progressive": True}),
+                     "webp": ("WEBP", {"quality": 80, "method": 4})}
+default_size = 125
+default_image = "default.jpg"
+rendition_pattern = re.compile(r"^(?P<digest>[0-9a-f]{16})-(?P<size>\d+)\.(?P<ext>jpg|webp)$")
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def rendition_name(digest, size=default_size, ext="jpg"):
+    return f"{digest}-{size}.{ext}"
+
+
+# Runs in a worker process: decode once, write every size and format
+def render_renditions(data, digest, directory, sizes=rendition_sizes):
+    from PIL import Image, ImageOps
+    image = Image.open(io.BytesIO(data))
+    # Let the JPEG decoder scale down while decoding, like Image.thumbnail does
+    largest = max(sizes)
+    image.draft("RGB", (largest, largest))
+    image = ImageOps.exif_transpose(image).convert("RGB")
+    written = []
+    for size in sorted(sizes, reverse=True):
+        # Downscale from the previous (larger) rendition, it is much cheaper
+        image.thumbnail((size, size), Image.LANCZOS)
+        for ext, (image_format, options) in rendition_formats.items():
+            filename = rendition_name(digest, size, ext)
+            path = os.path.join(directory, filename)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            image.save(tmp_path, image_format, **options)
+            os.replace(tmp_path, path)
+            written.append(filename)
+    return written
+
+
+class ImagePipeline:
+    def __init__(self):
+        self.directory = None
+        self.workers = 2
+        self.wait_timeout = 10
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.directory = os.path.join(app.root_path, "static", "profile_pics")
+        self.workers = app.config.get("IMAGE_WORKERS", self.workers)
+        self.wait_timeout = app.config.get("IMAGE_WAIT_TIMEOUT", self.wait_timeout)
+        app.cli.add_command(images_cli)
+
+    # The pool is created lazily, once per process, so forked workers get their own
+    @property
+    def executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # multiprocessing is only imported once there is work for it
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    # Store an uploaded file and return the image name to save on the user,
+    # or None when it isn't rendered in time
+    def process(self, form_image):
+        data = form_image.read()
+        digest = hashlib.sha256(data).hexdigest()[:16]
+        filename = rendition_name(digest)
+        if all(os.path.exists(os.path.join(self.directory, rendition_name(digest, size, ext)))
+               for size in rendition_sizes for ext in rendition_formats):
+            return filename
+        future = self.executor.submit(render_renditions, data, digest, self.directory)
+        try:
+            future.result(timeout=self.wait_timeout)
+        except TimeoutError:
+            # Keeps running in the pool, the files show up shortly
+            return None
+        except BrokenExecutor as error:
+            # A worker died on it (out of memory, say); start a new pool next time
+            with self._lock:
+                self._pid = None
+            raise InvalidImage(str(error)) from error
+        except Exception as error:
+            raise InvalidImage(str(error)) from error
+        return filename
+
+    # Static file names of every rendition of an image, or None for legacy images
+    def renditions(self, image):
+        match = rendition_pattern.match(image or "")
+        if not match:
+            return None
+        return {size: {ext: f"profile_pics/{rendition_name(match['digest'], size, ext)}"
+                       for ext in rendition_formats} for size in rendition_sizes}
+
+    def _files_for(self, image):
+        match = rendition_pattern.match(image)
+        if match:
+            return [rendition_name(match["digest"], size, ext) for size in rendition_sizes for ext in rendition_formats]
+        return [image]
+
+    # Delete an image's files once no user references it any more
+    def release(self, image, users):
+        if not image or image == default_image or users.count_documents({"image": image}, limit=1):
+            return
+        for filename in self._files_for(image):
+            try:
+                os.remove(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+    # Delete every file in profile_pics that no user references
+    def cleanup(self, users, dry_run=False):
+        keep = {default_image}
+        for image in users.distinct("image"):
+            keep.update(self._files_for(image))
+        removed = []
+        for filename in os.listdir(self.directory):
+            if filename in keep or filename.startswith("."):
+                continue
+            removed.append(filename)
+            if not dry_run:
+                os.remove(os.path.join(self.directory, filename))
+        return removed
+
+
+images_cli = AppGroup("images", help="Profile picture maintenance.")
+
+
+@images_cli.command("cleanup")
+@click.option("--dry-run", is_flag=True, help="Only list the files that would be deleted.")
+@with_appcontext
+def cleanup_command(dry_run):
+    """Delete profile pictures no user references."""
+    from flaskblog import mongo, image_pipeline
+    removed = image_pipeline.cleanup(mongo.db.users, dry_run=dry_run)
+    for filename in removed:
+        click.echo(filename)
+    click.echo(f"{'Would remove' if dry_run else 'Removed'} {len(removed)} file(s).")
@@ -0,0 +1,225 @@
+# Background email delivery
+#
+# Messages are written to the `outbox` collection first, so they survive a
+# restart, and then handed to a bounded in-process queue drained by a small
+# pool of worker threads. Each worker keeps its SMTP connection open while
+# there is mail to send. Failed deliveries are retried with exponential
+# backoff by a sweeper thread that also picks up mail left over by a
+# previous process. The threads start with each process's first request (or
+# its warm-up), so a worker that never sends mail still sweeps the outbox.
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+from pymongo import ReturnDocument
+
+logger = logging.getLogger(__name__)
+
+
+# Flask-Mail, and smtplib and email with it, is imported when the first
+# message is sent rather than at startup
+class LazyMail:
+    def __init__(self):
+        self.app = None
+        self._mail = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        self._mail = None
+
+    def connect(self):
+        with self._lock:
+            if self._mail is None:
+                from flask_mail import Mail
+                self._mail = Mail()
+                self._mail.init_app(self.app)
+        return self._mail.connect()
+
+
+class MailQueue:
+    def __init__(self, mail, mongo):
+        self.mail = mail
+        self.mongo = mongo
+        self.app = None
+        self._queue = None
+        self._threads = []
+        self._pid = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def init_app(self, app):
+        self.app = app
+        self.enabled = app.config.get("MAIL_QUEUE_ENABLED", True)
+        self.size = app.config.get("MAIL_QUEUE_SIZE", 100)
+        self.workers = app.config.get("MAIL_QUEUE_WORKERS", 2)
+        self.max_attempts = app.config.get("MAIL_MAX_ATTEMPTS", 5)
+        self.backoff = app.config.get("MAIL_RETRY_BACKOFF", 30)
+        self.idle_timeout = app.config.get("MAIL_CONNECTION_IDLE", 30)
+        self.poll_interval = app.config.get("MAIL_OUTBOX_POLL", 15)
+        self.lock_timeout = app.config.get("MAIL_SEND_LOCK_TIMEOUT", 300)
+        if self.enabled:
+            app.before_request(self.start)
+
+    # Persist a message and schedule it for delivery; returns the outbox id
+    def enqueue(self, to, subject, body, sender=None):
+        message = {
+            "to": to,
+            "subject": subject,
+            "body": body,
+            "sender": sender or self.app.config["MAIL_USERNAME"],
+            "status": "pending",
+            "attempts": 0,
+            "created": datetime.now(),
+            "next_attempt": datetime.now(),
+        }
+        message_id = self.mongo.db.outbox.insert_one(message).inserted_id
+        if not self.enabled:
+            self._deliver(message_id)
+            return message_id
+        self.start()
+        try:
+            self._queue.put_nowait(message_id)
+        except queue.Full:
+            # Still in the outbox, the sweeper will pick it up
+            logger.warning("Mail queue is full, deferring message %s", message_id)
+        return message_id
+
+    # Start the worker and sweeper threads (once per process, so it is fork safe)
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue(maxsize=self.size)
+            self._stopping.clear()
+            self._threads = [
+                threading.Thread(target=self._work, name=f"mail-worker-{i}", daemon=True)
+                for i in range(self.workers)
+            ]
+            self._threads.append(threading.Thread(target=self._sweep, name="mail-sweeper", daemon=True))
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self, timeout=5):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def stats(self):
+        counts = {status: 0 for status in ("pending", "sending", "sent", "failed")}
+        for row in self.mongo.db.outbox.aggregate([{"$group": {"_id": "$status", "count": {"$sum": 1}}}]):
+            counts[row["_id"]] = row["count"]
+        counts["queued"] = self._queue.qsize() if self._queue is not None else 0
+        return counts
+
+    # Claim a due message so only one worker (in any process) sends it
+    def _claim(self, message_id):
+        return self.mongo.db.outbox.find_one_and_update(
+            {"_id": message_id, "status": "pending", "next_attempt": {"$lte": datetime.now()}},
+            {"$set": {"status": "sending", "locked_at": datetime.now()}},
+            return_document=ReturnDocument.AFTER,
+        )
+
+    def _send(self, connection, message):
+        from flask_mail import Message
+        connection.send(Message(message["subject"], sender=message["sender"],
+                                recipients=[message["to"]], body=message["body"]))
+
+    def _record_failure(self, message, error):
+        attempts = message["attempts"] + 1
+        update = {"attempts": attempts, "last_error": str(error)}
+        if attempts >= self.max_attempts:
+            update["status"] = "failed"
+            logger.error("Giving up on message %s after %d attempts: %s", message["_id"], attempts, error)
+        else:
+            update["status"] = "pending"
+            update["next_attempt"] = datetime.now() + timedelta(seconds=self.backoff * 2 ** (attempts - 1))
+            logger.warning("Delivery of message %s failed (attempt %d): %s", message["_id"], attempts, error)
+        self.mongo.db.outbox.update_one({"_id": message["_id"]}, {"$set": update})
+
+    # Synchronous delivery, used when the queue is disabled
+    def _deliver(self, message_id):
+        message = self._claim(message_id)
+        if message is None:
+            return
+        try:
+            with self.mail.connect() as connection:
+                self._send(connection, message)
+        except Exception as error:
+            self._record_failure(message, error)
+        else:
+            self.mongo.db.outbox.update_one({"_id": message_id}, {"$set": {"status": "sent", "sent_at": datetime.now()}})
+
+    def _work(self):
+        with self.app.app_context():
+            connection = None
+            while not self._stopping.is_set():
+                try:
+                    message_id = self._queue.get(timeout=self.idle_timeout)
+                except queue.Empty:
+                    # Idle: release the SMTP connection until there is more mail
+                    if connection is not None:
+                        self._close(connection)
+                        connection = None
+                    continue
+                try:
+                    connection = self._process(connection, message_id)
+                except Exception:
+                    # Mongo hiccups must not kill the worker; the sweeper
+                    # re-queues whatever was left pending or sending
+                    logger.exception("Mail worker failed on message %s", message_id)
+                    if connection is not None:
+                        self._close(connection)
+                        connection = None
+            if connection is not None:
+                self._close(connection)
+
+    # Send one queued message; returns the connection to keep using
+    def _process(self, connection, message_id):
+        message = self._claim(message_id)
+        if message is None:
+            return connection
+        try:
+            if connection is None:
+                connection = self.mail.connect().__enter__()
+            self._send(connection, message)
+        except Exception as error:
+            if connection is not None:
+                self._close(connection)
+                connection = None
+            self._record_failure(message, error)
+        else:
+            self.mongo.db.outbox.update_one(
+                {"_id": message_id}, {"$set": {"status": "sent", "sent_at": datetime.now()}})
+        return connection
+
+    def _close(self, connection):
+        try:
+            connection.__exit__(None, None, None)
+        except Exception:
+            pass
+
+    # Re-queue messages that are due for a retry or were never queued
+    def _sweep(self):
+        with self.app.app_context():
+            while not self._stopping.wait(self.poll_interval):
+                try:
+                    self._requeue()
+                except Exception:
+                    logger.exception("Mail sweep failed, retrying in %ss", self.poll_interval)
+
+    def _requeue(self):
+        outbox = self.mongo.db.outbox
+        # Release messages held by a worker that died mid-send
+        stale = datetime.now() - timedelta(seconds=self.lock_timeout)
+        outbox.update_many({"status": "sending", "locked_at": {"$lt": stale}},
+                           {"$set": {"status": "pending"}})
+        due = outbox.find({"status": "pending", "next_attempt": {"$lte": datetime.now()}}, {"_id": 1})
+        for message in due.limit(self.size):
+            try:
+                self._queue.put_nowait(message["_id"])
+            except queue.Full:
+                break
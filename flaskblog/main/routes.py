@@ -1,56 +1,135 @@
-from flask import render_template, request, Blueprint, current_app
-from flaskblog import mongo
+from flask import render_template, request, Blueprint, current_app, url_for, jsonify, Response, abort
+from flaskblog import database, async_database, profile_cache, response_cache, mail_queue, search_service, metrics, rate_limiter, change_feed
+from flaskblog.queries import fetch_posts, fetch_posts_async, feed_fields
+from flaskblog.pagination import (decode_cursor, encode_cursor, keyset_filter, keyset_sort,
+                                  trim_window, estimated_total, estimated_total_async)
+from flaskblog.asgi import async_view, AsyncStreamResponse
 
 main_blueprint = Blueprint("main", __name__)
 
-# Homepage
-@main_blueprint.route("/")
-def home():
-    # Debug
-    print(f"Current app: {current_app.extensions}")
-    # Get page number from URL parameters, default to 1
-    page = request.args.get('page', 1, type=int)
+# Work out which slice of the feed the request asks for
+def feed_query(posts_per_page):
     sort = request.args.get("sort", "newest", type=str)
-    sortBy = {"date_posted": -1} if sort == "newest" else {"date_posted": 1}
-    posts_per_page = 4
-    skip = (page - 1) * posts_per_page
-    total_posts = mongo.db.posts.count_documents({})
+    descending = sort == "newest"
+    # Numbered pages (?page=) are kept as a fallback for old links
+    page = request.args.get("page", type=int)
+    if page is not None and "cursor" not in request.args:
+        page = max(page, 1)
+        query = {"sort": keyset_sort(descending), "skip": (page - 1) * posts_per_page, "limit": posts_per_page}
+        return {"sort": sort, "page": page, "position": None, "direction": "next", "query": query}
+
+    # Keyset pagination: seek to the cursor position instead of skipping
+    position = decode_cursor(request.args.get("cursor", ""))
+    if position is not None and position[3] != sort:
+        position = None
+    match, direction = {}, "next"
+    if position is not None:
+        date_posted, post_id, direction, _ = position
+        match = keyset_filter(date_posted, post_id, descending, direction)
+    query = {"match": match, "sort": keyset_sort(descending, direction), "limit": posts_per_page + 1}
+    return {"sort": sort, "page": None, "position": position, "direction": direction, "query": query}
+
+
+def render_feed(feed, window, total_posts, posts_per_page):
+    sort, page, direction = feed["sort"], feed["page"], feed["direction"]
     total_pages = (total_posts + posts_per_page - 1) // posts_per_page
-    posts = list(mongo.db.posts.aggregate([
-        {
-            "$lookup": {
-                "from": "users",
-                "localField": "author",
-                "foreignField": "_id",
-                "as": "author_details"
-            }
-        },
-        {"$unwind": "$author_details"},
-        {
-            "$project": {
-                "_id": 1,
-                "title": 1,
-                "content": 1,
-                "date_posted": 1,
-                "author_details.username": 1
-            }
-        },
-        {"$sort": sortBy},  # Sort by date, newest first
-        {"$skip": skip},
-        {"$limit": posts_per_page}
-    ]))
+    if page is not None:
+        posts = window
+        has_prev = page > 1
+        has_next = page < total_pages
+        prev_url = url_for("main.home", page=page - 1, sort=sort) if has_prev else None
+        next_url = url_for("main.home", page=page + 1, sort=sort) if has_next else None
+    else:
+        posts, has_more = trim_window(window, posts_per_page, direction)
+        if direction == "next":
+            has_prev, has_next = feed["position"] is not None, has_more
+        else:
+            has_prev, has_next = has_more, True
+        prev_url = next_url = None
+        if posts and has_prev:
+            prev_url = url_for("main.home", cursor=encode_cursor(posts[0], "prev", sort), sort=sort)
+        if posts and has_next:
+            next_url = url_for("main.home", cursor=encode_cursor(posts[-1], "next", sort), sort=sort)
 
     return render_template(
         "home.html",
         posts=posts,
         page=page,
         total_pages=total_pages,
-        has_prev=page > 1,
-        has_next=page < total_pages,
-        sort=sort
+        has_prev=has_prev,
+        has_next=has_next,
+        prev_url=prev_url,
+        next_url=next_url,
+        sort=sort,
+        live_updates=change_feed.enabled and streams_supported()
     )
 
+# Homepage
+@main_blueprint.route("/")
+@response_cache.cached(tags=lambda: ["feed", "users"], query_args=("page", "cursor", "sort"))
+def home():
+    posts_per_page = current_app.config["POSTS_PER_PAGE"]
+    feed = feed_query(posts_per_page)
+    total_posts = estimated_total(database.db.posts, current_app.config["FEED_COUNT_TTL"])
+    window = fetch_posts(**feed["query"], fields=feed_fields)
+    return render_feed(feed, window, total_posts, posts_per_page)
+
+@async_view("main.home")
+@response_cache.cached(tags=lambda: ["feed", "users"], query_args=("page", "cursor", "sort"))
+async def home_async():
+    posts_per_page = current_app.config["POSTS_PER_PAGE"]
+    feed = feed_query(posts_per_page)
+    total_posts = await estimated_total_async(async_database.db.posts, current_app.config["FEED_COUNT_TTL"])
+    window = await fetch_posts_async(**feed["query"], fields=feed_fields)
+    return render_feed(feed, window, total_posts, posts_per_page)
+
 # About page
 @main_blueprint.route("/about")
 def about():
-    return render_template("about.html", title="About")
\ No newline at end of file
+    return render_template("about.html", title="About")
+
+# New posts pushed to open home pages as Server-Sent Events
+sse_headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+# A stream holds its worker for as long as the page stays open: only
+# threaded servers and the ASGI entry point can afford that, a sync worker
+# would stop serving everyone else
+def streams_supported():
+    return request.environ.get("wsgi.multithread", False)
+
+@main_blueprint.route("/events/posts")
+def post_events():
+    # 204 tells EventSource not to reconnect
+    if not change_feed.enabled or not streams_supported():
+        return Response(status=204)
+    stream = change_feed.stream(current_app.create_url_adapter(request))
+    return Response(stream, mimetype="text/event-stream", headers=sse_headers)
+
+@async_view("main.post_events")
+async def post_events_async():
+    if not change_feed.enabled:
+        return Response(status=204)
+    stream = change_feed.stream_async(current_app.create_url_adapter(request))
+    return AsyncStreamResponse(stream, mimetype="text/event-stream", headers=sse_headers)
+
+# Runtime diagnostics (cache counters, mail outbox, search index, Mongo pools, rate limits, change feed),
+# only served with DIAGNOSTICS_ENABLED
+@main_blueprint.route("/api/diagnostics")
+def diagnostics():
+    if not current_app.config["DIAGNOSTICS_ENABLED"]:
+        abort(404)
+    return jsonify({
+        "profile_cache": profile_cache.stats(),
+        "response_cache": response_cache.stats(),
+        "mail_outbox": mail_queue.stats(),
+        "search": search_service.stats(),
+        "mongo": database.stats(),
+        "mongo_async": async_database.stats(),
+        "rate_limits": rate_limiter.stats(),
+        "events": change_feed.stats(),
+    })
+
+# Prometheus metrics
+@main_blueprint.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
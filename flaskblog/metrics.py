@@ -0,0 +1,201 @@
+# Request-level performance instrumentation
+#
+# Records per-endpoint latency histograms, MongoDB command counts and
+# durations (through pymongo command monitoring), template render time and
+# named timers such as bcrypt. Everything is exported in the Prometheus text
+# format; per-request totals can also be sent as a Server-Timing header.
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_request_context, request, template_rendered, before_render_template
+from pymongo import monitoring
+
+logger = logging.getLogger("flaskblog.requests")
+
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for value in values)
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, escaped))
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    def __init__(self, name, description, labels=(), buckets=default_buckets):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series["counts"][i] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, series in sorted(self._series.items()):
+                names = self.label_names + ("le",)
+                for bound, count in zip(self.buckets, series["counts"]):
+                    lines.append(f"{self.name}_bucket{_labels(names, labels + (bound,))} {count}")
+                lines.append(f"{self.name}_bucket{_labels(names, labels + ('+Inf',))} {series['count']}")
+                lines.append(f"{self.name}_sum{_labels(self.label_names, labels)} {series['sum']}")
+                lines.append(f"{self.name}_count{_labels(self.label_names, labels)} {series['count']}")
+        return lines
+
+
+class Counter:
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.label_names = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.label_names, labels)} {value}")
+        return lines
+
+
+# Feeds MongoDB command timings into the metrics and the current request's totals
+class CommandTimer(monitoring.CommandListener):
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def started(self, event):
+        pass
+
+    def _record(self, event, outcome):
+        seconds = event.duration_micros / 1e6
+        self.metrics.mongo_commands.observe(seconds, event.command_name, outcome)
+        # Sync pymongo runs the listener on the thread that issued the command
+        if has_request_context():
+            g.setdefault("timings", {})
+            g.timings["mongo"] = g.timings.get("mongo", 0.0) + seconds
+            g.mongo_ops = g.get("mongo_ops", 0) + 1
+
+    def succeeded(self, event):
+        self._record(event, "ok")
+
+    def failed(self, event):
+        self._record(event, "error")
+
+
+class Metrics:
+    def __init__(self):
+        self.requests = Histogram("flaskblog_request_duration_seconds", "Request latency by endpoint.",
+                                  ("endpoint", "method", "status"))
+        self.mongo_commands = Histogram("flaskblog_mongo_command_duration_seconds",
+                                        "MongoDB command duration.", ("command", "outcome"))
+        self.mongo_per_request = Counter("flaskblog_mongo_commands_total",
+                                         "MongoDB commands issued, by endpoint.", ("endpoint",))
+        self.templates = Histogram("flaskblog_template_render_seconds", "Template render time.", ("template",))
+        self.timers = Histogram("flaskblog_timer_seconds", "Named code timers (e.g. bcrypt).", ("timer",))
+        self.command_listener = CommandTimer(self)
+        self.collectors = []
+        self.server_timing = False
+        self.log_requests = False
+
+    def init_app(self, app):
+        self.server_timing = app.config.get("METRICS_SERVER_TIMING", False)
+        self.log_requests = app.config.get("METRICS_LOG_REQUESTS", False)
+        app.before_request(self._start_request)
+        app.after_request(self._finish_request)
+        before_render_template.connect(self._start_template, app)
+        template_rendered.connect(self._finish_template, app)
+
+    # Register a callable returning {name: value} gauges, e.g. cache counters
+    def add_collector(self, name, collect):
+        self.collectors.append((name, collect))
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.timers.observe(elapsed, name)
+            if has_request_context():
+                g.setdefault("timings", {})
+                g.timings[name] = g.timings.get(name, 0.0) + elapsed
+
+    def _start_request(self):
+        g.request_started = time.perf_counter()
+
+    def _finish_request(self, response):
+        if "request_started" not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or "unmatched"
+        self.requests.observe(elapsed, endpoint, request.method, response.status_code)
+        mongo_ops = g.get("mongo_ops", 0)
+        if mongo_ops:
+            self.mongo_per_request.inc(endpoint, amount=mongo_ops)
+        timings = g.get("timings", {})
+        if self.server_timing:
+            entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+            entries.append(f"total;dur={elapsed * 1000:.1f}")
+            response.headers["Server-Timing"] = ", ".join(entries)
+        if self.log_requests:
+            logger.info(json.dumps({
+                "endpoint": endpoint,
+                "method": request.method,
+                "path": request.path,
+                "status": response.status_code,
+                "duration_ms": round(elapsed * 1000, 2),
+                "mongo_ops": mongo_ops,
+                "timings_ms": {name: round(seconds * 1000, 2) for name, seconds in timings.items()},
+            }))
+        return response
+
+    def _start_template(self, app, template, context, **extra):
+        if has_request_context():
+            g.setdefault("template_starts", []).append(time.perf_counter())
+
+    def _finish_template(self, app, template, context, **extra):
+        if not has_request_context() or not g.get("template_starts"):
+            return
+        elapsed = time.perf_counter() - g.template_starts.pop()
+        self.templates.observe(elapsed, template.name or "string")
+        # Nested renders are included in their parent, only count the outermost
+        if not g.template_starts:
+            g.setdefault("timings", {})
+            g.timings["template"] = g.timings.get("template", 0.0) + elapsed
+
+    # Prometheus text exposition format
+    def render(self):
+        lines = []
+        for metric in (self.requests, self.mongo_commands, self.mongo_per_request, self.templates, self.timers):
+            lines += metric.render()
+        for name, collect in self.collectors:
+            for key, value in collect().items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    metric_name = f"flaskblog_{name}_{key}"
+                    lines += [f"# TYPE {metric_name} gauge", f"{metric_name} {value}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,190 @@
+# Database provisioning: validators, indexes and data migrations
+#
+# Run `flask db upgrade` once per deploy. It applies the declared validators
+# and indexes (both idempotent), runs any data migration newer than the
+# version recorded in the `meta` collection and then records the new
+# version. App processes only read that version on boot.
+from datetime import datetime
+import click
+from flask.cli import AppGroup, with_appcontext
+from pymongo import IndexModel
+from pymongo.errors import OperationFailure, PyMongoError
+
+indexes = {
+    "users": [
+        IndexModel([("email", 1)], unique=True),
+        IndexModel([("username", 1)], unique=True),
+    ],
+    "posts": [
+        # Keyset pagination of the feed, in both sort directions
+        IndexModel([("date_posted", 1), ("_id", 1)]),
+        # A user's posts, with the same keyset tie-break on _id
+        IndexModel([("author", 1), ("date_posted", 1), ("_id", 1)]),
+        # Full-text search, titles weigh more than contents
+        IndexModel([("title", "text"), ("content", "text")], weights={"title": 3, "content": 1}),
+    ],
+    "outbox": [
+        IndexModel([("status", 1), ("next_attempt", 1)]),
+    ],
+}
+
+# Capped collections, name -> size in bytes
+capped_collections = {
+    # Change events of a standalone server (flaskblog/events.py)
+    "events": 16 * 1024 * 1024,
+}
+
+# Posts are listed per author through the posts(author, date_posted, _id) index,
+# so the ever-growing users.posts array is dropped. A user's array is only
+# removed once every post it references is confirmed to carry that author.
+def drop_user_posts_array(db, echo=print):
+    kept = 0
+    for user in db.users.find({"posts": {"$exists": True}}, {"posts": 1}):
+        post_ids = user.get("posts") or []
+        existing = db.posts.count_documents({"_id": {"$in": post_ids}})
+        owned = db.posts.count_documents({"_id": {"$in": post_ids}, "author": user["_id"]})
+        if owned != existing:
+            echo(f"Keeping posts array of user {user['_id']}: {existing - owned} post(s) have another author")
+            kept += 1
+            continue
+        db.users.update_one({"_id": user["_id"]}, {"$unset": {"posts": ""}})
+    if kept:
+        echo(f"{kept} user(s) kept their posts array, fix their posts and run the migration again")
+
+
+# Feed cards read the excerpt and post pages the rendered HTML stored on
+# each post (flaskblog/summaries.py), so existing posts get theirs
+def summarize_posts(db, echo=print):
+    from flaskblog.summaries import backfill_summaries
+    checked, updated = backfill_summaries(db.posts)
+    echo(f"{updated} of {checked} post(s) summarized")
+
+
+# The per-author index gained _id, so a page cursor's tie-break is served
+# from the index instead of sorting every post at the same date in memory.
+# Its replacement is built before this runs.
+def drop_author_date_index(db, echo=print):
+    try:
+        db.posts.drop_index("author_1_date_posted_1")
+    except OperationFailure:
+        echo("Index author_1_date_posted_1 already gone")
+    else:
+        echo("Dropped index author_1_date_posted_1")
+
+
+# Data migrations as (version, description, function(db, echo)), in order
+data_migrations = [
+    (4, "drop the embedded users.posts array", drop_user_posts_array),
+    (7, "store excerpts and rendered HTML on posts", summarize_posts),
+    (8, "replace posts(author, date_posted) with posts(author, date_posted, _id)", drop_author_date_index),
+]
+
+# Bump whenever the indexes, validators or data migrations change
+schema_version = 8
+
+
+def validators():
+    from flaskblog import post_schema, user_schema
+    return {"posts": post_schema, "users": user_schema}
+
+
+def current_version(db):
+    meta = db.meta.find_one({"_id": "schema"})
+    return meta["version"] if meta else 0
+
+
+def apply_validators(db):
+    existing = set(db.list_collection_names())
+    for name, schema in validators().items():
+        if name in existing:
+            db.command("collMod", name, validator={"$jsonSchema": schema})
+        else:
+            db.create_collection(name, validator={"$jsonSchema": schema})
+
+
+def apply_capped_collections(db):
+    existing = set(db.list_collection_names())
+    created = []
+    for name, size in capped_collections.items():
+        if name not in existing:
+            db.create_collection(name, capped=True, size=size)
+            created.append(name)
+    return created
+
+
+def apply_indexes(db):
+    created = []
+    for name, models in indexes.items():
+        created += db[name].create_indexes(models)
+    return created
+
+
+# Bring the database up to `schema_version`; returns the version it started from
+def upgrade(db, echo=print):
+    start = current_version(db)
+    apply_validators(db)
+    echo("Validators applied.")
+    for name in apply_capped_collections(db):
+        echo(f"Capped collection created: {name}")
+    for index in apply_indexes(db):
+        echo(f"Index ensured: {index}")
+    for version, description, migrate in data_migrations:
+        if version > start:
+            echo(f"Migrating to version {version}: {description}")
+            migrate(db, echo)
+    db.meta.update_one(
+        {"_id": "schema"},
+        {"$set": {"version": schema_version, "applied_at": datetime.now()}},
+        upsert=True,
+    )
+    echo(f"Schema at version {schema_version} (was {start}).")
+    return start
+
+
+# Cheap check: one read, no admin commands
+def check_schema(app, db):
+    version = current_version(db)
+    if version < schema_version:
+        app.logger.warning("Database schema is at version %s, expected %s. Run `flask db upgrade`.",
+                           version, schema_version)
+
+
+# A before_request hook running check_schema once per process
+def deferred_schema_check(app, mongo):
+    checked = False
+
+    def check():
+        nonlocal checked
+        if checked or mongo.db is None:
+            return
+        checked = True
+        try:
+            check_schema(app, mongo.db)
+        except PyMongoError:
+            app.logger.warning("Could not check the database schema", exc_info=True)
+    return check
+
+
+db_cli = AppGroup("db", help="Database provisioning.")
+
+
+@db_cli.command("upgrade")
+@with_appcontext
+def upgrade_command():
+    """Apply validators, indexes and pending data migrations."""
+    from flaskblog import mongo
+    try:
+        upgrade(mongo.db, echo=click.echo)
+    except OperationFailure as error:
+        # e.g. duplicate emails blocking a unique index
+        raise click.ClickException(f"Provisioning failed: {error}")
+
+
+@db_cli.command("status")
+@with_appcontext
+def status_command():
+    """Show the recorded schema version."""
+    from flaskblog import mongo
+    version = current_version(mongo.db)
+    state = "up to date" if version >= schema_version else "upgrade needed"
+    click.echo(f"Schema version {version}, code expects {schema_version} ({state}).")
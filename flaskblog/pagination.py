@@ -0,0 +1,104 @@
+# Keyset (cursor) pagination helpers
+import base64
+import calendar
+import json
+import time
+from datetime import datetime, timedelta
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+
+EPOCH = datetime(1970, 1, 1)
+
+
+# Convert a (naive UTC) datetime coming back from Mongo to milliseconds and back
+def _to_millis(date):
+    return calendar.timegm(date.utctimetuple()) * 1000 + date.microsecond // 1000
+
+
+def _from_millis(millis):
+    return EPOCH + timedelta(milliseconds=millis)
+
+
+# Build an opaque token pointing at a post, e.g. the last post of a page
+def encode_cursor(post, direction, sort):
+    payload = {"d": _to_millis(post["date_posted"]), "i": str(post["_id"]), "dir": direction, "s": sort}
+    raw = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+# Decode a token back to (date_posted, _id, direction, sort), or None if it is invalid
+def decode_cursor(token):
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        payload = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        direction = payload["dir"]
+        if direction not in ("next", "prev"):
+            return None
+        return _from_millis(int(payload["d"])), ObjectId(payload["i"]), direction, payload["s"]
+    except (ValueError, KeyError, TypeError, InvalidId):
+        return None
+
+
+# Sort spec for the feed, with _id as a tie breaker so the order is total
+def keyset_sort(descending, direction="next"):
+    order = -1 if descending == (direction == "next") else 1
+    return [("date_posted", order), ("_id", order)]
+
+
+# Filter selecting the posts that come after (or before) the cursor position
+def keyset_filter(date_posted, post_id, descending, direction="next"):
+    op = "$lt" if descending == (direction == "next") else "$gt"
+    return {
+        "$or": [
+            {"date_posted": {op: date_posted}},
+            {"date_posted": date_posted, "_id": {op: post_id}},
+        ]
+    }
+
+
+# Split a fetched window of limit + 1 posts into (posts, has_more)
+def trim_window(posts, limit, direction="next"):
+    has_more = len(posts) > limit
+    posts = posts[:limit]
+    if direction == "prev":
+        posts.reverse()
+    return posts, has_more
+
+
+# Cached estimate of the collection size, refreshed at most every `ttl` seconds
+_count_cache = {}
+
+
+def _cached_total(name):
+    cached = _count_cache.get(name)
+    if cached and cached[1] > time.monotonic():
+        return cached[0]
+    return None
+
+
+def estimated_total(collection, ttl=60):
+    total = _cached_total(collection.name)
+    if total is None:
+        total = collection.estimated_document_count()
+        _count_cache[collection.name] = (total, time.monotonic() + ttl)
+    return total
+
+
+async def estimated_total_async(collection, ttl=60):
+    total = _cached_total(collection.name)
+    if total is None:
+        total = await collection.estimated_document_count()
+        _count_cache[collection.name] = (total, time.monotonic() + ttl)
+    return total
+
+
+# Opaque cursor over a plain _id ordering, used by the API exports
+def encode_id_cursor(object_id):
+    return base64.urlsafe_b64encode(object_id.binary).decode("ascii").rstrip("=")
+
+
+def decode_id_cursor(token):
+    try:
+        return ObjectId(base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)))
+    except (ValueError, TypeError, InvalidId):
+        return None
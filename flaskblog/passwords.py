@@ -0,0 +1,161 @@
+# Password hashing
+#
+# bcrypt runs in a small process pool, so a burst of logins can only occupy
+# PASSWORD_WORKERS cores and the request threads stay free for the feed.
+# At most PASSWORD_QUEUE_SIZE hashes may be in flight; beyond that requests
+# are turned away with a 503 and Retry-After instead of queueing behind each
+# other. The cost (BCRYPT_LOG_ROUNDS) is picked with `flask passwords
+# calibrate`, and hashes of another cost are upgraded after the next
+# successful login.
+import asyncio
+import os
+import threading
+import time
+import click
+from flask.cli import AppGroup
+from werkzeug.exceptions import ServiceUnavailable
+
+
+# Run in the worker processes
+def hash_password(password, rounds):
+    import bcrypt
+    return bcrypt.hashpw(password.encode("utf-8"), bcrypt.gensalt(rounds)).decode("utf-8")
+
+
+def check_password(hashed, password):
+    import bcrypt
+    try:
+        return bcrypt.checkpw(password.encode("utf-8"), hashed.encode("utf-8"))
+    except ValueError:  # not a bcrypt hash
+        return False
+
+
+# Cost of a "$2b$12$..." hash
+def hash_rounds(hashed):
+    try:
+        return int(hashed.split("$")[2])
+    except (IndexError, ValueError):
+        return None
+
+
+class PasswordHasherBusy(ServiceUnavailable):
+    description = "Too many sign-ins are being processed right now. Please try again in a moment."
+
+
+class PasswordHasher:
+    def __init__(self):
+        self.rounds = 12
+        self.workers = 2
+        self.queue_size = 16
+        self.retry_after = 2
+        self.completed = 0
+        self.rejected = 0
+        self.upgraded = 0
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.rounds = app.config.get("BCRYPT_LOG_ROUNDS", self.rounds)
+        self.workers = app.config.get("PASSWORD_WORKERS", self.workers)
+        self.queue_size = app.config.get("PASSWORD_QUEUE_SIZE", self.queue_size)
+        self.retry_after = app.config.get("PASSWORD_RETRY_AFTER", self.retry_after)
+        self._slots = threading.BoundedSemaphore(self.queue_size)
+        app.cli.add_command(passwords_cli)
+
+    # The pool is created lazily, once per process, so forked workers get their own
+    @property
+    def executor(self):
+        with self._lock:
+            if self._pid != os.getpid():
+                # multiprocessing is only imported once there is work for it
+                from concurrent.futures import ProcessPoolExecutor
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    # Queue a job if there is room, raising PasswordHasherBusy otherwise
+    def _submit(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            self.rejected += 1
+            raise PasswordHasherBusy(retry_after=self.retry_after)
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, future):
+        self._slots.release()
+        self.completed += 1
+
+    def hash(self, password):
+        return self._submit(hash_password, password, self.rounds).result()
+
+    def check(self, hashed, password):
+        return self._submit(check_password, hashed, password).result()
+
+    async def hash_async(self, password):
+        return await asyncio.wrap_future(self._submit(hash_password, password, self.rounds))
+
+    async def check_async(self, hashed, password):
+        return await asyncio.wrap_future(self._submit(check_password, hashed, password))
+
+    def needs_rehash(self, hashed):
+        return hash_rounds(hashed) != self.rounds
+
+    # After a successful login, re-hash a password stored with another cost.
+    # Best effort and off the request path: skipped when the pool is busy.
+    def upgrade(self, user, password, users):
+        if not self.needs_rehash(user["password"]):
+            return
+        try:
+            future = self._submit(hash_password, password, self.rounds)
+        except PasswordHasherBusy:
+            return
+
+        def store(future):
+            if future.exception() is None:
+                # Only replace the hash we verified, the password may have changed since
+                users.update_one({"_id": user["_id"], "password": user["password"]},
+                                 {"$set": {"password": future.result()}})
+                self.upgraded += 1
+        future.add_done_callback(store)
+
+    def stats(self):
+        return {"rounds": self.rounds, "workers": self.workers, "queue_size": self.queue_size,
+                "completed": self.completed, "rejected": self.rejected, "upgraded": self.upgraded}
+
+
+# Time one hash at the given cost, in seconds (best of `samples`)
+def measure(rounds, samples=3):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        hash_password("calibration-password", rounds)
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+passwords_cli = AppGroup("passwords", help="Password hashing maintenance.")
+
+
+@passwords_cli.command("calibrate")
+@click.option("--target-ms", default=250, show_default=True, help="Hash time to aim for on this machine.")
+@click.option("--min-rounds", default=10, show_default=True)
+@click.option("--max-rounds", default=16, show_default=True)
+def calibrate_command(target_ms, min_rounds, max_rounds):
+    """Pick the bcrypt cost whose hash time is closest to the target."""
+    best = None
+    for rounds in range(min_rounds, max_rounds + 1):
+        elapsed = measure(rounds) * 1000
+        click.echo(f"rounds={rounds:<3} {elapsed:8.1f} ms")
+        if best is None or abs(elapsed - target_ms) < abs(best[1] - target_ms):
+            best = (rounds, elapsed)
+        # Every extra round doubles the time, nothing further can be closer
+        if elapsed > target_ms:
+            break
+    click.echo(f"\nBCRYPT_LOG_ROUNDS={best[0]}  (~{best[1]:.0f} ms per hash)")
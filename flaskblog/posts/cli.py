@@ -0,0 +1,35 @@
+import click
+from bson.objectid import ObjectId
+from flask.cli import AppGroup, with_appcontext
+
+posts_cli = AppGroup("posts", help="Post maintenance.")
+
+
+@posts_cli.command("backfill-authors")
+@click.option("--author", help="Only this author's posts (user id).")
+@with_appcontext
+def backfill_authors(author):
+    """Embed (or refresh) the author snapshot on existing posts."""
+    from flaskblog import mongo, author_fanout
+    query = {"_id": ObjectId(author)} if author else {}
+    for user in mongo.db.users.find(query, {"username": 1, "image": 1}):
+        job_id = author_fanout.schedule(user["_id"], user, background=False)
+        author_fanout.run(job_id, progress=lambda updated, total: click.echo(
+            f"\r{user['username']}: {updated}/{total} posts", nl=False))
+        click.echo(f"\r{user['username']}: done{' ' * 20}")
+
+
+@posts_cli.command("backfill-summaries")
+@click.option("--batch-size", default=500, show_default=True)
+@click.option("--force", is_flag=True, help="Render every post, even those already up to date.")
+@with_appcontext
+def backfill_summaries_command(batch_size, force):
+    """Store the excerpt, reading time and rendered HTML on existing posts."""
+    from flaskblog import mongo, change_feed
+    from flaskblog.summaries import backfill_summaries
+    checked, updated = backfill_summaries(mongo.db.posts, batch_size, force, progress=lambda checked, updated: click.echo(
+        f"\r{checked} checked, {updated} updated", nl=False))
+    click.echo(f"\r{checked} checked, {updated} updated.{' ' * 20}")
+    if updated:
+        # Running workers drop the pages rendered from the old summaries
+        change_feed.publish_reset()
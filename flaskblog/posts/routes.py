@@ -1,9 +1,15 @@
-from flask import Blueprint, render_template, url_for, flash, redirect, request, jsonify, current_app
+from flask import Blueprint, render_template, url_for, flash, redirect, request, current_app
 from flaskblog.posts.forms import ( AddPostForm, UpdatePostForm)
 from datetime import datetime
 from bson.objectid import ObjectId
 from flask_login import  current_user, login_required
-from flaskblog import mongo
+from flaskblog import mongo, database, async_database, response_cache, rate_limiter, change_feed
+from flaskblog.ratelimit import signed_in_user
+from flaskblog.queries import fetch_posts, fetch_posts_async, attach_authors, attach_authors_async, post_page_fields
+from flaskblog.export import export_args, export_query_args, stream_export, stream_export_async
+from flaskblog.asgi import async_view
+from flaskblog.fanout import author_snapshot
+from flaskblog.summaries import summarize
 posts_blueprint = Blueprint("posts", __name__)
 
 
@@ -11,19 +17,19 @@ posts_blueprint = Blueprint("posts", __name__)
 
 # Add a new post
 @posts_blueprint.route('/posts/add', methods=['GET', 'POST'])
+@login_required
+@rate_limiter.limit(account=signed_in_user)
 def add_post():
     form = AddPostForm()
     if form.validate_on_submit():
         data = request.form
         user_id = ObjectId(current_user.id)  # Ensure author is a valid ObjectId
-        post = {"author": user_id, "title": data["title"], "content": data["content"], "date_posted": datetime.now()}
+        post = {"author": user_id, "title": data["title"], "content": data["content"], "date_posted": datetime.now(),
+                "author_details": author_snapshot({"username": current_user.username, "image": current_user.image})}
+        post.update(summarize(post["content"]))
         # Add the new post
-        post_id = mongo.db.posts.insert_one(post).inserted_id
-        # Update the user's posts array
-        mongo.db.users.update_one(
-            {"_id": user_id},
-            {"$push": {"posts": post_id}}
-        )
+        mongo.db.posts.insert_one(post)
+        change_feed.publish("posts", "insert", post)
         flash(f"Post added successfully!", category="success")
         return redirect(url_for("main.home"))
     elif request.method == "GET":
@@ -33,67 +39,52 @@ def add_post():
     
 
 # Get a post by id
-# Route for individual post
-@posts_blueprint.route("/post/<post_id>")
-def post(post_id):
-    # Fetch the post by its ID and join with the users collection to get author details
-    post = list(mongo.db.posts.aggregate([
-        {
-            "$match": {"_id": ObjectId(post_id)}  # Match the post by its ID
-        },
-        {
-            "$lookup": {
-                "from": "users",
-                "localField": "author",
-                "foreignField": "_id",
-                "as": "author_details"
-            }
-        },
-        {"$unwind": "$author_details"},  # Flatten the author details array
-        {
-            "$project": {
-                "_id": 1,
-                "title": 1,
-                "content": 1,
-                "date_posted": 1,
-                "author_details.username": 1
-            }
-        }
-    ]))
-
-    if not post:
+def render_post(posts):
+    if not posts:
         flash("Post not found!", category="danger")
         return redirect(url_for("main.home"))
 
     # Since aggregation returns a list, take the first (and only) result
-    post = post[0]
-    return render_template("post.html", post=post)
+    return render_template("post.html", post=posts[0])
+
+# Route for individual post
+@posts_blueprint.route("/post/<post_id>")
+@response_cache.cached(tags=lambda post_id: [f"post:{post_id}", "users"])
+def post(post_id):
+    # Fetch the post by its ID along with its author details
+    return render_post(fetch_posts({"_id": ObjectId(post_id)}, limit=1, fields=post_page_fields))
+
+@async_view("posts.post")
+@response_cache.cached(tags=lambda post_id: [f"post:{post_id}", "users"])
+async def post_async(post_id):
+    return render_post(await fetch_posts_async({"_id": ObjectId(post_id)}, limit=1, fields=post_page_fields))
 
 # Get all posts
+def posts_export_args():
+    limit, after, fields, export_format = export_args(
+        ("_id", "title", "content", "date_posted", "author"), ("title", "content", "date_posted", "author"))
+    projection = {field: 1 for field in fields}
+    projection.setdefault("_id", 0)
+    return limit, after, fields, export_format, projection
+
 @posts_blueprint.route('/api/posts', methods=['GET'])
+@response_cache.conditional(tags=lambda: ["feed", "users"], query_args=export_query_args, headers=("Accept",))
 def get_all_posts():
-    posts = list(mongo.db.posts.aggregate([
-        {
-            "$lookup": {
-                "from": "users",
-                "localField": "author",
-                "foreignField": "_id",
-                "as": "author_details"
-            }
-        },
-        {"$unwind": "$author_details"},  # Flatten the author details array
-        {
-            "$project": {
-                "_id": 0,
-                "title": 1,
-                "content": 1,
-                "date_posted": 1,
-                "author_details.username": 1,
-                "author_details.email": 1
-            }
-        }
-    ]))
-    return jsonify(posts)
+    limit, after, fields, export_format, projection = posts_export_args()
+    transform = None
+    if "author" in fields:
+        # Resolve the authors of each streamed chunk with one batched query
+        transform = lambda chunk: attach_authors(chunk, ("username", "email"))
+    return stream_export(database.db.posts, projection, limit, after, export_format, transform)
+
+@async_view("posts.get_all_posts")
+@response_cache.conditional(tags=lambda: ["feed", "users"], query_args=export_query_args, headers=("Accept",))
+async def get_all_posts_async():
+    limit, after, fields, export_format, projection = posts_export_args()
+    transform = None
+    if "author" in fields:
+        transform = lambda chunk: attach_authors_async(chunk, ("username", "email"))
+    return await stream_export_async(async_database.db.posts, projection, limit, after, export_format, transform)
 
 # Update a post
 @posts_blueprint.route("/post/<post_id>/update", methods=["GET", "POST"])
@@ -115,10 +106,12 @@ def update_post(post_id):
         # Update the post
         title = request.form.get("title")
         content = request.form.get("content")
+        changes = {"title": title, "content": content, **summarize(content, post)}
         mongo.db.posts.update_one(
             {"_id": ObjectId(post_id)},
-            {"$set": {"title": title, "content": content}}
+            {"$set": changes}
         )
+        change_feed.publish("posts", "update", {"_id": ObjectId(post_id), **changes})
         flash("Post updated successfully!", category="success")
         return redirect(url_for("posts.post", post_id=post_id))
 
@@ -146,12 +139,7 @@ def delete_post(post_id):
 
         # Delete the post
         mongo.db.posts.delete_one({"_id": ObjectId(post_id)})
-        
-        # Remove the post reference from the user's posts array
-        mongo.db.users.update_one(
-            {"_id": ObjectId(current_user.id)},
-            {"$pull": {"posts": ObjectId(post_id)}}
-        )
+        change_feed.publish("posts", "delete", {"_id": ObjectId(post_id)})
         
         flash("Post deleted successfully!", category="success")
         return redirect(url_for("main.home"))
@@ -0,0 +1,98 @@
+# Process-local cache of user profiles (the fields needed to render a user)
+import threading
+import time
+from collections import OrderedDict
+from bson.objectid import ObjectId
+
+profile_fields = ("username", "email", "image", "session_epoch")
+
+
+class ProfileCache:
+    def __init__(self, mongo, maxsize=1024, ttl=300):
+        self.mongo = mongo
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def init_app(self, app):
+        self.maxsize = app.config.get("PROFILE_CACHE_SIZE", self.maxsize)
+        self.ttl = app.config.get("PROFILE_CACHE_TTL", self.ttl)
+        self.clear()
+
+    # Look up a cached profile, counting the hit or miss
+    def _lookup(self, user_id):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is not None and entry[1] > time.monotonic():
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self._entries[user_id]
+            self.misses += 1
+            return None
+
+    def _store(self, profile):
+        with self._lock:
+            self._entries[profile["_id"]] = (profile, time.monotonic() + self.ttl)
+            self._entries.move_to_end(profile["_id"])
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    # Get a single profile, loading it from Mongo on a miss
+    def get(self, user_id):
+        user_id = ObjectId(user_id)
+        profile = self._lookup(user_id)
+        if profile is None:
+            profile = self.mongo.db.users.find_one({"_id": user_id}, {field: 1 for field in profile_fields})
+            if profile is not None:
+                self._store(profile)
+        return profile
+
+    # Split ids into cached profiles and the ids still to load
+    def _lookup_many(self, user_ids):
+        profiles, missing = {}, []
+        for user_id in {ObjectId(user_id) for user_id in user_ids}:
+            profile = self._lookup(user_id)
+            if profile is None:
+                missing.append(user_id)
+            else:
+                profiles[user_id] = profile
+        return profiles, missing
+
+    # Get several profiles at once, loading all misses with a single $in query
+    def get_many(self, user_ids):
+        profiles, missing = self._lookup_many(user_ids)
+        if missing:
+            for profile in self.mongo.db.users.find({"_id": {"$in": missing}}, {field: 1 for field in profile_fields}):
+                self._store(profile)
+                profiles[profile["_id"]] = profile
+        return profiles
+
+    # Same as get_many, loading the misses through an async `users` collection
+    async def get_many_async(self, user_ids, users):
+        profiles, missing = self._lookup_many(user_ids)
+        if missing:
+            async for profile in users.find({"_id": {"$in": missing}}, {field: 1 for field in profile_fields}):
+                self._store(profile)
+                profiles[profile["_id"]] = profile
+        return profiles
+
+    # Drop a profile after the user document changed
+    def invalidate(self, user_id):
+        with self._lock:
+            self._entries.pop(ObjectId(user_id), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions}
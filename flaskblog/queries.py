@@ -0,0 +1,169 @@
+# Shared query builders for the post listings
+from flask import current_app
+from flaskblog import database, async_database, profile_cache
+from flaskblog.profiles import profile_fields
+from flaskblog.fanout import snapshot_fields
+
+# Post fields rendered by the feed and post pages
+post_fields = ("_id", "title", "content", "date_posted")
+# Feed cards show the stored excerpt, never the full content
+feed_fields = ("_id", "title", "excerpt", "reading_time", "date_posted")
+# The post page shows the stored HTML; content is the fallback for posts not yet summarized
+post_page_fields = ("_id", "title", "content", "content_html", "reading_time", "date_posted")
+# Shown for posts whose author no longer exists, so pages stay full
+deleted_author = {"username": "[deleted]"}
+
+
+def placeholder_author(author_fields):
+    return {field: deleted_author.get(field) for field in author_fields}
+
+
+# Build a pipeline that matches, sorts and limits posts first and only
+# then joins the authors of the posts that survived
+def post_pipeline(match=None, sort=None, skip=0, limit=None, fields=post_fields,
+                  author_fields=("username",), join=True):
+    pipeline = []
+    if match:
+        pipeline.append({"$match": match})
+    if sort:
+        pipeline.append({"$sort": dict(sort)})
+    if skip:
+        pipeline.append({"$skip": skip})
+    if limit:
+        pipeline.append({"$limit": limit})
+
+    projection = {field: 1 for field in fields}
+    if "excerpt" in fields:
+        # Posts not summarized yet (bulk imports, other writers) show the start of their content
+        length = current_app.config["POST_EXCERPT_LENGTH"]
+        projection["excerpt"] = {"$ifNull": ["$excerpt", {"$substrCP": [{"$ifNull": ["$content", ""]}, 0, length]}]}
+    if "_id" not in fields:
+        projection["_id"] = 0
+    if join:
+        pipeline += [
+            {
+                "$lookup": {
+                    "from": "users",
+                    "localField": "author",
+                    "foreignField": "_id",
+                    "as": "author_details"
+                }
+            },
+            # Flatten the author details array, keeping posts without an author
+            {"$unwind": {"path": "$author_details", "preserveNullAndEmptyArrays": True}},
+        ]
+        projection.update({f"author_details.{field}": 1 for field in author_fields})
+    else:
+        # Keep the reference so the authors can be resolved afterwards
+        projection["author"] = 1
+    pipeline.append({"$project": projection})
+    if join:
+        pipeline.append({"$addFields": {"author_details": {
+            "$ifNull": ["$author_details", {"$literal": placeholder_author(author_fields)}]}}})
+    return pipeline
+
+
+# Copy the resolved author fields onto the posts, with the placeholder for
+# authors that no longer exist, like the $lookup join does
+def _apply_authors(posts, authors, author_fields):
+    for post in posts:
+        author = authors.get(post.pop("author"))
+        if author is None:
+            post["author_details"] = placeholder_author(author_fields)
+        else:
+            post["author_details"] = {field: author.get(field) for field in author_fields}
+    return posts
+
+
+# Resolve the authors of a page of posts with a single $in query, served
+# from the profile cache where possible
+def attach_authors(posts, author_fields=("username",)):
+    author_ids = {post["author"] for post in posts}
+    if not author_ids:
+        return posts
+    if set(author_fields) <= set(profile_fields):
+        authors = profile_cache.get_many(author_ids)
+    else:
+        authors = {
+            user["_id"]: user
+            for user in database.db.users.find({"_id": {"$in": list(author_ids)}}, {field: 1 for field in author_fields})
+        }
+    return _apply_authors(posts, authors, author_fields)
+
+
+async def attach_authors_async(posts, author_fields=("username",)):
+    author_ids = {post["author"] for post in posts}
+    if not author_ids:
+        return posts
+    users = async_database.db.users
+    if set(author_fields) <= set(profile_fields):
+        authors = await profile_cache.get_many_async(author_ids, users)
+    else:
+        authors = {
+            user["_id"]: user
+            async for user in users.find({"_id": {"$in": list(author_ids)}}, {field: 1 for field in author_fields})
+        }
+    return _apply_authors(posts, authors, author_fields)
+
+
+# Split a page into posts carrying a usable author snapshot and posts
+# written before snapshots existed (or missing a requested field)
+def _split_embedded(posts, author_fields):
+    embedded, missing = [], []
+    for post in posts:
+        snapshot = post.get("author_details") or {}
+        if all(field in snapshot for field in author_fields):
+            post.pop("author")
+            embedded.append(post)
+        else:
+            missing.append(post)
+    return embedded, missing
+
+
+# Use the author snapshot embedded in the posts, resolving only the posts without one
+def use_embedded_authors(posts, author_fields=("username",)):
+    embedded, missing = _split_embedded(posts, author_fields)
+    if missing:
+        attach_authors(missing, author_fields)
+    return posts
+
+
+async def use_embedded_authors_async(posts, author_fields=("username",)):
+    embedded, missing = _split_embedded(posts, author_fields)
+    if missing:
+        await attach_authors_async(missing, author_fields)
+    return posts
+
+
+# Pick the author resolution and build the pipeline for fetch_posts
+def _plan_fetch(match, sort, skip, limit, fields, author_fields, resolution):
+    resolution = resolution or current_app.config["AUTHOR_RESOLUTION"]
+    if resolution == "embedded" and not set(author_fields) <= set(snapshot_fields):
+        resolution = "batch"
+    if resolution == "embedded":
+        fields = tuple(fields) + ("author_details",)
+    pipeline = post_pipeline(match, sort, skip, limit, fields, author_fields, join=resolution == "lookup")
+    return resolution, pipeline
+
+
+# Fetch posts with their author details, from the embedded snapshot, $lookup or batched resolution
+def fetch_posts(match=None, sort=None, skip=0, limit=None, fields=post_fields,
+                author_fields=("username",), resolution=None):
+    resolution, pipeline = _plan_fetch(match, sort, skip, limit, fields, author_fields, resolution)
+    posts = list(database.db.posts.aggregate(pipeline))
+    if resolution == "embedded":
+        posts = use_embedded_authors(posts, author_fields)
+    elif resolution != "lookup":
+        posts = attach_authors(posts, author_fields)
+    return posts
+
+
+async def fetch_posts_async(match=None, sort=None, skip=0, limit=None, fields=post_fields,
+                            author_fields=("username",), resolution=None):
+    resolution, pipeline = _plan_fetch(match, sort, skip, limit, fields, author_fields, resolution)
+    posts = await (await async_database.db.posts.aggregate(pipeline)).to_list(None)
+    if resolution == "embedded":
+        posts = await use_embedded_authors_async(posts, author_fields)
+    elif resolution != "lookup":
+        posts = await attach_authors_async(posts, author_fields)
+    return posts
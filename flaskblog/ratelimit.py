@@ -0,0 +1,201 @@
+# Rate limiting for the expensive write paths
+#
+# Each limited endpoint has token buckets per client IP, per account (the
+# email typed into a form, or the signed-in user) and one for the endpoint
+# as a whole. A request takes a token from each; when one is empty it is
+# refused with 429 and a Retry-After of the time until the next token. The
+# endpoint bucket caps the total bcrypt, SMTP and Mongo write load, so a
+# spread-out attack can't starve the read paths either. Views limited with
+# charge_account="failure" (login) only check the account bucket up front and
+# take its token when the attempt fails, so a user signing in correctly is
+# never locked out of their own account.
+#
+# Limits are written "<scope>=<count>/<period>", e.g.
+# "ip=20/minute;account=5/minute;endpoint=600/minute": a bucket holds
+# <count> tokens and refills at <count> per <period>.
+import inspect
+import math
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from flask import request
+from flask_login import current_user
+from werkzeug.exceptions import TooManyRequests
+
+periods = {"second": 1, "minute": 60, "hour": 3600, "day": 86400}
+scopes = ("ip", "account", "endpoint")
+
+
+class RateLimited(TooManyRequests):
+    description = "Too many requests. Please wait a moment before trying again."
+
+
+# "ip=20/minute;account=5/minute" -> {"ip": (20, 20 / 60), "account": (5, 5 / 60)}
+def parse_limits(spec):
+    limits = {}
+    for part in filter(None, (part.strip() for part in spec.split(";"))):
+        scope, _, rate = part.partition("=")
+        count, _, period = rate.partition("/")
+        if scope not in scopes or period not in periods:
+            raise ValueError(f"Invalid rate limit {part!r}")
+        limits[scope] = (int(count), int(count) / periods[period])
+    return limits
+
+
+class MemoryBackend:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Take `cost` tokens (0 only checks), returning 0 or the seconds until
+    # one is available
+    def consume(self, key, capacity, rate, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * rate)
+            retry_after = 0
+            if tokens >= 1:
+                tokens -= cost
+            else:
+                retry_after = (1 - tokens) / rate
+            self._buckets[key] = (tokens, now)
+            self._buckets.move_to_end(key)
+            # A forgotten bucket is simply full again
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return retry_after
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Same bucket as a Redis hash, updated atomically with the server's clock so
+# every node shares the limits
+consume_script = """
+local now = redis.call("TIME")
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local cost = tonumber(ARGV[3])
+local state = redis.call("HMGET", KEYS[1], "tokens", "updated")
+local tokens = tonumber(state[1]) or capacity
+local updated = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated) * rate)
+local retry_after = 0
+if tokens >= 1 then
+    tokens = tokens - cost
+else
+    retry_after = (1 - tokens) / rate
+end
+redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+redis.call("EXPIRE", KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(retry_after)
+"""
+
+
+class RedisBackend:
+    def __init__(self, url, prefix="flaskblog:ratelimit:"):
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self._consume = self.client.register_script(consume_script)
+
+    def consume(self, key, capacity, rate, cost=1):
+        return float(self._consume(keys=[self.prefix + key], args=[capacity, rate, cost]))
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + "*"):
+            self.client.delete(key)
+
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = MemoryBackend()
+        self.enabled = True
+        self.rules = {}
+        self.allowed = 0
+        self.limited = dict.fromkeys(scopes, 0)
+        self.errors = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get("RATELIMIT_ENABLED", True)
+        if app.config.get("RATELIMIT_BACKEND", "memory") == "redis":
+            self.backend = RedisBackend(app.config["RATELIMIT_URL"])
+        else:
+            self.backend = MemoryBackend()
+        self.rules = {endpoint: parse_limits(spec) for endpoint, spec in app.config.get("RATELIMIT_RULES", {}).items()}
+
+    # Raise RateLimited when one of the endpoint's buckets is empty. With
+    # charge_account="failure" the account bucket is only checked here.
+    def check(self, account=None, charge_account="always"):
+        limits = self.rules.get(request.endpoint)
+        if not self.enabled or not limits:
+            return
+        keys = {"ip": request.remote_addr or "unknown", "account": account, "endpoint": ""}
+        for scope, (capacity, rate) in limits.items():
+            if keys[scope] is None:
+                continue
+            cost = 0 if scope == "account" and charge_account == "failure" else 1
+            try:
+                retry_after = self.backend.consume(f"{request.endpoint}:{scope}:{keys[scope]}", capacity, rate, cost)
+            except Exception:
+                # The shared store being down must not take sign-ins with it
+                self.errors += 1
+                continue
+            if retry_after:
+                self.limited[scope] += 1
+                raise RateLimited(retry_after=math.ceil(retry_after))
+        self.allowed += 1
+
+    # Charge a failed attempt (a wrong password) to the account's bucket
+    def record_failure(self, account):
+        limits = self.rules.get(request.endpoint)
+        if not self.enabled or not limits or account is None or "account" not in limits:
+            return
+        capacity, rate = limits["account"]
+        try:
+            self.backend.consume(f"{request.endpoint}:account:{account}", capacity, rate)
+        except Exception:
+            self.errors += 1
+
+    # Limit a view (plain or coroutine) for the given methods. `account`
+    # returns the account a request acts on, or None; `charge_account` is
+    # "always" or "failure" (the view calls record_failure).
+    def limit(self, account=None, methods=("POST",), charge_account="always"):
+        def identify():
+            return account() if account else None
+
+        def decorator(view):
+            if inspect.iscoroutinefunction(view):
+                @wraps(view)
+                async def async_wrapper(**kwargs):
+                    if request.method in methods:
+                        self.check(identify(), charge_account)
+                    return await view(**kwargs)
+                return async_wrapper
+
+            @wraps(view)
+            def wrapper(**kwargs):
+                if request.method in methods:
+                    self.check(identify(), charge_account)
+                return view(**kwargs)
+            return wrapper
+        return decorator
+
+    def stats(self):
+        stats = {"allowed": self.allowed, "errors": self.errors}
+        stats.update({f"limited_{scope}": count for scope, count in self.limited.items()})
+        return stats
+
+
+# Account keys for the limited forms
+def form_email():
+    return request.form.get("email", "").strip().lower() or None
+
+
+def signed_in_user():
+    return current_user.id if current_user.is_authenticated else None
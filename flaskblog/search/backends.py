@@ -0,0 +1,244 @@
+# Full-text search backends over post titles and contents
+#
+# Both backends rank results and page them with a (score, _id) cursor.
+# "mongo" uses the posts text index; "memory" keeps an inverted index in
+# the process, built from one scan of the posts collection and then kept
+# up to date by the write routes.
+import base64
+import json
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from markupsafe import Markup, escape
+
+token_pattern = re.compile(r"\w+", re.UNICODE)
+stopwords = {"a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "in", "is", "it",
+             "of", "on", "or", "that", "the", "this", "to", "was", "with"}
+title_weight = 3
+snippet_length = 160
+
+
+def tokenize(text):
+    return [token for token in token_pattern.findall((text or "").lower()) if token not in stopwords]
+
+
+def encode_search_cursor(score, post_id):
+    raw = json.dumps({"s": score, "i": str(post_id)}, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_search_cursor(token):
+    try:
+        payload = json.loads(base64.urlsafe_b64decode((token + "=" * (-len(token) % 4)).encode("ascii")))
+        return float(payload["s"]), ObjectId(payload["i"])
+    except (ValueError, KeyError, TypeError, InvalidId):
+        return None
+
+
+# Cut a window of the content around the first matching term and mark the matches
+def highlight(text, terms, length=snippet_length):
+    text = text or ""
+    lowered = text.lower()
+    positions = [position for position in (lowered.find(term) for term in terms) if position >= 0]
+    start = max(min(positions) - length // 4, 0) if positions else 0
+    window = text[start:start + length]
+    if not terms:
+        return escape(window)
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    parts, last = [], 0
+    for match in pattern.finditer(window):
+        parts.append(escape(window[last:match.start()]))
+        parts.append(Markup("<mark>%s</mark>") % match.group(0))
+        last = match.end()
+    parts.append(escape(window[last:]))
+    snippet = Markup("").join(parts)
+    if start > 0:
+        snippet = Markup("&hellip;") + snippet
+    if start + length < len(text):
+        snippet += Markup("&hellip;")
+    return snippet
+
+
+class MongoTextBackend:
+    def __init__(self, database):
+        self.database = database
+
+    # Return [(score, post_id)] for one page, best first
+    def rank(self, query, limit, after=None):
+        pipeline = [
+            {"$match": {"$text": {"$search": query}}},
+            {"$project": {"score": {"$meta": "textScore"}}},
+        ]
+        if after is not None:
+            score, post_id = after
+            pipeline.append({"$match": {"$or": [{"score": {"$lt": score}},
+                                                {"score": score, "_id": {"$lt": post_id}}]}})
+        pipeline += [{"$sort": {"score": -1, "_id": -1}}, {"$limit": limit}]
+        return [(row["score"], row["_id"]) for row in self.database.db.posts.aggregate(pipeline)]
+
+    def index_post(self, post):
+        pass
+
+    def remove_post(self, post_id):
+        pass
+
+    def refresh_post(self, post_id):
+        pass
+
+    def reset(self):
+        pass
+
+    def stats(self):
+        return {"backend": "mongo"}
+
+
+class InvertedIndexBackend:
+    k1 = 1.2
+    b = 0.75
+
+    def __init__(self, database):
+        self.database = database
+        self._lock = threading.RLock()
+        self._built = False
+        self._postings = defaultdict(dict)  # term -> {post_id: term frequency}
+        self._lengths = {}                  # post_id -> document length
+        self._terms = {}                    # post_id -> terms, to remove a post
+
+    def _build(self):
+        with self._lock:
+            if self._built:
+                return
+            for post in self.database.db.posts.find({}, {"title": 1, "content": 1}):
+                self._add(post)
+            self._built = True
+
+    def _add(self, post):
+        counts = Counter(tokenize(post.get("content")))
+        for term in tokenize(post.get("title")):
+            counts[term] += title_weight
+        for term, frequency in counts.items():
+            self._postings[term][post["_id"]] = frequency
+        self._lengths[post["_id"]] = sum(counts.values())
+        self._terms[post["_id"]] = list(counts)
+
+    def _remove(self, post_id):
+        for term in self._terms.pop(post_id, ()):
+            postings = self._postings.get(term)
+            if postings is not None:
+                postings.pop(post_id, None)
+                if not postings:
+                    del self._postings[term]
+        self._lengths.pop(post_id, None)
+
+    # Incremental updates, fed by the change feed (flaskblog/events.py)
+    def index_post(self, post):
+        with self._lock:
+            if self._built:
+                self._remove(post["_id"])
+                self._add(post)
+
+    def remove_post(self, post_id):
+        with self._lock:
+            if self._built:
+                self._remove(ObjectId(post_id))
+
+    # Re-read a post changed by another worker
+    def refresh_post(self, post_id):
+        if not self._built:
+            return
+        post = self.database.db.posts.find_one({"_id": ObjectId(post_id)}, {"title": 1, "content": 1})
+        if post is None:
+            self.remove_post(post_id)
+        else:
+            self.index_post(post)
+
+    # Drop the index, it is rebuilt on the next search
+    def reset(self):
+        with self._lock:
+            self._postings.clear()
+            self._lengths.clear()
+            self._terms.clear()
+            self._built = False
+
+    # BM25 over the query terms
+    def rank(self, query, limit, after=None):
+        self._build()
+        with self._lock:
+            total = len(self._lengths)
+            if not total:
+                return []
+            average = sum(self._lengths.values()) / total
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                postings = self._postings.get(term)
+                if not postings:
+                    continue
+                idf = math.log(1 + (total - len(postings) + 0.5) / (len(postings) + 0.5))
+                for post_id, frequency in postings.items():
+                    norm = self.k1 * (1 - self.b + self.b * self._lengths[post_id] / average)
+                    scores[post_id] += idf * frequency * (self.k1 + 1) / (frequency + norm)
+        ranked = sorted(((score, post_id) for post_id, score in scores.items()), reverse=True)
+        if after is not None:
+            ranked = [entry for entry in ranked if entry < after]
+        return ranked[:limit]
+
+    def stats(self):
+        with self._lock:
+            return {"backend": "memory", "built": self._built, "documents": len(self._lengths),
+                    "terms": len(self._postings)}
+
+
+class SearchService:
+    def __init__(self, database):
+        self.database = database
+        self.backend = MongoTextBackend(database)
+
+    def init_app(self, app):
+        if app.config.get("SEARCH_BACKEND", "mongo") == "memory":
+            self.backend = InvertedIndexBackend(self.database)
+        else:
+            self.backend = MongoTextBackend(self.database)
+
+    def index_post(self, post):
+        self.backend.index_post(post)
+
+    def remove_post(self, post_id):
+        self.backend.remove_post(post_id)
+
+    def refresh_post(self, post_id):
+        self.backend.refresh_post(post_id)
+
+    def reset(self):
+        self.backend.reset()
+
+    def stats(self):
+        return self.backend.stats()
+
+    # One page of results: (posts with score and snippet, next cursor token)
+    def search(self, query, limit, cursor=None):
+        from flaskblog.queries import attach_authors
+        after = decode_search_cursor(cursor) if cursor else None
+        ranked = self.backend.rank(query, limit + 1, after)
+        has_more = len(ranked) > limit
+        ranked = ranked[:limit]
+        documents = {
+            post["_id"]: post
+            for post in self.database.db.posts.find(
+                {"_id": {"$in": [post_id for _, post_id in ranked]}},
+                {"title": 1, "content": 1, "date_posted": 1, "author": 1})
+        }
+        terms = tokenize(query)
+        results = []
+        for score, post_id in ranked:
+            post = documents.get(post_id)
+            if post is None:
+                continue
+            post["score"] = score
+            post["snippet"] = highlight(post.pop("content"), terms)
+            results.append(post)
+        results = attach_authors(results)
+        next_cursor = encode_search_cursor(*ranked[-1]) if has_more and ranked else None
+        return results, next_cursor
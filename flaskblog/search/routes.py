@@ -0,0 +1,40 @@
+from flask import Blueprint, render_template, request, jsonify, current_app, url_for
+from flaskblog import search_service
+
+search_blueprint = Blueprint("search", __name__)
+
+
+# Search page
+@search_blueprint.route("/search")
+def search():
+    query = request.args.get("q", "", type=str).strip()
+    results, next_cursor = [], None
+    if query:
+        results, next_cursor = search_service.search(
+            query, current_app.config["SEARCH_PAGE_SIZE"], request.args.get("cursor"))
+    next_url = url_for("search.search", q=query, cursor=next_cursor) if next_cursor else None
+    return render_template("search.html", title="Search", query=query, results=results, next_url=next_url)
+
+
+# Search API
+@search_blueprint.route("/api/search")
+def search_api():
+    query = request.args.get("q", "", type=str).strip()
+    if not query:
+        return jsonify({"error": "Missing query"}), 400
+    limit = min(request.args.get("limit", current_app.config["SEARCH_PAGE_SIZE"], type=int), 100)
+    results, next_cursor = search_service.search(query, max(limit, 1), request.args.get("cursor"))
+    return jsonify({
+        "results": [
+            {
+                "id": str(post["_id"]),
+                "title": post["title"],
+                "snippet": str(post["snippet"]),
+                "score": post["score"],
+                "date_posted": post["date_posted"],
+                "author": post["author_details"]["username"],
+            }
+            for post in results
+        ],
+        "next_cursor": next_cursor,
+    })
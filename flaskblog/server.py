@@ -0,0 +1,49 @@
+# Hooks for the preforking production server (see gunicorn.conf.py)
+#
+# The master imports the app once and forks the workers from it, so code,
+# config and compiled templates are shared copy-on-write. What must not be
+# shared is rebuilt in each worker right after the fork: the Mongo client
+# (the process pools and background threads of the other extensions already
+# start per process). Before a worker takes its first request it opens its
+# Mongo connections and starts its change feed and mail threads, so a fresh
+# deploy doesn't serve its first requests cold.
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+# Compile every template once, in the master
+def compile_templates(app):
+    env = app.jinja_env
+    names = [name for name in env.list_templates() if name.endswith(".html")]
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+# In each worker, right after the fork
+def after_fork(app):
+    from flaskblog import database
+    database.reinit(app)
+
+
+# In each worker, before it accepts requests
+def warm_up(app, connections=1):
+    from flaskblog import database, change_feed, mail_queue
+    started = time.perf_counter()
+    connections = max(connections, app.config.get("MONGO_MIN_POOL_SIZE", 0))
+    try:
+        database.prefill(connections)
+        with app.app_context():
+            if change_feed.enabled:
+                change_feed.start()
+            if mail_queue.enabled:
+                mail_queue.start()
+    except Exception:
+        # Mongo being down must not keep the worker from booting, requests
+        # will report it
+        logger.warning("Warm-up failed", exc_info=True)
+        return
+    logger.info("Worker warmed up in %.0f ms (%d connection(s))", (time.perf_counter() - started) * 1000,
+                connections)
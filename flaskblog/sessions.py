@@ -0,0 +1,270 @@
+# Server-side sessions
+#
+# The session cookie only carries a random id, the session itself lives in a
+# store: "sqlite" (a WAL database in the instance folder, shared by every
+# worker of the host) or "memory" (one process). SESSION_BACKEND = "cookie"
+# keeps Flask's signed cookie.
+#
+# Next to Flask-Login's keys the session holds a snapshot of the signed-in
+# user (id, username, email, image, session epoch) stamped with the user's
+# version in the store, so authenticated pages are served without reading
+# Mongo. Every change to a user, from any worker, bumps that version through
+# the change feed; a session with an older stamp, or one older than
+# SESSION_USER_TTL, reloads the profile once. A password reset bumps the
+# user's session epoch in Mongo, which turns away every session and
+# remember-me cookie issued before it.
+import os
+import pickle
+import random
+import secrets
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from flask import session
+from flask.sessions import SessionInterface, SessionMixin
+from flask_login import user_logged_in, user_logged_out
+from werkzeug.datastructures import CallbackDict
+
+snapshot_key = "_profile"
+
+
+def new_sid():
+    return secrets.token_urlsafe(32)
+
+
+# Flask-Login id "<user id>:<session epoch>" -> (user id, epoch), or None
+def parse_token(token):
+    user_id, _, epoch = (token or "").partition(":")
+    if not ObjectId.is_valid(user_id):
+        return None
+    try:
+        return user_id, int(epoch or 0)
+    except ValueError:
+        return None
+
+
+class MemoryStore:
+    def __init__(self, maxsize=100000):
+        self.maxsize = maxsize
+        self._sessions = OrderedDict()
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, sid):
+        with self._lock:
+            entry = self._sessions.get(sid)
+            if entry is None or entry[1] < time.time():
+                return None
+            self._sessions.move_to_end(sid)
+            return entry[0]
+
+    def set(self, sid, data, ttl):
+        with self._lock:
+            self._sessions[sid] = (data, time.time() + ttl)
+            self._sessions.move_to_end(sid)
+            while len(self._sessions) > self.maxsize:
+                self._sessions.popitem(last=False)
+
+    def delete(self, sid):
+        with self._lock:
+            self._sessions.pop(sid, None)
+
+    def version(self, user_id):
+        return self._versions.get(user_id, 0)
+
+    def bump(self, user_id):
+        with self._lock:
+            self._versions[user_id] = self._versions.get(user_id, 0) + 1
+
+    def clear(self):
+        with self._lock:
+            self._sessions.clear()
+            self._versions.clear()
+
+
+class SqliteStore:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+
+    # One connection per thread, reopened in forked workers
+    @property
+    def db(self):
+        if getattr(self._local, "pid", None) != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS sessions (sid TEXT PRIMARY KEY, data BLOB, expires REAL)")
+            connection.execute("CREATE TABLE IF NOT EXISTS user_versions (user_id TEXT PRIMARY KEY, version INTEGER)")
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def get(self, sid):
+        row = self.db.execute("SELECT data, expires FROM sessions WHERE sid = ?", (sid,)).fetchone()
+        if row is None or row[1] < time.time():
+            return None
+        return pickle.loads(row[0])
+
+    def set(self, sid, data, ttl):
+        now = time.time()
+        self.db.execute("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", (sid, pickle.dumps(data), now + ttl))
+        # Expired sessions are swept now and then by whoever writes
+        if random.random() < 0.001:
+            self.db.execute("DELETE FROM sessions WHERE expires < ?", (now,))
+
+    def delete(self, sid):
+        self.db.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+
+    def version(self, user_id):
+        row = self.db.execute("SELECT version FROM user_versions WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    def bump(self, user_id):
+        self.db.execute("INSERT INTO user_versions VALUES (?, 1) "
+                        "ON CONFLICT(user_id) DO UPDATE SET version = version + 1", (user_id,))
+
+    def clear(self):
+        self.db.execute("DELETE FROM sessions")
+        self.db.execute("DELETE FROM user_versions")
+
+
+class ServerSession(CallbackDict, SessionMixin):
+    def __init__(self, initial=None, sid=None, new=False):
+        def on_update(self):
+            self.modified = True
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.modified = False
+        self.replaced_sid = None
+
+    # Move the session to a new id, so an id planted before sign-in is worthless
+    def regenerate(self):
+        self.replaced_sid = self.replaced_sid or self.sid
+        self.sid = new_sid()
+        self.modified = True
+
+
+class ServerSessionInterface(SessionInterface):
+    def __init__(self, store):
+        self.store = store
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if sid:
+            data = self.store.get(sid)
+            if data is not None:
+                return ServerSession(data, sid=sid)
+        return ServerSession(sid=new_sid(), new=True)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if session.replaced_sid:
+            self.store.delete(session.replaced_sid)
+        if not session:
+            if not session.new and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path, secure=secure, samesite=samesite,
+                                       httponly=httponly)
+            return
+        if not self.should_set_cookie(app, session):
+            return
+        self.store.set(session.sid, dict(session), int(app.permanent_session_lifetime.total_seconds()))
+        response.set_cookie(name, session.sid, expires=self.get_expiration_time(app, session), httponly=httponly,
+                            domain=domain, path=path, secure=secure, samesite=samesite)
+
+
+class SessionStore:
+    def __init__(self):
+        self.store = MemoryStore()
+        self.backend = "memory"
+        self.user_ttl = 300
+        self.hits = 0
+        self.misses = 0
+        self.revoked = 0
+
+    def init_app(self, app):
+        self.backend = app.config.get("SESSION_BACKEND", "sqlite")
+        self.user_ttl = app.config.get("SESSION_USER_TTL", self.user_ttl)
+        if self.backend == "sqlite":
+            path = app.config.get("SESSION_SQLITE_PATH") or os.path.join(app.instance_path, "sessions.sqlite3")
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.store = SqliteStore(path)
+        else:
+            # The user versions live here even with cookie sessions
+            self.store = MemoryStore()
+        if self.backend != "cookie":
+            app.session_interface = ServerSessionInterface(self.store)
+        user_logged_in.connect(self._logged_in, app)
+        user_logged_out.connect(self._logged_out, app)
+
+    # The signed-in user from the session's snapshot while it is current,
+    # without any I/O beyond the store
+    def cached_user(self, token):
+        from flaskblog import User
+        parsed = parse_token(token)
+        snapshot = session.get(snapshot_key)
+        if parsed is None or snapshot is None:
+            return None
+        user_id, epoch = parsed
+        fields, version, stamped = snapshot
+        if (fields[0] != user_id or fields[4] != epoch or stamped < time.time() - self.user_ttl
+                or version != self.store.version(user_id)):
+            return None
+        return User(*fields)
+
+    # Flask-Login's user_loader
+    def load_user(self, token):
+        from flaskblog import User
+        user = self.cached_user(token)
+        if user is not None:
+            self.hits += 1
+            return user
+        self.misses += 1
+        parsed = parse_token(token)
+        if parsed is None:
+            return None
+        user_id, epoch = parsed
+        # Read before the profile: a change in between leaves the snapshot stale, not wrong
+        version = self.store.version(user_id)
+        user = User.get(user_id)
+        if user is None or user.epoch != epoch:
+            # Deleted, or signed in before a password reset
+            self.revoked += 1
+            session.pop("_user_id", None)
+            session.pop(snapshot_key, None)
+            return None
+        self.remember(user, version)
+        return user
+
+    # Store a snapshot of `user` in the session
+    def remember(self, user, version=None):
+        if version is None:
+            version = self.store.version(user.id)
+        session[snapshot_key] = ((user.id, user.username, user.email, user.image, user.epoch), version, time.time())
+
+    # Change feed handler: sessions of a changed user reload it
+    def user_changed(self, event):
+        if event["coll"] == "users":
+            self.store.bump(str(event["id"]))
+
+    def _logged_in(self, app, user):
+        if isinstance(session, ServerSession):
+            session.regenerate()
+        self.remember(user)
+
+    def _logged_out(self, app, user):
+        session.pop(snapshot_key, None)
+
+    def stats(self):
+        return {"backend": self.backend, "user_hits": self.hits, "user_misses": self.misses,
+                "revoked": self.revoked}
@@ -0,0 +1,89 @@
+# Startup profile
+#
+# `flask profile-startup` imports the package and builds the app in a fresh
+# interpreter under `python -X importtime`, then reports what each module
+# costs, the time to a ready app and the process's peak memory. Modules
+# only needed on rare paths (image uploads, email, Markdown, optional
+# backends) must stay out of startup: the command fails when one of them is
+# imported, or when --budget-ms / --budget-mb is exceeded, so CI can keep
+# cold starts from creeping back up (tests/test_startup.py checks the same
+# defaults).
+import json
+import os
+import re
+import subprocess
+import sys
+import click
+
+# Loaded on first use, never at startup
+lazy_modules = ("PIL", "bcrypt", "flask_mail", "smtplib", "markdown", "redis", "brotli", "zstandard",
+                "concurrent.futures.process")
+
+# Default budgets for import flaskblog plus create_app(), and for peak RSS
+budget_ms = 800
+budget_mb = 80
+
+probe = """
+import json, resource, sys, time
+started = time.perf_counter()
+import flaskblog
+imported = time.perf_counter()
+flaskblog.create_app()
+ready = time.perf_counter()
+print(json.dumps({
+    "import_ms": (imported - started) * 1000,
+    "create_app_ms": (ready - imported) * 1000,
+    "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": sorted(sys.modules),
+}))
+"""
+
+importtime_line = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)$")
+
+
+# Start a fresh interpreter and return (probe result, [(module, self us, cumulative us, depth)])
+def profile_startup():
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", probe], capture_output=True, text=True,
+                            cwd=os.getcwd(), env=os.environ.copy())
+    if result.returncode != 0:
+        raise click.ClickException(f"The app failed to start:\n{result.stderr[-2000:]}")
+    modules = []
+    for line in result.stderr.splitlines():
+        match = importtime_line.match(line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            modules.append((name, int(own), int(cumulative), len(indent) // 2))
+    return json.loads(result.stdout.strip().splitlines()[-1]), modules
+
+
+@click.command("profile-startup")
+@click.option("--top", default=25, show_default=True, help="Modules to list, by cumulative import time (0: all).")
+@click.option("--budget-ms", type=float, default=budget_ms, show_default=True,
+              help="Fail when import plus create_app takes longer (0: no limit).")
+@click.option("--budget-mb", type=float, default=budget_mb, show_default=True,
+              help="Fail when the started process's peak RSS is larger (0: no limit).")
+def profile_startup_command(top, budget_ms, budget_mb):
+    """Report the import and startup cost of the app, failing over budget."""
+    report, modules = profile_startup()
+    ranked = sorted(modules, key=lambda module: module[2], reverse=True)
+    click.echo(f"{'cumulative ms':>14} {'self ms':>8}  module")
+    for name, own, cumulative, depth in ranked[:top or None]:
+        click.echo(f"{cumulative / 1000:14.1f} {own / 1000:8.1f}  {'  ' * depth}{name}")
+
+    total_ms = report["import_ms"] + report["create_app_ms"]
+    rss_mb = report["max_rss_kb"] / 1024
+    click.echo(f"\nimport flaskblog: {report['import_ms']:.0f} ms, create_app(): {report['create_app_ms']:.0f} ms, "
+               f"total {total_ms:.0f} ms")
+    click.echo(f"{len(report['modules'])} modules loaded, peak RSS {rss_mb:.1f} MB")
+
+    problems = []
+    loaded = set(report["modules"])
+    for name in lazy_modules:
+        if name in loaded:
+            problems.append(f"{name} is imported at startup, it should load on first use")
+    if budget_ms and total_ms > budget_ms:
+        problems.append(f"startup took {total_ms:.0f} ms, over the {budget_ms:.0f} ms budget")
+    if budget_mb and rss_mb > budget_mb:
+        problems.append(f"peak RSS is {rss_mb:.1f} MB, over the {budget_mb:.0f} MB budget")
+    if problems:
+        raise click.ClickException("\n".join(problems))
@@ -0,0 +1,168 @@
+# Post summaries, computed when a post is written
+#
+# Each post stores what its pages show so reads never touch the full text:
+# an excerpt, word count and reading time for the feed cards, and the body
+# rendered to HTML for the post page. Content is Markdown when the
+# `markdown` package is installed (plain paragraphs otherwise); the HTML is
+# always passed through a tag whitelist, so raw HTML and javascript: links in
+# a post are dropped. `content_hash` covers the content and the renderer:
+# an edit that leaves the content alone reuses the stored rendering, and
+# `flask posts backfill-summaries` only rewrites posts whose hash is stale.
+import hashlib
+import math
+import re
+from functools import lru_cache
+from html import escape
+from html.parser import HTMLParser
+from flask import current_app
+from pymongo import UpdateOne
+
+summary_fields = ("excerpt", "word_count", "reading_time", "content_html", "content_hash")
+# Bump when the rendering or sanitizing changes, so backfills redo every post
+renderer_version = 1
+
+allowed_tags = {
+    "p", "br", "hr", "h1", "h2", "h3", "h4", "h5", "h6", "strong", "em", "b", "i", "del", "code", "pre",
+    "blockquote", "ul", "ol", "li", "a", "img", "table", "thead", "tbody", "tr", "th", "td",
+}
+allowed_attributes = {"a": {"href", "title"}, "img": {"src", "alt", "title"}}
+void_tags = {"br", "hr", "img"}
+# Their text isn't content either
+dropped_tags = {"script", "style"}
+safe_url = re.compile(r"^(https?:|mailto:|/|#|[^:/?#]*([/?#]|$))", re.IGNORECASE)
+
+
+# Rebuild HTML from whitelisted tags and attributes, collecting the plain text
+class Sanitizer(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.html = []
+        self.text = []
+        self.open = []
+        self.dropping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in dropped_tags:
+            self.dropping += 1
+            return
+        if tag not in allowed_tags or self.dropping:
+            return
+        kept = ""
+        for name, value in attrs:
+            if name not in allowed_attributes.get(tag, ()) or value is None:
+                continue
+            if name in ("href", "src") and not safe_url.match(value.strip()):
+                continue
+            kept += f' {name}="{escape(value)}"'
+        self.html.append(f"<{tag}{kept}>")
+        if tag not in void_tags:
+            self.open.append(tag)
+        elif tag == "br":
+            self.text.append(" ")
+
+    def handle_endtag(self, tag):
+        if tag in dropped_tags:
+            self.dropping = max(0, self.dropping - 1)
+            return
+        # Only close what is open, so stray end tags can't break the page
+        if tag in self.open:
+            while self.open:
+                opened = self.open.pop()
+                self.html.append(f"</{opened}>")
+                if opened == tag:
+                    break
+            self.text.append(" ")
+
+    def handle_data(self, data):
+        if not self.dropping:
+            self.html.append(escape(data, quote=False))
+            self.text.append(data)
+
+    def result(self):
+        self.close()
+        self.html += [f"</{tag}>" for tag in reversed(self.open)]
+        return "".join(self.html), " ".join("".join(self.text).split())
+
+
+def markdown_available():
+    try:
+        import markdown
+    except ImportError:
+        return False
+    return True
+
+
+def renderer():
+    return "markdown" if current_app.config["POST_FORMAT"] == "markdown" and markdown_available() else "text"
+
+
+def content_hash(content, name):
+    return hashlib.sha1(f"{renderer_version}:{name}:{content}".encode("utf-8")).hexdigest()
+
+
+def render_text(content):
+    paragraphs = re.split(r"\n\s*\n", content.replace("\r\n", "\n").strip())
+    return "".join(f"<p>{'<br>'.join(escape(line) for line in paragraph.splitlines())}</p>"
+                   for paragraph in paragraphs if paragraph.strip())
+
+
+# Sanitized HTML and plain text of a post's content
+@lru_cache(maxsize=256)
+def render(content, name):
+    if name == "markdown":
+        import markdown
+        html = markdown.markdown(content, extensions=["fenced_code", "tables"])
+    else:
+        html = render_text(content)
+    sanitizer = Sanitizer()
+    sanitizer.feed(html)
+    return sanitizer.result()
+
+
+# Cut at a word boundary
+def excerpt(text, length):
+    if len(text) <= length:
+        return text
+    return text[:length].rsplit(" ", 1)[0].rstrip(".,;:!?") + "…"
+
+
+# The summary fields of `content`; `previous` (the stored post) is reused
+# when its hash still matches
+def summarize(content, previous=None):
+    name = renderer()
+    digest = content_hash(content, name)
+    if previous and previous.get("content_hash") == digest and all(field in previous for field in summary_fields):
+        return {field: previous[field] for field in summary_fields}
+    html, text = render(content, name)
+    word_count = len(text.split())
+    return {
+        "excerpt": excerpt(text, current_app.config["POST_EXCERPT_LENGTH"]),
+        "word_count": word_count,
+        "reading_time": max(1, math.ceil(word_count / current_app.config["POST_WORDS_PER_MINUTE"])),
+        "content_html": html,
+        "content_hash": digest,
+    }
+
+
+# Compute the summaries of stored posts that lack them or whose hash is
+# stale; returns (checked, updated)
+def backfill_summaries(posts, batch_size=500, force=False, progress=None):
+    checked = updated = 0
+    requests = []
+    for post in posts.find({}, {"content": 1, "content_hash": 1}, batch_size=batch_size):
+        checked += 1
+        content = post.get("content") or ""
+        if not force and post.get("content_hash") == content_hash(content, renderer()):
+            continue
+        requests.append(UpdateOne({"_id": post["_id"], "content": post.get("content")},
+                                  {"$set": summarize(content)}))
+        if len(requests) == batch_size:
+            updated += posts.bulk_write(requests, ordered=False).modified_count
+            requests = []
+            if progress is not None:
+                progress(checked, updated)
+    if requests:
+        updated += posts.bulk_write(requests, ordered=False).modified_count
+    if progress is not None:
+        progress(checked, updated)
+    return checked, updated
@@ -4,42 +4,76 @@ from flaskblog.users.forms import (RegistrationForm, LoginForm, UpdateAccountFor
                              RequestResetForm, ResetPasswordForm)
 from datetime import datetime
 from bson.objectid import ObjectId
-from flaskblog import bcrypt, User
+from flaskblog import passwords, User
 from flask_login import login_user, current_user, logout_user, login_required
 from flaskblog.utils import save_image, send_email
-from flaskblog import mongo
+from flaskblog.images import InvalidImage
+from flaskblog.export import export_args, export_query_args, stream_export, stream_export_async
+from flaskblog.pagination import decode_cursor, encode_cursor, keyset_filter, keyset_sort, trim_window
+from flaskblog import (mongo, database, async_database, profile_cache, response_cache, image_pipeline,
+                       metrics, author_fanout, rate_limiter, change_feed, session_store)
+from flaskblog.ratelimit import form_email
+from flaskblog.asgi import async_view, run_sync
 
 
 users_blueprint = Blueprint("users", __name__)
 
 @users_blueprint.route("/register", methods=["GET", "POST"])
+@rate_limiter.limit()
 def register():
     form = RegistrationForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode("utf-8")
+        with metrics.timer("bcrypt"):
+            hashed_password = passwords.hash(form.password.data)
         user = {"username": form.username.data, "email": form.email.data, "password": hashed_password, "date_joined": datetime.now(), "image": "default.jpg"}
         user_id = mongo.db.users.insert_one(user).inserted_id
+        change_feed.publish("users", "insert", {"_id": user_id})
         flash(f'Account created for {user["username"]}! You can now log in', category="success")
         return redirect(url_for("users.login"))
     return render_template("register.html",title="Register" , form=form)
 
 # Login page
+def login_result(form, user_data, password_ok):
+    if password_ok:
+        user = User.from_document(user_data)
+        login_user(user, remember=form.remember.data)
+        flash('You have been logged in!', 'success')
+        next_page = request.args.get('next')
+        return redirect(next_page) if next_page else redirect(url_for("main.home"))
+    rate_limiter.record_failure(form_email())
+    flash('Login unsuccessful. Please check email and password.', 'danger')
+    return render_template("login.html",title="Login" , form=form)
+
 @users_blueprint.route("/login", methods=["GET", "POST"])
+@rate_limiter.limit(account=form_email, charge_account="failure")
 def login():
     if current_user.is_authenticated:  # Redirect if already logged in
         return redirect(url_for("main.home"))
     form = LoginForm()
-    if form.validate_on_submit():
-         user_data = mongo.db.users.find_one({"email": form.email.data})
-         if user_data and bcrypt.check_password_hash(user_data["password"], form.password.data):
-            user = User(str(user_data["_id"]), user_data["username"], user_data["email"], user_data["image"])
-            login_user(user, remember=form.remember.data)
-            flash('You have been logged in!', 'success')
-            next_page = request.args.get('next')
-            return redirect(next_page) if next_page else redirect(url_for("main.home"))
-         else:
-            flash('Login unsuccessful. Please check email and password.', 'danger')
-    return render_template("login.html",title="Login" , form=form)
+    if not form.validate_on_submit():
+        return render_template("login.html",title="Login" , form=form)
+    user_data = mongo.db.users.find_one({"email": form.email.data}, {"posts": 0})
+    with metrics.timer("bcrypt"):
+        password_ok = user_data is not None and passwords.check(user_data["password"], form.password.data)
+    if password_ok:
+        passwords.upgrade(user_data, form.password.data, mongo.db.users)
+    return login_result(form, user_data, password_ok)
+
+@async_view("users.login")
+@rate_limiter.limit(account=form_email, charge_account="failure")
+async def login_async():
+    if current_user.is_authenticated:
+        return redirect(url_for("main.home"))
+    form = LoginForm()
+    if not form.validate_on_submit():
+        return render_template("login.html",title="Login" , form=form)
+    user_data = await async_database.db.users.find_one({"email": form.email.data}, {"posts": 0})
+    with metrics.timer("bcrypt"):
+        password_ok = user_data is not None and await passwords.check_async(user_data["password"], form.password.data)
+    # Both write (Mongo, the session store), so they run off the loop
+    if password_ok:
+        await run_sync(passwords.upgrade, user_data, form.password.data, mongo.db.users)
+    return await run_sync(login_result, form, user_data, password_ok)
 
 # Logout Page
 @users_blueprint.route("/logout")
@@ -58,19 +92,35 @@ def logout():
 def account():
     form = UpdateAccountForm()
     if form.validate_on_submit():
-        new_image = save_image(form.image.data)
-        mongo.db.users.update_one({"_id": ObjectId(current_user.id)}, {"$set": {"username": form.username.data, "email": form.email.data, "image": new_image}})
-        updated_user_data = mongo.db.users.find_one({"_id": ObjectId(current_user.id)})
-        current_user.username = updated_user_data["username"]
-        current_user.email = updated_user_data["email"]
-        current_user.image = updated_user_data["image"]
-        flash(f'Account updated successfully!', category="success")
-        return redirect(url_for("users.account"))
+        try:
+            new_image = save_image(form.image.data)
+        except InvalidImage:
+            form.image.errors.append("Please upload a valid image.")
+        else:
+            old_image, old_username = current_user.image, current_user.username
+            mongo.db.users.update_one({"_id": ObjectId(current_user.id)}, {"$set": {"username": form.username.data, "email": form.email.data, "image": new_image}})
+            change_feed.publish("users", "update", {"_id": ObjectId(current_user.id), "username": form.username.data,
+                                                    "email": form.email.data, "image": new_image})
+            updated_user_data = profile_cache.get(current_user.id)
+            # Later requests load the user from the session's snapshot
+            session_store.remember(User.from_document(updated_user_data))
+            if new_image != old_image:
+                image_pipeline.release(old_image, mongo.db.users)
+            # Refresh the author snapshot embedded in this user's posts
+            if (updated_user_data["username"], updated_user_data["image"]) != (old_username, old_image):
+                author_fanout.schedule(current_user.id, updated_user_data)
+            flash(f'Account updated successfully!', category="success")
+            return redirect(url_for("users.account"))
     elif request.method == "GET":
         form.username.data = current_user.username
         form.email.data = current_user.email
     image_file = url_for("static", filename="profile_pics/" + current_user.image)
-    return render_template("account.html", title="Account", image_file=image_file, form=form)
+    renditions = image_pipeline.renditions(current_user.image)
+    image_webp = None
+    if renditions:
+        image_webp = (f'{url_for("static", filename=renditions[125]["webp"])} 1x, '
+                      f'{url_for("static", filename=renditions[256]["webp"])} 2x')
+    return render_template("account.html", title="Account", image_file=image_file, image_webp=image_webp, form=form)
 
 
 ### Users
@@ -82,60 +132,123 @@ def add_user():
     # Create a new user object excluding 'confirm_password'
     user = {"username": data["username"], "email": data["email"], "password": data["password"], "date_joined": datetime.now()}
     mongo.db.users.insert_one(user)
+    change_feed.publish("users", "insert", {"_id": user["_id"]})
     flash(f'{user["email"]} signed in!', category="success")
     return redirect(url_for("main.home"))
 
 # Get all users
+def users_export_args():
+    # Explicit projection: password hashes never leave the database
+    limit, after, fields, export_format = export_args(
+        ("_id", "username", "email", "image", "date_joined"), ("username", "email", "image", "date_joined"))
+    projection = {field: 1 for field in fields}
+    projection.setdefault("_id", 0)
+    return limit, after, export_format, projection
+
 @users_blueprint.route('/api/users', methods=['GET'])
+@response_cache.conditional(tags=lambda: ["users"], query_args=export_query_args, headers=("Accept",))
 def get_all_users():
-    users = list(mongo.db.users.find({}, {"_id": 0}))
-    return jsonify(users)
+    limit, after, export_format, projection = users_export_args()
+    return stream_export(database.db.users, projection, limit, after, export_format)
+
+@async_view("users.get_all_users")
+@response_cache.conditional(tags=lambda: ["users"], query_args=export_query_args, headers=("Accept",))
+async def get_all_users_async():
+    limit, after, export_format, projection = users_export_args()
+    return await stream_export_async(async_database.db.users, projection, limit, after, export_format)
 
 # Update a user
 @users_blueprint.route('/api/users/update', methods=['PUT'])
 def update_user():
     data = request.json
     mongo.db.users.update_one({"_id": data["_id"]}, {"$set": data})
+    change_feed.publish("users", "update", data)
+    if "username" in data or "image" in data:
+        user = profile_cache.get(data["_id"])
+        if user:
+            author_fanout.schedule(user["_id"], user)
     return jsonify({"message": "User updated successfully!"})
 
 # Delete a user
 @users_blueprint.route('/api/users/delete', methods=['DELETE'])
 def delete_user():
     data = request.json
-    mongo.db.users.delete_one({"username": data["username"]})
+    user = mongo.db.users.find_one_and_delete({"username": data["username"]}, projection={"_id": 1})
+    if user:
+        change_feed.publish("users", "delete", user)
     return jsonify({"message": "User deleted successfully!"})
 
-# Get user posts
+# Get user posts, newest first, through the posts(author, date_posted, _id) index
+def user_posts_query(user_id):
+    limit = min(max(request.args.get("limit", 20, type=int), 1), 100)
+    fields = ("_id", "title", "date_posted")
+    if "content" in request.args.get("fields", "").split(","):
+        fields += ("content",)
+    match = {"author": ObjectId(user_id)}
+    position = decode_cursor(request.args.get("cursor", ""))
+    if position is not None:
+        date_posted, post_id, _, _ = position
+        match = {"$and": [match, keyset_filter(date_posted, post_id, descending=True)]}
+    return match, {field: 1 for field in fields}, limit
+
+
+def user_posts_response(user_id, window, limit):
+    posts, has_more = trim_window(window, limit)
+    response = jsonify(posts)
+    if has_more and posts:
+        token = encode_cursor(posts[-1], "next", "newest")
+        response.headers["X-Next-Cursor"] = token
+        next_url = url_for("users.get_user_posts", user_id=user_id, cursor=token, limit=limit, _external=True)
+        response.headers["Link"] = f'<{next_url}>; rel="next"'
+    return response
+
 @users_blueprint.route('/api/users/<user_id>/posts', methods=['GET'])
+@response_cache.conditional(tags=lambda user_id: ["feed", "users"], query_args=("limit", "cursor", "fields"))
 def get_user_posts(user_id):
-    user = mongo.db.users.find_one({"_id": ObjectId(user_id)})
-    if not user:
+    if profile_cache.get(user_id) is None:
         return jsonify({"error": "User not found"}), 404
+    match, projection, limit = user_posts_query(user_id)
+    window = list(database.db.posts.find(match, projection).sort(keyset_sort(descending=True)).limit(limit + 1))
+    return user_posts_response(user_id, window, limit)
 
-    # Fetch posts using the `posts` field
-    posts = list(mongo.db.posts.find({"_id": {"$in": user["posts"]}}))
-    return jsonify(posts)
+@async_view("users.get_user_posts")
+@response_cache.conditional(tags=lambda user_id: ["feed", "users"], query_args=("limit", "cursor", "fields"))
+async def get_user_posts_async(user_id):
+    db = async_database.db
+    if not await profile_cache.get_many_async([user_id], db.users):
+        return jsonify({"error": "User not found"}), 404
+    match, projection, limit = user_posts_query(user_id)
+    window = await db.posts.find(match, projection).sort(keyset_sort(descending=True)).limit(limit + 1).to_list(None)
+    return user_posts_response(user_id, window, limit)
 
 
+# Progress of the job refreshing a user's posts after a profile change
+@users_blueprint.route('/api/users/<user_id>/fanout', methods=['GET'])
+def get_user_fanout(user_id):
+    progress = author_fanout.progress(user_id)
+    if progress is None:
+        return jsonify({"error": "No fan-out job for this user"}), 404
+    return jsonify(progress)
 
 
 # Request password reset
 @users_blueprint.route('/reset_password', methods=['GET', 'POST'])
+@rate_limiter.limit(account=form_email)
 def request_reset():
     if current_user.is_authenticated:  # Redirect if already logged in
         return redirect(url_for("main.home"))
     form = RequestResetForm()
     if form.validate_on_submit():
-        user = mongo.db.users.find_one({"email": form.email.data})
+        user = mongo.db.users.find_one({"email": form.email.data}, {"posts": 0})
         if user:
-            user_instance = User(str(user["_id"]), user["username"], user["email"], user["image"])
+            user_instance = User.from_document(user)
             token = user_instance.get_reset_token()
             send_email(user["email"], "Reset Password", token)
-            flash(f"Password reset email sent to {user["email"]}!", category="info")
+            flash(f"Password reset email sent to {user['email']}!", category="info")
             return redirect(url_for("main.home"))
         else:
             flash("No account found with that email!", category="danger")
-            return redirect(url_for("main.    home"))
+            return redirect(url_for("main.home"))
     return render_template("request_reset.html", form=form, title="Reset Password")
 
 # password reset
@@ -149,10 +262,13 @@ def request_token(token):
         return redirect(url_for("main.home"))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode("utf-8")
+        with metrics.timer("bcrypt"):
+            hashed_password = passwords.hash(form.password.data)
         data = {"password": hashed_password}
-        res = mongo.db.users.update_one({"_id": ObjectId(user.id)}, {"$set": data })
-        print(res.modified_count)
+        # A new session epoch signs the user out everywhere and spends the token
+        res = mongo.db.users.update_one({"_id": ObjectId(user.id)}, {"$set": data, "$inc": {"session_epoch": 1}})
+        change_feed.publish("users", "update", {"_id": ObjectId(user.id)})
+        current_app.logger.info("Password reset for user %s (modified=%s)", user.id, res.modified_count)
         flash(f'Your password has been updated! You can now log in', category="success")
         return redirect(url_for("users.login"))
     return render_template("reset_password.html", form=form, title="Reset Password", token=token)
\ No newline at end of file
@@ -1,33 +1,25 @@
 # Send Email
-from flask import url_for, current_app
-from flaskblog import mail
-from flask_mail import Message
+from flask import url_for, current_app, flash
+from flaskblog import mail_queue, image_pipeline
 from flask_login import current_user
-from PIL import Image
-import secrets
-import os
 
+# The body is rendered here, inside the request, and delivered in the background
 def send_email(to, subject, token):
-    msg = Message(subject, sender=current_app.config["MAIL_USERNAME"], recipients=[to])
-    msg.body = f'''To reset your password, please click the following link:
+    body = f'''To reset your password, please click the following link:
 {url_for('users.request_token', token=token, _external=True)}
 
 If you did not request a password reset, please ignore this email.
     '''
-    mail.send(msg)
+    mail_queue.enqueue(to, subject, body, sender=current_app.config["MAIL_USERNAME"])
 
 
-# Function to upload image
+# Function to upload image; raises InvalidImage for files that aren't images
 def save_image(form_image):
     if form_image:
-        random_hex = secrets.token_hex(8)
-        _, f_ext = os.path.splitext(form_image.filename)
-        image_fn = random_hex + f_ext
-        image_path = os.path.join(current_app.root_path, "static/profile_pics", image_fn)
-        output_size = (125, 125)
-        i = Image.open(form_image)
-        i.thumbnail(output_size)
-        i.save(image_path)
-        return image_fn
-    else:
-        return current_user.image
\ No newline at end of file
+        image = image_pipeline.process(form_image)
+        if image is not None:
+            return image
+        # Still rendering: keep the current picture rather than point at missing files
+        flash("Your new picture is taking a while to process, please upload it again in a minute.",
+              category="warning")
+    return current_user.image
\ No newline at end of file
@@ -0,0 +1,45 @@
+# Production server: `gunicorn -c gunicorn.conf.py run:app`
+#
+# The app is loaded once in the master and forked into the workers
+# (flaskblog/server.py has the hooks). Workers are replaced after
+# max_requests (plus jitter, so they don't all restart together) and on
+# `kill -HUP <master>`, each finishing its in-flight requests first. HUP
+# doesn't load new code into a preloading master: to deploy, start a new
+# master with `kill -USR2 <master>`, then stop the old one with `kill -TERM`.
+import multiprocessing
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+# More than one thread per worker switches to the threaded worker, for
+# request mixes that mostly wait on Mongo and SMTP. It is the default while
+# the change feed is on: every open home page holds a thread on the
+# new-post stream (sync workers answer that stream with 204 instead)
+events_enabled = os.getenv("EVENTS_ENABLED", "true").lower() == "true"
+threads = int(os.getenv("GUNICORN_THREADS", 16 if events_enabled else 1))
+worker_class = "gthread" if threads > 1 else "sync"
+preload_app = True
+
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 2000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 200))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 30))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+
+accesslog = os.getenv("GUNICORN_ACCESS_LOG", "-")
+
+
+def when_ready(server):
+    from flaskblog.server import compile_templates
+    if server.cfg.preload_app:
+        server.log.info("Compiled %d templates", compile_templates(server.app.wsgi()))
+
+
+def post_fork(server, worker):
+    from flaskblog.server import after_fork
+    after_fork(worker.app.wsgi())
+
+
+def post_worker_init(worker):
+    from flaskblog.server import warm_up
+    warm_up(worker.app.wsgi(), connections=worker.cfg.threads)
@@ -2,5 +2,6 @@ from flaskblog import create_app
 
 app = create_app()
 
+# Development server. In production run `gunicorn -c gunicorn.conf.py run:app`
 if __name__ == "__main__":
-    app.run(debug=True)
\ No newline at end of file
+    app.run(debug=True)
@@ -0,0 +1,30 @@
+# Startup cost: see `flask profile-startup` (flaskblog/startup.py)
+import os
+import pytest
+from flaskblog import startup
+
+root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="module")
+def report():
+    # create_app() needs its config, not a reachable Mongo
+    with pytest.MonkeyPatch.context() as patch:
+        patch.chdir(root)
+        for name, value in (("SECRET_KEY", "test"), ("MONGO_URI", "mongodb://localhost:27017/flaskblog"),
+                            ("MAIL_PORT", "1025")):
+            patch.setenv(name, os.environ.get(name, value))
+        return startup.profile_startup()[0]
+
+
+@pytest.mark.parametrize("name", startup.lazy_modules)
+def test_rare_path_modules_are_not_imported_at_startup(report, name):
+    assert name not in report["modules"]
+
+
+def test_startup_time_is_within_budget(report):
+    assert report["import_ms"] + report["create_app_ms"] <= startup.budget_ms
+
+
+def test_startup_memory_is_within_budget(report):
+    assert report["max_rss_kb"] / 1024 <= startup.budget_mb